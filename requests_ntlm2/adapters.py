@@ -1,18 +1,32 @@
+import collections
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
 from requests.adapters import HTTPAdapter
-from requests.packages.urllib3.connection import HTTPConnection, HTTPSConnection
 from requests.packages.urllib3.poolmanager import pool_classes_by_scheme
 from six.moves.urllib.parse import urlparse
 
+from . import clock
 from .connection import DEFAULT_HTTP_VERSION
 from .connection import HTTPConnection as _HTTPConnection
 from .connection import HTTPSConnection as _HTTPSConnection
 from .core import NtlmCompatibility
+from .hostcache import get_host_cache
+from .keepalive import get_keep_alive_tracker
+from .keepwarm import get_keep_warm_scheduler
+from .pool import HTTPConnectionPool, HTTPSConnectionPool
+from .tunnels import get_tunnel_pool
 
 
 logger = logging.getLogger(__name__)
 
+PREWARM_MAX_WORKERS = 8
+# how long opening a connection (and its tunnel) may take when pre-warming
+PREWARM_TIMEOUT = 10.0
+
+# how long it took to open one connection (and its tunnel) when pre-warming, or why it failed
+PrewarmResult = collections.namedtuple("PrewarmResult", ("url", "host", "port", "elapsed", "error"))
+
 
 class HttpProxyAdapter(HTTPAdapter):
     def __init__(self, user_agent=None, *args, **kwargs):
@@ -64,6 +78,9 @@ class HttpProxyAdapter(HTTPAdapter):
 
 
 class HttpNtlmAdapter(HttpProxyAdapter):
+    # replaced by the adapter's own pool classes in `_setup`
+    pool_classes_by_scheme = pool_classes_by_scheme
+
     def __init__(
         self,
         ntlm_username,
@@ -76,7 +93,33 @@ class HttpNtlmAdapter(HttpProxyAdapter):
     ):
         """
         Thin wrapper around requests.adapters.HTTPAdapter
+
+        The following options are keyword-only, as the positional arguments
+        after `proxy_tunnelling_http_version` go to `HttpProxyAdapter`:
+
+        :param host_cache: A `requests_ntlm2.hostcache.HostCapabilityCache` (or the path of its
+                           file) used to persist what was learnt about the proxy
+        :param tunnel_pool: A `requests_ntlm2.tunnels.TunnelPool` (or True for one with the
+                            default limits) that keeps authenticated CONNECT tunnels which
+                            would otherwise be closed, so that new connections can reuse them
+        :param handshake_limiter: A `requests_ntlm2.limiter.HandshakeLimiter` limiting how many
+                                  tunnels can be going through the NTLM dance with the proxy at once
+        :param keep_alive_tracker: A `requests_ntlm2.keepalive.KeepAliveTracker` learning how long
+                                   the proxy and servers keep idle connections open, so that they
+                                   are retired before that. Defaults to one shared by the whole process,
+                                   or to one that persists the timeouts in `host_cache` when given
+        :param keep_warm: A `requests_ntlm2.keepwarm.KeepWarmScheduler` (or True for one with the
+                          default settings) that pings the idle authenticated connections and
+                          tunnels in the background, so that they are not closed for being idle
         """
+        self.host_cache = get_host_cache(kwargs.pop("host_cache", None))
+        self.tunnel_pool = get_tunnel_pool(kwargs.pop("tunnel_pool", None))
+        self.handshake_limiter = kwargs.pop("handshake_limiter", None)
+        self.keep_alive_tracker = get_keep_alive_tracker(kwargs.pop("keep_alive_tracker", None), self.host_cache)
+        keep_warm = kwargs.pop("keep_warm", None)
+        self.keep_warm = get_keep_warm_scheduler(keep_warm)
+        # a scheduler that was passed in may be shared with other adapters
+        self._owns_keep_warm = keep_warm is True
         self._setup(
             ntlm_username,
             ntlm_password,
@@ -86,25 +129,112 @@ class HttpNtlmAdapter(HttpProxyAdapter):
         )
         super(HttpNtlmAdapter, self).__init__(*args, **kwargs)
 
+    def init_poolmanager(self, *args, **kwargs):
+        super(HttpNtlmAdapter, self).init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = self.pool_classes_by_scheme
+
+    def proxy_manager_for(self, proxy, **proxy_kwargs):
+        manager = super(HttpNtlmAdapter, self).proxy_manager_for(proxy, **proxy_kwargs)
+        # SOCKS proxy managers have pool classes of their own
+        if not proxy.lower().startswith("socks"):
+            manager.pool_classes_by_scheme = self.pool_classes_by_scheme
+        return manager
+
     def close(self):
         self._teardown()
+        if self.keep_warm is not None:
+            self.keep_warm.remove_pools(*self.pool_classes_by_scheme.values())
+            if self._owns_keep_warm:
+                self.keep_warm.stop()
         super(HttpNtlmAdapter, self).close()
+        if self.tunnel_pool is not None:
+            self.tunnel_pool.clear()
 
-    @staticmethod
-    def _setup(username, password, ntlm_compatibility, ntlm_strict_mode, http_version):
-        pool_classes_by_scheme["http"].ConnectionCls = _HTTPConnection
-        pool_classes_by_scheme["https"].ConnectionCls = _HTTPSConnection
-        _HTTPSConnection.set_ntlm_auth_credentials(username, password)
-
-        if http_version:
-            _HTTPSConnection.set_http_version(http_version)
-
-        _HTTPSConnection.ntlm_compatibility = ntlm_compatibility
-        _HTTPConnection.ntlm_strict_mode = ntlm_strict_mode
+    def prewarm(self, urls, connections=1, proxies=None, max_workers=PREWARM_MAX_WORKERS, timeout=PREWARM_TIMEOUT):
+        """
+        Opens `connections` connections to each of `urls` (through the proxy
+        in `proxies`, if any, which authenticates the tunnels) at the same
+        time on a pool of threads, and leaves them in the connection pools
+        so that the first requests do not have to wait for them.
+
+        Connections that are already open count towards `connections`, and
+        urllib3 does not keep more than `pool_maxsize` connections per host.
+        Opening a connection fails after `timeout` seconds. Returns a list of
+        `PrewarmResult`, one for each connection opened.
+        """
+        pending = []
+        # held until all of them are checked out, as the pool would hand out
+        # the same open connection again
+        already_open = []
+        try:
+            for url in urls:
+                pool = self.get_connection(url, proxies)
+                for _ in range(connections):
+                    conn = pool._get_conn()
+                    if getattr(conn, "sock", None) is None:
+                        pending.append((url, pool, conn, timeout))
+                    else:
+                        already_open.append((pool, conn))
+        finally:
+            for pool, conn in already_open:
+                pool._put_conn(conn)
+
+        if not pending:
+            return []
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(pending))) as executor:
+            return list(executor.map(lambda args: self._prewarm_connection(*args), pending))
 
     @staticmethod
-    def _teardown():
-        pool_classes_by_scheme["http"].ConnectionCls = HTTPConnection
-        pool_classes_by_scheme["https"].ConnectionCls = HTTPSConnection
-        _HTTPSConnection.clear_ntlm_auth_credentials()
-        _HTTPSConnection.clear_http_version()
+    def _prewarm_connection(url, pool, conn, timeout=PREWARM_TIMEOUT):
+        start = clock.now()
+        error = None
+        # urllib3 sets it again from the timeout of each request
+        conn.timeout = timeout
+        try:
+            if pool.proxy is not None and pool.scheme == "https":
+                pool._prepare_proxy(conn)
+            else:
+                conn.connect()
+        except Exception as e:
+            logger.warning("failed to pre-warm a connection to %s: %s", url, e)
+            conn.close()
+            conn, error = None, e
+        elapsed = clock.now() - start
+        if error is None:
+            logger.debug("pre-warmed a connection to %s in %.3fs", url, elapsed)
+        # an empty slot is put back for a failed connection, like urllib3 does
+        pool._put_conn(conn)
+        return PrewarmResult(url, pool.host, pool.port, elapsed, error)
+
+    def _setup(self, username, password, ntlm_compatibility, ntlm_strict_mode, http_version):
+        # the settings live on connection classes of this adapter's own, so that adapters
+        # with different credentials or proxies do not get in each other's way. The
+        # pools hand out the connections that are already authenticated first
+        self.connection_cls = _HTTPSConnection.with_ntlm_settings(
+            username,
+            password,
+            ntlm_compatibility=ntlm_compatibility,
+            ntlm_strict_mode=ntlm_strict_mode,
+            http_version=http_version,
+            host_cache=self.host_cache,
+            tunnel_pool=self.tunnel_pool,
+            handshake_limiter=self.handshake_limiter,
+            keep_alive_tracker=self.keep_alive_tracker
+        )
+        self.pool_classes_by_scheme = {
+            "http": type("HTTPConnectionPool", (HTTPConnectionPool,), {
+                "ConnectionCls": _HTTPConnection,
+                "keep_alive_tracker": self.keep_alive_tracker,
+                "keep_warm": self.keep_warm,
+            }),
+            "https": type("HTTPSConnectionPool", (HTTPSConnectionPool,), {
+                "ConnectionCls": self.connection_cls,
+                "keep_alive_tracker": self.keep_alive_tracker,
+                "keep_warm": self.keep_warm,
+            }),
+        }
+
+    def _teardown(self):
+        self.connection_cls.clear_ntlm_auth_credentials()
+        self.connection_cls.clear_host_cache()
+        self.connection_cls.clear_tunnel_pool()
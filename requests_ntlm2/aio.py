@@ -0,0 +1,465 @@
+"""
+asyncio version of the NTLM dance, for services that drive many connections
+from a single event loop instead of a thread per request. Python 3 only.
+
+NTLM authenticates the connection rather than the request, so the dance is
+done over an `AsyncHTTPConnection` that stays open for the requests that
+follow it.
+"""
+import asyncio
+import logging
+import ssl
+
+from requests.structures import CaseInsensitiveDict
+from six.moves.http_client import PROXY_AUTHENTICATION_REQUIRED
+
+from .connection import DEFAULT_HTTP_VERSION, get_tunnel_header_bytes, get_workstation
+from .core import (
+    NtlmCompatibility,
+    get_auth_type_from_header,
+    get_cached_certificate_hash_bytes,
+    get_channel_bindings,
+    get_ntlm_credentials
+)
+from .dance import HttpNtlmContext
+from .state import HandshakeStats
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TIMEOUT = 30.0
+MAX_LINE_SIZE = 64 * 1024
+MAX_HEADERS = 100
+
+
+def _get_ssl_context(ssl_option):
+    """the SSLContext for an `ssl` argument: False, True or a SSLContext"""
+    if not ssl_option or isinstance(ssl_option, ssl.SSLContext):
+        return ssl_option or None
+    return ssl.create_default_context()
+
+
+class AsyncResponse(object):
+    """The parts of a HTTP response that the NTLM dance needs"""
+
+    def __init__(self, status_code, reason, headers, content=b""):
+        self.status_code = status_code
+        self.reason = reason
+        self.headers = headers
+        self.content = content
+        self.history = []
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8", "replace")
+
+    def __repr__(self):
+        return "<{} [{}]>".format(self.__class__.__name__, self.status_code)
+
+
+class AsyncHTTPConnection(object):
+    """
+    A single keep-alive HTTP/1.1 connection driven by asyncio streams. It is
+    (re)opened by the first request sent after it was closed.
+
+    :param str host: The host to connect to
+    :param int port: The port to connect to (Default: 443 if `ssl` else 80)
+    :param ssl: False for HTTP, True (or a `ssl.SSLContext`) for HTTPS
+    :param float timeout: Seconds to wait for connecting and for each read
+    """
+
+    def __init__(self, host, port=None, ssl=False, timeout=DEFAULT_TIMEOUT):
+        self.host = host
+        self.port = port or (443 if ssl else 80)
+        self.ssl = ssl
+        self.timeout = timeout
+        # the auth type the connection was authenticated with, if any, and
+        # the session security (for signing and sealing) negotiated on it
+        self.auth_type = None
+        self.session_security = None
+        self._reader = None
+        self._writer = None
+
+    @property
+    def is_connected(self):
+        return self._writer is not None and not self._reader.at_eof()
+
+    @property
+    def host_header(self):
+        if self.port == (443 if self.ssl else 80):
+            return self.host
+        return "{}:{}".format(self.host, self.port)
+
+    async def connect(self):
+        ssl_context = _get_ssl_context(self.ssl)
+        self._reader, self._writer = await asyncio.wait_for(
+            asyncio.open_connection(
+                self.host, self.port, ssl=ssl_context,
+                server_hostname=self.host if ssl_context is not None else None
+            ),
+            self.timeout
+        )
+        self.auth_type = None
+        self.session_security = None
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
+        self.auth_type = None
+        self.session_security = None
+
+    def get_peer_certificate(self):
+        """the DER encoded certificate of the server, or None if not using TLS"""
+        if self._writer is None:
+            return None
+        ssl_object = self._writer.get_extra_info("ssl_object")
+        if ssl_object is None:
+            return None
+        return ssl_object.getpeercert(True)
+
+    async def _readline(self):
+        try:
+            line = await asyncio.wait_for(self._reader.readline(), self.timeout)
+        except ValueError:
+            raise IOError("line longer than {} bytes".format(MAX_LINE_SIZE))
+        if len(line) > MAX_LINE_SIZE:
+            raise IOError("line longer than {} bytes".format(MAX_LINE_SIZE))
+        return line
+
+    async def _readexactly(self, size):
+        return await asyncio.wait_for(self._reader.readexactly(size), self.timeout)
+
+    async def _read_headers(self):
+        headers = CaseInsensitiveDict()
+        for _ in range(MAX_HEADERS + 1):
+            line = await self._readline()
+            if line in (b"\r\n", b"\n", b""):
+                return headers
+            name, _, value = line.decode("latin-1").partition(":")
+            name, value = name.strip(), value.strip()
+            if name in headers:
+                # same as what requests does with repeated headers
+                value = "{}, {}".format(headers[name], value)
+            headers[name] = value
+        raise IOError("got more than {} headers".format(MAX_HEADERS))
+
+    async def _read_chunked_body(self):
+        body = bytearray()
+        while True:
+            line = await self._readline()
+            size = int(line.split(b";", 1)[0].strip(), 16)
+            if size == 0:
+                # skip the trailers
+                await self._read_headers()
+                return bytes(body)
+            body += await self._readexactly(size)
+            await self._readline()
+
+    async def _read_body(self, method, status_code, headers):
+        if method == "HEAD" or status_code in (204, 304) or 100 <= status_code < 200:
+            return b""
+        if method == "CONNECT" and 200 <= status_code < 300:
+            # the tunnel starts right after the headers
+            return b""
+        if "chunked" in headers.get("Transfer-Encoding", "").lower():
+            return await self._read_chunked_body()
+        if "Content-Length" in headers:
+            return await self._readexactly(int(headers["Content-Length"]))
+        # the body runs until the server closes the connection
+        body = await asyncio.wait_for(self._reader.read(), self.timeout)
+        self.close()
+        return body
+
+    async def _read_response(self, method):
+        while True:
+            status_line = await self._readline()
+            if not status_line:
+                raise ConnectionResetError("connection closed before the response was received")
+            version, status_code, reason = (status_line.decode("latin-1").rstrip("\r\n").split(" ", 2) + [""])[:3]
+            if not version.startswith("HTTP/"):
+                raise IOError("bad status line: {!r}".format(status_line))
+            status_code = int(status_code)
+            headers = await self._read_headers()
+            if status_code != 100:
+                break
+
+        content = await self._read_body(method, status_code, headers)
+        if self._writer is not None and not self._is_keep_alive(method, version, status_code, headers):
+            self.close()
+        return AsyncResponse(status_code, reason, headers, content)
+
+    @staticmethod
+    def _is_keep_alive(method, version, status_code, headers):
+        if method == "CONNECT" and 200 <= status_code < 300:
+            return True
+        connection = headers.get("Connection", headers.get("Proxy-Connection", "")).lower()
+        if version == "HTTP/1.0":
+            return connection == "keep-alive"
+        return connection != "close"
+
+    def _format_request(self, method, target, headers, body):
+        headers = CaseInsensitiveDict(headers or {})
+        headers.setdefault("Host", self.host_header)
+        if body is not None or method in ("POST", "PUT", "PATCH"):
+            headers["Content-Length"] = str(len(body or b""))
+
+        lines = ["{} {} HTTP/1.1".format(method, target)]
+        lines.extend("{}: {}".format(name, value) for name, value in headers.items())
+        return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + (body or b"")
+
+    async def request(self, method, target, headers=None, body=None):
+        """
+        Sends a request and reads the whole of its response
+
+        :param str method: The HTTP method
+        :param str target: The request target, eg "/path?query"
+        :param headers: The request headers; Host and Content-Length are added
+        :param bytes body: The request body, if any
+        """
+        method = method.upper()
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        return await self.send(self._format_request(method, target, headers, body), method)
+
+    async def send(self, data, method):
+        """sends an already formatted `method` request and reads the whole of its response"""
+        if not self.is_connected:
+            self.close()
+            await self.connect()
+
+        self._writer.write(data)
+        try:
+            await asyncio.wait_for(self._writer.drain(), self.timeout)
+            return await self._read_response(method)
+        except BaseException:
+            # the connection is in an unknown state
+            self.close()
+            raise
+
+    async def start_tls(self, ssl_context, server_hostname):
+        """upgrades the connection (eg a CONNECT tunnel) to TLS"""
+        if hasattr(self._writer, "start_tls"):
+            await asyncio.wait_for(
+                self._writer.start_tls(ssl_context, server_hostname=server_hostname), self.timeout
+            )
+            return
+
+        # python < 3.11
+        loop = asyncio.get_event_loop()
+        transport = self._writer.transport
+        protocol = transport.get_protocol()
+        transport = await asyncio.wait_for(
+            loop.start_tls(transport, protocol, ssl_context, server_hostname=server_hostname),
+            self.timeout
+        )
+        self._writer = asyncio.StreamWriter(transport, protocol, self._reader, loop)
+
+    def detach(self):
+        """
+        Returns the (reader, writer) pair of the connection, which is then
+        left to the caller; the connection itself is closed.
+        """
+        streams = self._reader, self._writer
+        self._reader = self._writer = None
+        self.auth_type = None
+        self.session_security = None
+        return streams
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+
+class AsyncHttpNtlmAuth(object):
+    """
+    Does the NTLM (or Negotiate) dance over an `AsyncHTTPConnection`, using
+    the same `HttpNtlmContext` as `HttpNtlmAuth` for the messages.
+    """
+
+    def __init__(
+        self,
+        username,
+        password,
+        send_cbt=True,
+        ntlm_compatibility=NtlmCompatibility.NTLMv2_DEFAULT,
+        ntlm_strict_mode=False
+    ):
+        """Create an authentication handler for NTLM over asyncio HTTP connections.
+
+        :param str username: Username in 'domain\\username' format
+        :param str password: Password
+        :param bool send_cbt: Will send the channel bindings over a
+                              HTTPS channel (Default: True)
+        :param ntlm_compatibility: The Lan Manager Compatibility Level to use with the auth message
+        :param ntlm_strict_mode: If False, tries to Type 2 (ie challenge response) NTLM message
+                                that does not conform to the NTLM spec
+        """
+        self.username, self.password, self.domain = get_ntlm_credentials(username, password)
+        if self.domain:
+            self.domain = self.domain.upper()
+        self.send_cbt = send_cbt
+        self.ntlm_compatibility = ntlm_compatibility
+        self.ntlm_strict_mode = ntlm_strict_mode
+        self.session_security = None
+        self.stats = HandshakeStats()
+
+    def _new_ntlm_context(self, auth_type, cbt_data=None):
+        return HttpNtlmContext(
+            self.username,
+            self.password,
+            domain=self.domain,
+            auth_type=auth_type,
+            cbt_data=cbt_data,
+            ntlm_compatibility=self.ntlm_compatibility,
+            ntlm_strict_mode=self.ntlm_strict_mode
+        )
+
+    def _get_cbt_data(self, connection):
+        if not self.send_cbt:
+            return None
+        certificate = connection.get_peer_certificate()
+        if certificate is None:
+            return None
+        return get_channel_bindings(get_cached_certificate_hash_bytes(certificate))
+
+    async def request(self, connection, method, target, headers=None, body=None):
+        """
+        Sends a request on `connection`, going through the NTLM dance first if
+        the server asks for it. Returns the `AsyncResponse` to the request.
+        """
+        response = await connection.request(method, target, headers=headers, body=body)
+        if response.status_code != 401:
+            if connection.auth_type is not None:
+                self.stats.increment("reused_connections")
+            return response
+
+        if connection.auth_type is not None:
+            # the server has forgotten that this connection was authenticated
+            connection.auth_type = None
+            connection.session_security = None
+            self.stats.increment("expired_connections")
+
+        auth_type = get_auth_type_from_header(response.headers.get("www-authenticate", ""))
+        if auth_type is None:
+            return response
+        return await self.authenticate(
+            connection, method, target, headers, body, auth_type, response
+        )
+
+    async def authenticate(
+        self, connection, method, target, headers, body, auth_type, response=None,
+        auth_header_field="www-authenticate", auth_header="Authorization"
+    ):
+        """
+        Sends the Type 1 (negotiate) and Type 3 (authenticate) legs of the NTLM
+        dance on `connection`. `response` is the 401 that started it, if any.
+        """
+        headers = CaseInsensitiveDict(headers or {})
+        if not connection.is_connected:
+            # the dance has to be done on the connection that will be reused
+            await connection.connect()
+
+        ntlm_context = self._new_ntlm_context(auth_type, cbt_data=self._get_cbt_data(connection))
+        headers[auth_header] = ntlm_context.get_negotiate_header()
+        response2 = await connection.request(method, target, headers=headers, body=body)
+        history = [r for r in (response, response2) if r is not None]
+
+        challenge = ntlm_context.get_challenge_from_header(response2.headers.get(auth_header_field))
+        if challenge is None or not connection.is_connected:
+            # not a challenge, or it was only valid on the connection that was just closed
+            logger.warning("gave up on the NTLM dance with %s: no challenge", connection.host_header)
+            self.stats.increment("failed_handshakes")
+            response2.history = history[:-1]
+            return response2
+
+        if response2.headers.get("set-cookie"):
+            headers["Cookie"] = response2.headers.get("set-cookie")
+
+        ntlm_context.parse_challenge_message(challenge)
+        headers[auth_header] = ntlm_context.get_authenticate_header()
+        response3 = await connection.request(method, target, headers=headers, body=body)
+
+        self.session_security = ntlm_context.session_security
+        if response3.status_code in (401, 407):
+            self.stats.increment("failed_handshakes")
+        else:
+            self.stats.increment("handshakes")
+            connection.auth_type = auth_type
+            connection.session_security = ntlm_context.session_security
+        response3.history = history
+        return response3
+
+
+async def open_ntlm_tunnel(
+    proxy_host,
+    proxy_port,
+    host,
+    port,
+    username,
+    password,
+    ssl=True,
+    proxy_ssl=False,
+    headers=None,
+    ntlm_compatibility=NtlmCompatibility.NTLMv2_DEFAULT,
+    ntlm_strict_mode=False,
+    http_version=DEFAULT_HTTP_VERSION,
+    timeout=DEFAULT_TIMEOUT
+):
+    """
+    asyncio version of `VerifiedHTTPSConnection._tunnel`: opens a CONNECT
+    tunnel to host:port through a proxy that authenticates with NTLM and
+    returns the (reader, writer) pair of the tunnel.
+
+    :param ssl: True (or a `ssl.SSLContext`) to upgrade the tunnel to TLS with
+                `host`, False to return the bare tunnel
+    :param proxy_ssl: Same as `ssl`, but for the connection to the proxy itself
+    :param headers: Extra headers for the CONNECT request
+    :raises OSError: If the proxy does not open the tunnel
+    """
+    username, password, domain = get_ntlm_credentials(username, password)
+    ntlm_context = HttpNtlmContext(
+        username,
+        password,
+        domain=domain,
+        workstation=get_workstation(),
+        auth_type="NTLM",
+        ntlm_compatibility=ntlm_compatibility,
+        ntlm_strict_mode=ntlm_strict_mode
+    )
+
+    connection = AsyncHTTPConnection(proxy_host, proxy_port, ssl=proxy_ssl, timeout=timeout)
+    tunnel_headers = dict(headers or {})
+    try:
+        header_bytes = get_tunnel_header_bytes(
+            host, port, tunnel_headers, http_version, ntlm_context.get_negotiate_header()
+        )
+        response = await connection.send(header_bytes, "CONNECT")
+
+        if response.status_code == PROXY_AUTHENTICATION_REQUIRED:
+            challenge = ntlm_context.get_challenge_from_header(response.headers.get("proxy-authenticate"))
+            if challenge is not None and connection.is_connected:
+                ntlm_context.parse_challenge_message(challenge)
+                header_bytes = get_tunnel_header_bytes(
+                    host, port, tunnel_headers, http_version, ntlm_context.get_authenticate_header()
+                )
+                response = await connection.send(header_bytes, "CONNECT")
+
+        if response.status_code != 200:
+            raise OSError(
+                "Tunnel connection failed: %d %s" % (response.status_code, response.reason.strip())
+            )
+
+        if ssl:
+            await connection.start_tls(_get_ssl_context(ssl), server_hostname=host)
+    except BaseException:
+        connection.close()
+        raise
+
+    return connection.detach()
@@ -0,0 +1,137 @@
+import logging
+import mmap
+import tempfile
+
+import six
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SPOOL_THRESHOLD = 1024 * 1024
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+
+class ReplayableBody(object):
+    """
+    Wraps a streaming (ie non-seekable) request body so that it can be sent
+    more than once during the NTLM dance.
+
+    Every chunk taken from the original body is teed into a buffer, which is
+    kept in memory up to `spool_threshold` bytes and spilled to a temporary
+    file after that. Iterating again replays the buffered bytes (from an mmap
+    of the temporary file once spilled) before carrying on with whatever is
+    left of the original body.
+    """
+
+    def __init__(self, body, spool_threshold=DEFAULT_SPOOL_THRESHOLD, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.spool_threshold = spool_threshold
+        self.chunk_size = chunk_size
+        self._source = self._iter_source(body)
+        self._buffer = bytearray()
+        self._file = None
+        self._size = 0
+
+    @property
+    def spooled_size(self):
+        """number of bytes taken from the original body so far"""
+        return self._size
+
+    @property
+    def is_spilled(self):
+        """whether the buffered bytes have been moved to a temporary file"""
+        return self._file is not None
+
+    def _iter_source(self, body):
+        if hasattr(body, "read"):
+            while True:
+                chunk = body.read(self.chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        else:
+            for chunk in body:
+                yield chunk
+
+    def _spool(self, chunk):
+        self._size += len(chunk)
+        if self._file is None and self._size > self.spool_threshold:
+            logger.debug("spilling request body to disk after %d bytes", self._size)
+            self._file = tempfile.TemporaryFile()
+            self._file.write(self._buffer)
+            self._buffer = bytearray()
+
+        if self._file is None:
+            self._buffer += chunk
+        else:
+            self._file.seek(0, 2)
+            self._file.write(chunk)
+
+    def _iter_spooled(self, size):
+        if self._file is None:
+            for start in range(0, size, self.chunk_size):
+                yield bytes(self._buffer[start:start + self.chunk_size])
+            return
+
+        if size == 0:
+            return
+        self._file.flush()
+        view = mmap.mmap(self._file.fileno(), size, access=mmap.ACCESS_READ)
+        try:
+            for start in range(0, size, self.chunk_size):
+                yield view[start:start + self.chunk_size]
+        finally:
+            view.close()
+
+    def __iter__(self):
+        for chunk in self._iter_spooled(self._size):
+            yield chunk
+
+        for chunk in self._source:
+            if not chunk:
+                continue
+            if isinstance(chunk, six.text_type):
+                chunk = chunk.encode("utf-8")
+            self._spool(chunk)
+            yield chunk
+
+    def close(self):
+        self._buffer = bytearray()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def iter_chunks(source, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Yields the data from a file object, or from an iterable of bytes-like
+    objects, in chunks of at most `chunk_size` bytes
+    """
+    if hasattr(source, "read"):
+        while True:
+            chunk = source.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+    for buf in source:
+        if len(buf) <= chunk_size:
+            if len(buf):
+                yield buf
+            continue
+        view = memoryview(buf)
+        for start in range(0, len(view), chunk_size):
+            yield view[start:start + chunk_size]
+
+
+def is_streaming_body(body):
+    """whether the request body can only be read once"""
+    if body is None or isinstance(body, (six.binary_type, six.text_type, bytearray)):
+        return False
+    if isinstance(body, (ReplayableBody, list, tuple, dict)):
+        return False
+    if hasattr(body, "seek"):
+        try:
+            return not body.seekable()
+        except (AttributeError, ValueError):
+            return False
+    return hasattr(body, "read") or hasattr(body, "__iter__")
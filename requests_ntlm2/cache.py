@@ -0,0 +1,73 @@
+import threading
+from collections import OrderedDict
+
+from . import clock
+
+
+class LRUCache(object):
+    """
+    Thread-safe, bounded, least-recently-used mapping whose entries optionally expire
+    after `ttl` seconds. `hits` and `misses` count the outcome of the lookups done with `get`.
+    """
+
+    def __init__(self, maxsize=128, ttl=None, timer=clock.now):
+        if maxsize < 1:
+            raise ValueError("maxsize must be at least 1, got {}".format(maxsize))
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._timer = timer
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def _is_expired(self, expires_at):
+        return expires_at is not None and expires_at <= self._timer()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires_at = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+
+            if self._is_expired(expires_at):
+                del self._data[key]
+                self.misses += 1
+                return default
+
+            self.hits += 1
+            # mark as most recently used
+            del self._data[key]
+            self._data[key] = value, expires_at
+            return value
+
+    def set(self, key, value):
+        expires_at = None if self.ttl is None else self._timer() + self.ttl
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value, expires_at
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires_at = self._data.pop(key)
+            except KeyError:
+                return default
+        if self._is_expired(expires_at):
+            return default
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
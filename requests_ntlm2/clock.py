@@ -0,0 +1,6 @@
+import time
+
+
+# the clock of every timeout, deadline and idle time: unlike time.time it does
+# not jump when the system time is changed (where the platform has one)
+now = time.monotonic if hasattr(time, "monotonic") else time.time
@@ -1,47 +1,249 @@
 import logging
 import re
-import select
 import socket
 
 from requests.packages.urllib3.connection import DummyConnection
 from requests.packages.urllib3.connection import HTTPConnection as _HTTPConnection
 from requests.packages.urllib3.connection import HTTPSConnection as _HTTPSConnection
 from requests.packages.urllib3.connection import VerifiedHTTPSConnection as _VerifiedHTTPSConnection
-from six.moves.http_client import PROXY_AUTHENTICATION_REQUIRED, LineTooLong
+from six.moves.http_client import (
+    PROXY_AUTHENTICATION_REQUIRED,
+    BadStatusLine,
+    HTTPException,
+    LineTooLong
+)
 
-from .core import NtlmCompatibility, get_ntlm_credentials, noop
+from . import clock
+from .core import NtlmCompatibility, get_authority, get_ntlm_credentials, noop, response_will_close
 from .dance import HttpNtlmContext
-
-
-IO_WAIT_TIMEOUT = 0.05
+from .keepalive import default_keep_alive_tracker, is_socket_alive
 
 
 logger = logging.getLogger(__name__)
 
 # maximal line length when calling readline().
 _MAXLINE = 65536
+# how much is asked of the socket at once when reading the proxy's responses
+_RECV_SIZE = 8192
 
 _ASSUMED_HTTP09_STATUS_LINES = (
     ("HTTP/0.9", 200, ""),
     ("HTTP/0.9", 200, "OK"),
 )
 
-_TRACKED_HEADERS = (
-    "proxy-authenticate",
-    "proxy-support",
-    "cache-control",
-    "date",
-    "server",
-    "proxy-connection",
-    "connection",
-    "content-length",
-    "content-type",
+# maximal number of headers in a response to a CONNECT request
+_MAXHEADERS = 100
+
+_STATUS_LINE_RE = re.compile(
+    br"(?P<version>HTTP/\d\.\d)\s+(?P<status>\d+)\s+(?P<message>.+)",
+    re.DOTALL
 )
 
+# headers of the responses to CONNECT requests that are logged, and at which level
+_TRACKED_HEADERS = {
+    b"proxy-authenticate": logging.DEBUG,
+    b"proxy-support": logging.INFO,
+    b"cache-control": logging.INFO,
+    b"date": logging.INFO,
+    b"server": logging.INFO,
+    b"proxy-connection": logging.INFO,
+    b"connection": logging.INFO,
+    b"content-length": logging.INFO,
+    b"content-type": logging.INFO,
+}
+
 HTTP_VERSION_11 = "HTTP/1.1"
 HTTP_VERSION_10 = "HTTP/1.0"
 DEFAULT_HTTP_VERSION = HTTP_VERSION_10
 
+# http.client keeps the state of the connection in private attributes
+_CS_IDLE = "Idle"
+
+# options that make a TLS tunnel unsuitable for a connection that asks for different ones
+_TUNNEL_CERT_OPTIONS = ("cert_reqs", "ca_certs", "ca_cert_dir", "cert_file", "assert_hostname", "assert_fingerprint")
+
+
+def get_workstation():
+    """the name this machine gives in the NTLM messages, if it can be found"""
+    try:
+        return socket.gethostname().upper()
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+def get_tunnel_header_bytes(host, port, tunnel_headers, http_version, proxy_auth_header=None):
+    """
+    Builds the CONNECT request for a tunnel to host:port. The Host,
+    Proxy-Connection and (if given) Proxy-Authorization headers are set on
+    `tunnel_headers` before all of them are added to the request.
+    """
+    http_connect_string = "CONNECT {host}:{port} {http_version}\r\n".format(
+        host=host,
+        port=port,
+        http_version=http_version
+    )
+    logger.debug("> %r", http_connect_string)
+    header_bytes = http_connect_string
+    if proxy_auth_header:
+        tunnel_headers["Proxy-Authorization"] = proxy_auth_header
+    tunnel_headers["Proxy-Connection"] = "Keep-Alive"
+    tunnel_headers["Host"] = "{}:{}".format(host, port)
+
+    for header in sorted(tunnel_headers):
+        value = tunnel_headers[header]
+        header_byte = "%s: %s\r\n" % (header, value)
+        logger.debug("> %r", header_byte)
+        header_bytes += header_byte
+    header_bytes += "\r\n"
+    return header_bytes.encode("latin1")
+
+
+class TunnelResponseReader(object):
+    """
+    Reads the responses of a proxy to CONNECT requests straight from its socket.
+
+    Whatever the socket has ready is taken with a single recv into a buffer
+    that lasts for the whole tunnel setup, and lines are split off that
+    buffer as they complete, so nothing that arrives early is lost between
+    the 407 and the next response. Reads block on the socket, so they are
+    bounded by its timeout (ie the connection timeout) and never poll.
+    """
+
+    def __init__(self, sock, recv_size=_RECV_SIZE):
+        self.sock = sock
+        self.recv_size = recv_size
+        self._buffer = bytearray()
+        self._eof = False
+
+    @property
+    def buffered(self):
+        """number of bytes received but not read yet"""
+        return len(self._buffer)
+
+    def _fill(self):
+        if self._eof:
+            return False
+        data = self.sock.recv(self.recv_size)
+        if not data:
+            self._eof = True
+            return False
+        self._buffer += data
+        return True
+
+    def _take(self, size):
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def readline(self, limit=_MAXLINE):
+        start = 0
+        while True:
+            end = self._buffer.find(b"\n", start)
+            if end >= 0:
+                line = self._take(end + 1)
+                break
+            if len(self._buffer) > limit:
+                raise LineTooLong("header line")
+            start = len(self._buffer)
+            if not self._fill():
+                line = self._take(len(self._buffer))
+                break
+
+        if len(line) > limit:
+            raise LineTooLong("header line")
+        return line
+
+    def read(self, size):
+        """reads `size` bytes, or fewer if the proxy closes the connection first"""
+        while len(self._buffer) < size and self._fill():
+            pass
+        return self._take(size)
+
+    def read_status(self):
+        """
+        Reads the status line and returns its (version, status, reason). A line
+        that is not a status line is taken as the start of a HTTP/0.9 response.
+        """
+        line = self.readline(_MAXLINE + 1)
+        if not line:
+            raise BadStatusLine("Remote end closed connection without response")
+
+        parts = line.decode("iso-8859-1").split(None, 2)
+        if len(parts) < 2 or not parts[0].startswith("HTTP/"):
+            logger.debug("< %r", line)
+            return _ASSUMED_HTTP09_STATUS_LINES[0]
+
+        version, status, reason = (parts + [""])[:3]
+        try:
+            status = int(status)
+        except ValueError:
+            raise BadStatusLine(line)
+        return version, status, reason.rstrip("\r\n")
+
+
+class TunnelHeaders(object):
+    """the headers of a response to a CONNECT request, by lowercased name"""
+
+    def __init__(self):
+        self._headers = {}
+
+    def __contains__(self, name):
+        return name.lower() in self._headers
+
+    def __len__(self):
+        return sum(len(values) for values in self._headers.values())
+
+    def add(self, name, value):
+        self._headers.setdefault(name.lower(), []).append(value)
+
+    def get(self, name, default=None):
+        """the first value of the header"""
+        values = self._headers.get(name.lower())
+        return values[0] if values else default
+
+    def get_all(self, name):
+        """all the values of the header, which can be repeated (eg Proxy-Authenticate)"""
+        return list(self._headers.get(name.lower(), ()))
+
+    @property
+    def content_length(self):
+        try:
+            return max(int(self.get("content-length", 0)), 0)
+        except ValueError:
+            return 0
+
+
+def read_headers(fp):
+    """
+    Reads header lines from `fp` up to the blank line that ends them. Each
+    line is split into name and value once, and the headers listed in
+    `_TRACKED_HEADERS` are logged.
+    """
+    headers = TunnelHeaders()
+    while True:
+        line = fp.readline()
+        if len(line) > _MAXLINE:
+            raise LineTooLong("header line")
+        if not line or line in (b"\r\n", b"\n"):
+            return headers
+        if len(headers) >= _MAXHEADERS:
+            raise HTTPException("got more than {} headers".format(_MAXHEADERS))
+
+        name, _, value = line.partition(b":")
+        name = name.strip().lower()
+        level = _TRACKED_HEADERS.get(name)
+        if level is not None:
+            logger.log(level, "< %r", line)
+        headers.add(name.decode("latin-1"), value.strip().decode("latin-1"))
+
+
+class TunnelResponse(object):
+    """response to a CONNECT request, whose headers and body are read from `fp`"""
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.headers = None
+
 
 class HTTPConnection(_HTTPConnection):
     pass
@@ -54,13 +256,50 @@ class HTTPSConnection(_HTTPSConnection):
 class VerifiedHTTPSConnection(_VerifiedHTTPSConnection):
     ntlm_compatibility = NtlmCompatibility.NTLMv2_DEFAULT
     ntlm_strict_mode = False
+    ntlm_host_cache = None
+    ntlm_tunnel_pool = None
+    ntlm_handshake_limiter = None
+    ntlm_keep_alive_tracker = default_keep_alive_tracker
 
     def __init__(self, *args, **kwargs):
         super(VerifiedHTTPSConnection, self).__init__(*args, **kwargs)
         self._continue_reading_headers = True
+        self._tunnel_created_at = None
+        self._tunnel_reusable = False
         if self.ntlm_compatibility is None:
             self.ntlm_compatibility = NtlmCompatibility.NTLMv2_DEFAULT
 
+    @classmethod
+    def with_ntlm_settings(
+        cls,
+        username,
+        password,
+        ntlm_compatibility=NtlmCompatibility.NTLMv2_DEFAULT,
+        ntlm_strict_mode=False,
+        http_version=None,
+        host_cache=None,
+        tunnel_pool=None,
+        handshake_limiter=None,
+        keep_alive_tracker=default_keep_alive_tracker
+    ):
+        """
+        Returns a subclass that holds its own credentials and settings, so
+        that several of them (eg one per adapter) can be used at the same
+        time without touching this class.
+        """
+        connection_cls = type(cls.__name__, (cls,), {
+            "ntlm_compatibility": ntlm_compatibility,
+            "ntlm_strict_mode": ntlm_strict_mode,
+            "ntlm_host_cache": host_cache,
+            "ntlm_tunnel_pool": tunnel_pool,
+            "ntlm_handshake_limiter": handshake_limiter,
+            "ntlm_keep_alive_tracker": keep_alive_tracker,
+        })
+        connection_cls.set_ntlm_auth_credentials(username, password)
+        if http_version:
+            connection_cls.set_http_version(http_version)
+        return connection_cls
+
     @classmethod
     def set_ntlm_auth_credentials(cls, username, password):
         cls._ntlm_credentials = get_ntlm_credentials(username, password)
@@ -82,51 +321,52 @@ class VerifiedHTTPSConnection(_VerifiedHTTPSConnection):
         cls._http_version = None
         del cls._http_version
 
+    @classmethod
+    def set_host_cache(cls, host_cache):
+        cls.ntlm_host_cache = host_cache
+
+    @classmethod
+    def clear_host_cache(cls):
+        cls.ntlm_host_cache = None
+
+    @classmethod
+    def set_tunnel_pool(cls, tunnel_pool):
+        cls.ntlm_tunnel_pool = tunnel_pool
+
+    @classmethod
+    def clear_tunnel_pool(cls):
+        cls.ntlm_tunnel_pool = None
+
     @classmethod
     def clear_ntlm_auth_credentials(cls):
         cls._ntlm_credentials = None
         del cls._ntlm_credentials
 
     @staticmethod
-    def _is_line_blank(line):
-        # for sites which EOF without sending a trailer
-        if not line or line in (b"\r\n", b"\n", b""):
-            return True
-        return False
-
-    @staticmethod
-    def _read_response_line_if_ready(response):
-        (ready, _, _) = select.select([response.fp], (), (), IO_WAIT_TIMEOUT)
-        if ready:
-            return response.fp.readline()
-
-    @staticmethod
-    def _flush_response_buffer(response):
-        (ready, _, _) = select.select([response.fp], (), (), IO_WAIT_TIMEOUT)
-        if ready:
-            response.fp.read()
+    def _discard_response_body(response, content_length):
+        """reads the body of a 407 response so that the next response can be read after it"""
+        if content_length:
+            logger.debug("discarding %d bytes of response body", content_length)
+            response.fp.read(content_length)
 
     def handle_http09_response(self, response):
-        status_line_regex = re.compile(
-            br"(?P<version>HTTP/\d\.\d)\s+(?P<status>\d+)\s+(?P<message>.+)",
-            re.DOTALL
-        )
-
         while True:
             line = response.fp.readline()
             if not line:
                 self._continue_reading_headers = False
                 break
-            match = status_line_regex.search(line)
+            match = _STATUS_LINE_RE.search(line)
             if match:
                 status_line = match.groupdict()
                 logger.debug("< %r", "{version} {status} {message}".format(**status_line))
                 return status_line["version"], int(status_line["status"]), status_line["message"]
         return None
 
-    def _get_response(self):
-        response = self.response_class(self.sock, method=self._method)
-        version, code, message = response._read_status()
+    def _get_response(self, reader=None):
+        if reader is None:
+            reader = TunnelResponseReader(self.sock)
+        response = TunnelResponse(reader)
+        version, code, message = reader.read_status()
 
         if (version, code, message) in _ASSUMED_HTTP09_STATUS_LINES:
             logger.warning("server response used outdated HTTP version: HTTP/0.9")
@@ -151,38 +391,151 @@ class VerifiedHTTPSConnection(_VerifiedHTTPSConnection):
 
     def _get_header_bytes(self, proxy_auth_header=None):
         host, port = self._get_hostport(self._tunnel_host, self._tunnel_port)
-        http_connect_string = "CONNECT {host}:{port} {http_version}\r\n".format(
-            host=host,
-            port=port,
-            http_version=self._get_http_version()
+        return get_tunnel_header_bytes(
+            host, port, self._tunnel_headers, self._get_http_version(), proxy_auth_header
         )
-        logger.debug("> %r", http_connect_string)
-        header_bytes = http_connect_string
-        if proxy_auth_header:
-            self._tunnel_headers["Proxy-Authorization"] = proxy_auth_header
-        self._tunnel_headers["Proxy-Connection"] = "Keep-Alive"
-        self._tunnel_headers["Host"] = "{}:{}".format(host, port)
-
-        for header in sorted(self._tunnel_headers):
-            value = self._tunnel_headers[header]
-            header_byte = "%s: %s\r\n" % (header, value)
-            logger.debug("> %r", header_byte)
-            header_bytes += header_byte
-        header_bytes += "\r\n"
-        return header_bytes.encode("latin1")
+
+    def _get_proxy_capabilities(self):
+        if self.ntlm_host_cache is None:
+            return None
+        return self.ntlm_host_cache.get(self._get_proxy_authority())
+
+    def _get_proxy_authority(self):
+        return get_authority("http", self.host, self.port)
+
+    def _remember_tunnel_result(self, ntlm_context, code):
+        if self.ntlm_host_cache is None:
+            return
+
+        if code == 200:
+            update = dict(auth_type="NTLM")
+            if ntlm_context.challenge_fixed:
+                update["strict_mode"] = False
+        elif code == PROXY_AUTHENTICATION_REQUIRED and ntlm_context.challenge_fixed:
+            # the proxy rejected the authenticate message built from the modified challenge
+            update = dict(strict_mode=True)
+        else:
+            return
+
+        capabilities = self._get_proxy_capabilities()
+        if capabilities is None or any(getattr(capabilities, k) != v for k, v in update.items()):
+            self.ntlm_host_cache.update(self._get_proxy_authority(), **update)
+
+    def _observe_keep_alive(self, headers):
+        if self.ntlm_keep_alive_tracker is not None:
+            self.ntlm_keep_alive_tracker.observe_headers(self._get_proxy_authority(), headers)
+
+    def _get_tunnel_key(self):
+        username, _, domain = self._ntlm_credentials
+        # the certificate options are only there once urllib3 has called set_cert()
+        cert_options = tuple(getattr(self, name, None) for name in _TUNNEL_CERT_OPTIONS)
+        return (
+            self.host, self.port, self._tunnel_host, self._tunnel_port, username, domain, self._get_http_version()
+        ) + cert_options
+
+    def _take_pooled_tunnel(self):
+        """
+        picks up an idle tunnel from the tunnel pool, skipping the ones the
+        proxy has closed or is about to close
+        """
+        key = self._get_tunnel_key()
+        tracker = self.ntlm_keep_alive_tracker
+        while True:
+            tunnel = self.ntlm_tunnel_pool.get(key)
+            if tunnel is None:
+                return None
+            idle = clock.now() - tunnel.idle_since
+            if not is_socket_alive(tunnel.sock):
+                logger.debug("dropping pooled tunnel closed by the proxy after %.1fs idle", idle)
+                if tracker is not None:
+                    tracker.observe_idle_close(self._get_proxy_authority(), idle)
+            elif tracker is not None and tracker.is_expiring(idle, self._get_proxy_authority()):
+                logger.debug("dropping pooled tunnel idle for %.1fs, before the proxy closes it", idle)
+            else:
+                if tracker is not None:
+                    tracker.observe_idle_reuse(self._get_proxy_authority(), idle)
+                return tunnel
+            tunnel.sock.close()
+
+    def _use_tunnel(self, tunnel):
+        logger.debug("reusing pooled tunnel to %s:%s", self._tunnel_host, self._tunnel_port)
+        self.sock = tunnel.sock
+        self.auto_open = 0
+        self.is_verified = tunnel.is_verified
+        self._tunnel_created_at = tunnel.created_at
+        self._tunnel_reusable = True
+
+    def connect(self):
+        if self.ntlm_tunnel_pool is not None and self._tunnel_host:
+            tunnel = self._take_pooled_tunnel()
+            if tunnel is not None:
+                return self._use_tunnel(tunnel)
+
+        limiter = self.ntlm_handshake_limiter
+        if limiter is None or not self._tunnel_host:
+            return self._connect()
+
+        with limiter.slot(self._get_proxy_authority()) as waited:
+            if waited and self.ntlm_tunnel_pool is not None:
+                # a tunnel opened while this one was waiting may have been left over
+                tunnel = self._take_pooled_tunnel()
+                if tunnel is not None:
+                    return self._use_tunnel(tunnel)
+            self._connect()
+
+    def _connect(self):
+        super(VerifiedHTTPSConnection, self).connect()
+        if self._tunnel_host:
+            self._tunnel_created_at = clock.now()
+            self._tunnel_reusable = True
+
+    def getresponse(self, *args, **kwargs):
+        if self.ntlm_tunnel_pool is None or not self._tunnel_host:
+            return super(VerifiedHTTPSConnection, self).getresponse(*args, **kwargs)
+        # the response has to be known to leave the connection open before
+        # its tunnel can go back to the tunnel pool
+        self._tunnel_reusable = False
+        response = super(VerifiedHTTPSConnection, self).getresponse(*args, **kwargs)
+        self._tunnel_reusable = not response_will_close(response)
+        return response
+
+    def _is_tunnel_idle(self):
+        if not self._tunnel_reusable or self.sock is None or self._tunnel_created_at is None:
+            return False
+        if getattr(self, "_HTTPConnection__state", None) != _CS_IDLE:
+            return False
+        response = getattr(self, "_HTTPConnection__response", None)
+        if response is not None and not response.isclosed():
+            return False
+        return is_socket_alive(self.sock)
+
+    def retire(self):
+        """closes the connection for good, rather than keeping its tunnel in the tunnel pool"""
+        self._tunnel_reusable = False
+        self.close()
+
+    def close(self):
+        tunnel_pool = self.ntlm_tunnel_pool
+        if tunnel_pool is not None and self._tunnel_host and self._is_tunnel_idle():
+            if tunnel_pool.put(self._get_tunnel_key(), self.sock, self._tunnel_created_at, self.is_verified):
+                self.sock = None
+        self._tunnel_created_at = None
+        self._tunnel_reusable = False
+        super(VerifiedHTTPSConnection, self).close()
 
     def _tunnel(self):
         username, password, domain = self._ntlm_credentials
         logger.debug("attempting to open tunnel using HTTP CONNECT")
         logger.debug("username: %s, domain: %s", username, domain)
 
-        try:
-            workstation = socket.gethostname().upper()
-        except (AttributeError, TypeError, ValueError):
-            workstation = None
-
+        workstation = get_workstation()
         logger.debug("workstation: %s", workstation)
 
+        ntlm_strict_mode = self.ntlm_strict_mode
+        capabilities = self._get_proxy_capabilities()
+        if capabilities is not None and capabilities.strict_mode:
+            ntlm_strict_mode = True
+
         ntlm_context = HttpNtlmContext(
             username,
             password,
@@ -190,51 +543,42 @@ class VerifiedHTTPSConnection(_VerifiedHTTPSConnection):
             workstation=workstation,
             auth_type="NTLM",
             ntlm_compatibility=self.ntlm_compatibility,
-            ntlm_strict_mode=self.ntlm_strict_mode
+            ntlm_strict_mode=ntlm_strict_mode
         )
 
+        reader = TunnelResponseReader(self.sock)
         negotiate_header = ntlm_context.get_negotiate_header()
         header_bytes = self._get_header_bytes(proxy_auth_header=negotiate_header)
         self.send(header_bytes)
-        version, code, message, response = self._get_response()
+        version, code, message, response = self._get_response(reader)
 
         if code == PROXY_AUTHENTICATION_REQUIRED:
             authenticate_hdr = None
-            match_string = "Proxy-Authenticate: NTLM "
-            while True:
-                line = response.fp.readline()
-                if self._is_line_blank(line):
-                    break
-
-                if line.decode("utf-8").startswith(match_string):
-                    logger.debug("< %r", line)
-                    line = line.decode("utf-8")
-                    ntlm_context.set_challenge_from_header(line)
+            response.headers = read_headers(response.fp)
+            self._observe_keep_alive(response.headers)
+            for value in response.headers.get_all("proxy-authenticate"):
+                if ntlm_context.get_challenge_from_header(value) is not None:
+                    ntlm_context.set_challenge_from_header(value)
                     authenticate_hdr = ntlm_context.get_authenticate_header()
-                    continue
-
-                if len(line) > _MAXLINE:
-                    raise LineTooLong("header line")
-
-                for header in _TRACKED_HEADERS:
-                    if line.decode("utf-8").lower().startswith("{}:".format(header)):
-                        logger.info("< %r", line)
+                    break
 
+            # the authenticate message has to go over the same connection
+            self._discard_response_body(response, response.headers.content_length)
             header_bytes = self._get_header_bytes(proxy_auth_header=authenticate_hdr)
             self.send(header_bytes)
-            version, code, message, response = self._get_response()
+            version, code, message, response = self._get_response(reader)
+            self._remember_tunnel_result(ntlm_context, code)
 
         if code != 200:
             self.close()
             raise socket.error(
                 "Tunnel connection failed: %d %s" % (code, message.strip())
             )
-        while self._continue_reading_headers:
-            line = response.fp.readline()
-            if len(line) > _MAXLINE:
-                raise LineTooLong("header line")
-            if self._is_line_blank(line):
-                break
+        if self._continue_reading_headers:
+            response.headers = read_headers(response.fp)
+            self._observe_keep_alive(response.headers)
+        if reader.buffered:
+            logger.warning("proxy sent %d unexpected bytes after opening the tunnel", reader.buffered)
 
 
 try:
@@ -1,22 +1,43 @@
 import binascii
+import collections
+import hashlib
 import logging
 import struct
 import sys
 import warnings
 
 import ntlm_auth.constants
+import six
 from aenum import IntFlag, extend_enum
 from cryptography import x509
 from cryptography.exceptions import UnsupportedAlgorithm
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import hashes
 from ntlm_auth.gss_channel_bindings import GssChannelBindingsStruct
-from ntlm_auth.messages import ChallengeMessage
+from requests.models import PreparedRequest, Response
 from requests.packages.urllib3.response import HTTPResponse
+from six.moves.urllib.parse import urlparse
+
+from . import clock
+from .cache import LRUCache
 
 
 logger = logging.getLogger(__name__)
 
+DRAIN_MAX_BYTES = 1024 * 1024
+DRAIN_TIMEOUT = 10.0
+DRAIN_CHUNK_SIZE = 16 * 1024
+CBT_CACHE_SIZE = 64
+
+# [MS-NLMP] 2.2.1.2 CHALLENGE_MESSAGE, up to (but excluding) the optional version
+_CHALLENGE_MESSAGE = struct.Struct("<8sIHHII8s8xHHI")
+_NEGOTIATE_FLAGS = struct.Struct("<I")
+_NEGOTIATE_FLAGS_OFFSET = 20
+_AV_PAIR = struct.Struct("<HH")
+_VERSION = struct.Struct("<q")
+
+_DEFAULT_PORTS = {"http": 80, "https": 443}
+
 
 class NtlmCompatibility(object):
     # see Microsoft doc on compatibility levels here: https://bit.ly/2OWZVxp
@@ -163,6 +184,44 @@ class UnknownSignatureAlgorithmOID(Warning):
     pass
 
 
+ChallengeInfo = collections.namedtuple(
+    "ChallengeInfo",
+    (
+        "message",
+        "negotiate_flags",
+        "server_challenge",
+        "target_name",
+        "target_info",
+        "version",
+        "fixed",
+    )
+)
+
+
+class ChannelBindings(GssChannelBindingsStruct):
+    """
+    TLS channel bindings for the server certificate with the given hash. The
+    structure is packed once, so instances must not be modified; they are
+    shared between NTLM contexts through `cbt_cache`.
+    """
+
+    def __init__(self, cert_hash_bytes):
+        super(ChannelBindings, self).__init__()
+        channel_binding_type = b"tls-server-end-point"  # https://tools.ietf.org/html/rfc5929#section-4
+        self[self.APPLICATION_DATA] = b":".join([channel_binding_type, cert_hash_bytes])
+        self.cert_hash_bytes = cert_hash_bytes
+        self._data = super(ChannelBindings, self).get_data()
+
+    def get_data(self):
+        return self._data
+
+
+# sha256 of the DER encoded certificate -> certificate hash
+certificate_hash_cache = LRUCache(maxsize=CBT_CACHE_SIZE)
+# certificate hash -> ChannelBindings
+cbt_cache = LRUCache(maxsize=CBT_CACHE_SIZE)
+
+
 def get_server_cert(response):
     """
     Get the certificate at the request_url and return it as a hash. Will
@@ -179,12 +238,8 @@ def get_server_cert(response):
     raw_response = response.raw
 
     if isinstance(raw_response, HTTPResponse):
-        try:
-            if sys.version_info > (3, 0):
-                socket = raw_response._fp.fp.raw._sock
-            else:
-                socket = raw_response._fp.fp._sock
-        except AttributeError:
+        socket = get_response_socket(response)
+        if socket is None:
             return None
 
         try:
@@ -192,7 +247,7 @@ def get_server_cert(response):
         except AttributeError:
             logger.debug("unable to get server certificate")
         else:
-            return get_certificate_hash_bytes(server_certificate)
+            return get_cached_certificate_hash_bytes(server_certificate)
     else:
         logger.warning(
             "Requests is running with a non urllib3 backend,"
@@ -200,6 +255,132 @@ def get_server_cert(response):
         )
 
 
+def get_response_socket(response):
+    """
+    Get the socket that the response is being read from. NTLM authenticates
+    connections rather than requests, so this is what identifies the
+    connection that has (or has not) been through the NTLM dance.
+
+    :param response: HTTP Response object
+    :return: The socket object or None if it cannot be determined
+    """
+    raw_response = getattr(response, "raw", None)
+    if not isinstance(raw_response, HTTPResponse):
+        return None
+
+    try:
+        if sys.version_info > (3, 0):
+            return raw_response._fp.fp.raw._sock
+        return raw_response._fp.fp._sock
+    except AttributeError:
+        return None
+
+
+def response_will_close(response):
+    """
+    Whether the connection that the response came on is closed once the
+    response has been read. Works with the responses of http.client (and so
+    of urllib3 1.x connections) as well as with the urllib3 2.x responses
+    that wrap them.
+
+    :param response: http.client or urllib3 response object
+    :return: True if the connection cannot be reused after the response
+    """
+    will_close = getattr(response, "will_close", None)
+    if will_close is None:
+        original_response = getattr(response, "_original_response", None) or getattr(response, "_fp", None)
+        will_close = getattr(original_response, "will_close", True)
+    return bool(will_close)
+
+
+def drain_response(response, max_bytes=DRAIN_MAX_BYTES, timeout=DRAIN_TIMEOUT, chunk_size=DRAIN_CHUNK_SIZE):
+    """
+    Read and throw away the body of the response so that its connection can
+    be reused, without keeping the body in memory. If the body is longer than
+    `max_bytes`, or reading it takes longer than `timeout` seconds, the
+    connection is closed instead of being read to the end.
+
+    :param response: HTTP Response object
+    :return: True if the connection can be reused, False if it was closed
+    """
+    if response._content_consumed:
+        return True
+
+    raw_response = response.raw
+    if not isinstance(raw_response, HTTPResponse):
+        _ = response.content
+        return True
+
+    response._content = b""
+    response._content_consumed = True
+
+    content_length = response.headers.get("Content-Length", "")
+    if max_bytes is not None and content_length.isdigit() and int(content_length) > max_bytes:
+        logger.debug("not draining %s byte response body", content_length)
+        raw_response.close()
+        return False
+
+    deadline = None if timeout is None else clock.now() + timeout
+    drained = 0
+    while True:
+        chunk = raw_response.read(chunk_size, decode_content=False)
+        if not chunk:
+            return True
+
+        drained += len(chunk)
+        if max_bytes is not None and drained > max_bytes:
+            logger.debug("gave up draining response body after %d bytes", drained)
+            break
+        if deadline is not None and clock.now() > deadline:
+            logger.debug("gave up draining response body after %s seconds", timeout)
+            break
+
+    raw_response.close()
+    return False
+
+
+def get_response_stub(response):
+    """
+    Get a copy of the response that only holds on to its status, headers,
+    cookies and request, to be kept in the history of another response
+    without keeping the connection or the body of the original one around.
+
+    :param response: HTTP Response object
+    :return: HTTP Response object
+    """
+    stub = Response()
+    stub.status_code = response.status_code
+    stub.reason = response.reason
+    stub.headers = response.headers
+    stub.cookies = response.cookies
+    stub.url = response.url
+    stub.encoding = response.encoding
+    stub.elapsed = response.elapsed
+    stub.request = response.request
+    stub._content = response._content or b""
+    stub._content_consumed = True
+    return stub
+
+
+def get_request_stub(request):
+    """
+    Get a copy of the prepared request with headers of its own, that shares
+    its body, cookies and hooks with the original one.
+
+    :param request: Prepared request object
+    :return: Prepared request object
+    """
+    stub = PreparedRequest()
+    stub.method = request.method
+    stub.url = request.url
+    stub.headers = request.headers.copy()
+    stub.body = request.body
+    stub.hooks = request.hooks
+    stub._cookies = request._cookies
+    stub._body_position = getattr(request, "_body_position", None)
+    return stub
+
+
 def get_certificate_hash_bytes(certificate_der):
     # https://tools.ietf.org/html/rfc5929#section-4.1
     cert = x509.load_der_x509_certificate(certificate_der, default_backend())
@@ -228,6 +409,23 @@ def get_certificate_hash_bytes(certificate_der):
     return certificate_hash_bytes
 
 
+def get_cached_certificate_hash_bytes(certificate_der):
+    """
+    Same as `get_certificate_hash_bytes`, but skips parsing the certificate
+    when it has been seen recently. Server certificates hardly ever change.
+    """
+    if not isinstance(certificate_der, six.binary_type):
+        return get_certificate_hash_bytes(certificate_der)
+
+    key = hashlib.sha256(certificate_der).digest()
+    cert_hash_bytes = certificate_hash_cache.get(key)
+    if cert_hash_bytes is None:
+        cert_hash_bytes = get_certificate_hash_bytes(certificate_der)
+        if cert_hash_bytes is not None:
+            certificate_hash_cache.set(key, cert_hash_bytes)
+    return cert_hash_bytes
+
+
 def get_auth_type_from_header(header):
     """
     Given a WWW-Authenticate or Proxy-Authenticate header, returns the
@@ -241,6 +439,34 @@ def get_auth_type_from_header(header):
     return None
 
 
+def get_authority(scheme, host, port=None):
+    """
+    Returns "scheme://host:port" in lowercase, without the port when it is the
+    default one of the scheme, which is what identifies a server (or a proxy)
+    in everything that is learnt about it.
+    """
+    if ":" in host and not host.startswith("["):
+        host = "[{}]".format(host)
+    if port is None or _DEFAULT_PORTS.get(scheme) == int(port):
+        return "{}://{}".format(scheme, host).lower()
+    return "{}://{}:{}".format(scheme, host, port).lower()
+
+
+def get_url_authority(url):
+    """
+    Returns the "scheme://host:port" part of the given URL (or authority) as
+    `get_authority` does, which is what identifies the server that we are
+    authenticating against.
+    """
+    parse_result = urlparse(url or "")
+    try:
+        port = parse_result.port
+    except ValueError:
+        # not a valid port: left as it is
+        return "{}://{}".format(parse_result.scheme, parse_result.netloc).lower()
+    return get_authority(parse_result.scheme, parse_result.hostname or "", port)
+
+
 def get_ntlm_credentials(username, password):
     try:
         domain, username = username.split("\\", 1)
@@ -262,16 +488,23 @@ def get_cbt_data(response):
     :param response: HTTP Response object
     """
 
-    cert_hash_bytes = get_server_cert(response)
+    return get_channel_bindings(get_server_cert(response))
+
+
+def get_channel_bindings(cert_hash_bytes):
+    """
+    Gets the (shared) channel bindings for the server certificate with the given hash
+
+    :param cert_hash_bytes: The result of `get_certificate_hash_bytes`, or None
+    """
     if not cert_hash_bytes:
         logger.debug("server cert not found, channel binding tokens (CBT) wont be used")
         return None
 
-    channel_binding_type = b"tls-server-end-point"  # https://tools.ietf.org/html/rfc5929#section-4
-    data_type = GssChannelBindingsStruct.APPLICATION_DATA
-
-    cbt_data = GssChannelBindingsStruct()
-    cbt_data[data_type] = b":".join([channel_binding_type, cert_hash_bytes])
+    cbt_data = cbt_cache.get(cert_hash_bytes)
+    if cbt_data is None:
+        cbt_data = ChannelBindings(cert_hash_bytes)
+        cbt_cache.set(cert_hash_bytes, cbt_data)
     logger.debug("cbt data: %s", cbt_data.get_data())
     return cbt_data
 
@@ -286,12 +519,103 @@ def is_challenge_message(msg):
 
 def is_challenge_message_valid(msg):
     try:
-        _ = ChallengeMessage(msg)
+        parse_challenge(msg, fix=False)
         return True
-    except struct.error:
+    except ValueError:
         return False
 
 
+def _parse_av_pairs(view):
+    av_pairs = []
+    offset = 0
+    while True:
+        if len(view) - offset < _AV_PAIR.size:
+            raise ValueError("target info is not terminated by MsvAvEOL")
+        av_id, av_length = _AV_PAIR.unpack_from(view, offset)
+        offset += _AV_PAIR.size
+        if av_id == ntlm_auth.constants.AvId.MSV_AV_EOL:
+            return tuple(av_pairs)
+        av_pairs.append((av_id, view[offset:offset + av_length]))
+        offset += av_length
+
+
+def parse_challenge(msg, fix=True):
+    """
+    Parses a Type 2 (challenge) message in a single pass, without copying it.
+
+    Some servers set the NTLMSSP_NEGOTIATE_TARGET_INFO flag but send target
+    info that cannot be parsed. With `fix`, the flag is cleared instead of
+    failing; only then is the message copied.
+
+    :param msg: The decoded challenge message
+    :param fix: Whether to clear the target info flag if the target info is broken
+    :return: ChallengeInfo, with the target name and the values in the
+             (av_id, value) target info pairs as memoryviews of `msg`
+    :raises ValueError: If the message is not a valid challenge message
+    """
+    view = memoryview(msg)
+    if len(view) < _CHALLENGE_MESSAGE.size:
+        raise ValueError("challenge message is too short: {} bytes".format(len(view)))
+
+    (
+        signature,
+        message_type,
+        target_name_length,
+        _,
+        target_name_offset,
+        negotiate_flags,
+        server_challenge,
+        target_info_length,
+        _,
+        target_info_offset,
+    ) = _CHALLENGE_MESSAGE.unpack_from(view)
+
+    if signature != ntlm_auth.constants.NTLM_SIGNATURE:
+        raise ValueError("invalid signature: {!r}".format(signature))
+    if message_type != ntlm_auth.constants.MessageTypes.NTLM_CHALLENGE:
+        raise ValueError("not a challenge message: message type {}".format(message_type))
+
+    flags = ntlm_auth.constants.NegotiateFlags
+    version = None
+    if (
+        negotiate_flags & flags.NTLMSSP_NEGOTIATE_VERSION
+        and negotiate_flags & flags.NTLMSSP_NEGOTIATE_EXTENDED_SESSIONSECURITY
+        and len(view) > _CHALLENGE_MESSAGE.size
+    ):
+        if len(view) < _CHALLENGE_MESSAGE.size + _VERSION.size:
+            raise ValueError("challenge message version is truncated")
+        version = _VERSION.unpack_from(view, _CHALLENGE_MESSAGE.size)[0]
+
+    target_name = None
+    if negotiate_flags & flags.NTLMSSP_REQUEST_TARGET:
+        target_name = view[target_name_offset:target_name_offset + target_name_length]
+
+    target_info = None
+    fixed = False
+    if negotiate_flags & flags.NTLMSSP_NEGOTIATE_TARGET_INFO:
+        try:
+            target_info = _parse_av_pairs(view[target_info_offset:target_info_offset + target_info_length])
+        except ValueError:
+            if not fix:
+                raise
+            logger.debug("ignoring the target info of the challenge message")
+            negotiate_flags &= ~flags.NTLMSSP_NEGOTIATE_TARGET_INFO
+            msg = bytearray(msg)
+            _NEGOTIATE_FLAGS.pack_into(msg, _NEGOTIATE_FLAGS_OFFSET, negotiate_flags)
+            msg = bytes(msg)
+            fixed = True
+
+    return ChallengeInfo(
+        message=msg,
+        negotiate_flags=negotiate_flags,
+        server_challenge=server_challenge,
+        target_name=target_name,
+        target_info=target_info,
+        version=version,
+        fixed=fixed,
+    )
+
+
 def fix_target_info(challenge_msg):
     if not is_challenge_message(challenge_msg):
         return challenge_msg
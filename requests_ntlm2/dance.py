@@ -1,14 +1,23 @@
 import base64
 import logging
+import struct
 
 import ntlm_auth.messages
 import ntlm_auth.ntlm
 
-from .core import NegotiateFlags, NtlmCompatibility, fix_target_info
+from .cache import LRUCache
+from .core import NegotiateFlags, NtlmCompatibility, parse_challenge
+from .session_security import SessionSecurity
 
 
 logger = logging.getLogger(__name__)
 
+NEGOTIATE_HEADER_CACHE_SIZE = 64
+
+# The negotiate (Type 1) message only depends on the auth type, flags, domain and workstation,
+# so the same message and header can be shared by every context with the same configuration
+negotiate_header_cache = LRUCache(maxsize=NEGOTIATE_HEADER_CACHE_SIZE)
+
 
 class HttpNtlmContext(ntlm_auth.ntlm.NtlmContext):
     """Thin wrapper over ntlm_auth.ntlm.NtlmContext for HTTP"""
@@ -60,6 +69,8 @@ class HttpNtlmContext(ntlm_auth.ntlm.NtlmContext):
         self._auth_type = auth_type
         self._challenge_token = None
         self.ntlm_strict_mode = ntlm_strict_mode
+        self.challenge_fixed = False
+        self.challenge_info = None
         super(HttpNtlmContext, self).__init__(
             username,
             password,
@@ -101,6 +112,32 @@ class HttpNtlmContext(ntlm_auth.ntlm.NtlmContext):
     def session_security(self, value):
         self._session_security = value
 
+    def step(self, input_token=None):
+        if self._negotiate_message is None:
+            return super(HttpNtlmContext, self).step(input_token)
+
+        # as ntlm-auth does, but with our (faster) SessionSecurity, so that
+        # the keys are only derived once
+        self._challenge_message = ntlm_auth.messages.ChallengeMessage(input_token)
+        self._authenticate_message = ntlm_auth.messages.AuthenticateMessage(
+            self.username,
+            self.password,
+            self.domain,
+            self.workstation,
+            self._challenge_message,
+            self.ntlm_compatibility,
+            server_certificate_hash=self._server_certificate_hash,
+            cbt_data=self.cbt_data,
+        )
+        self._authenticate_message.add_mic(self._negotiate_message, self._challenge_message)
+
+        flags = struct.unpack("<I", self._authenticate_message.negotiate_flags)[0]
+        if flags & (NegotiateFlags.NEGOTIATE_SEAL | NegotiateFlags.NEGOTIATE_SIGN):
+            self._session_security = SessionSecurity(flags, self.session_key)
+
+        self.complete = True
+        return self._authenticate_message.get_data()
+
     def create_negotiate_message(self):
         msg = self.step()
         return base64.b64encode(msg)
@@ -109,34 +146,50 @@ class HttpNtlmContext(ntlm_auth.ntlm.NtlmContext):
         challenge_msg = base64.b64decode(msg2)
 
         try:
-            flags = NegotiateFlags(
-                ntlm_auth.messages.ChallengeMessage(challenge_msg).negotiate_flags
-            )
-            logger.debug("challenge flags: %s", flags)
+            self.challenge_info = parse_challenge(challenge_msg, fix=not self.ntlm_strict_mode)
+        except ValueError as ex:
+            # leave it to ntlm-auth to fail on it
+            logger.warning("invalid challenge message: %s", ex)
+            self.challenge_info = None
+            self._challenge_token = challenge_msg
+            return
+
+        try:
+            logger.debug("challenge flags: %s", NegotiateFlags(self.challenge_info.negotiate_flags))
         except Exception:
             logger.exception("unable to check challenge flags; e=")
 
-        if self.ntlm_strict_mode:
-            self._challenge_token = challenge_msg
-        else:
-            fixed_challenge_msg = fix_target_info(challenge_msg)
-            if fixed_challenge_msg != challenge_msg:
-                logger.debug("original challenge: %s", base64.b64encode(challenge_msg))
-                logger.debug("modified challenge: %s", base64.b64encode(fixed_challenge_msg))
-            self._challenge_token = fixed_challenge_msg
+        if self.challenge_info.fixed:
+            self.challenge_fixed = True
+            logger.debug("original challenge: %s", base64.b64encode(challenge_msg))
+            logger.debug("modified challenge: %s", base64.b64encode(self.challenge_info.message))
+        self._challenge_token = self.challenge_info.message
 
     def create_authenticate_message(self):
         msg = self.step(self._challenge_token)
         return base64.b64encode(msg)
 
     def get_negotiate_header(self):
+        key = None
+        if self._negotiate_message is None:
+            key = (self._auth_type, int(self.negotiate_flags), self.domain, self.workstation)
+            cached = negotiate_header_cache.get(key)
+            if cached is not None:
+                # the authenticate message and its MIC are built from the negotiate message,
+                # so the context has to move on as if it had created it
+                self._negotiate_message, result = cached
+                return result
+
         negotiate_message = self.create_negotiate_message().decode("ascii")
         result = u"{auth_type} {negotiate_message}".format(
             auth_type=self._auth_type, negotiate_message=negotiate_message
         )
+        if key is not None:
+            negotiate_header_cache.set(key, (self._negotiate_message, result))
         return result
 
-    def set_challenge_from_header(self, raw_header_value):
+    def get_challenge_from_header(self, raw_header_value):
+        """gets the base64 encoded challenge for this auth type from the header, if present"""
         if not raw_header_value:
             return None
 
@@ -149,10 +202,15 @@ class HttpNtlmContext(ntlm_auth.ntlm.NtlmContext):
             header_value = header_value.strip()
             for auth_strip in match_strings:
                 if header_value.startswith(auth_strip):
-                    challenge = header_value.replace(auth_strip, "")
-                    return self.parse_challenge_message(challenge)
+                    return header_value.replace(auth_strip, "")
         return None
 
+    def set_challenge_from_header(self, raw_header_value):
+        challenge = self.get_challenge_from_header(raw_header_value)
+        if challenge is None:
+            return None
+        return self.parse_challenge_message(challenge)
+
     def get_authenticate_header(self):
         """gets the authentication header"""
         authenticate_message = self.create_authenticate_message()
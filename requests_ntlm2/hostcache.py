@@ -0,0 +1,219 @@
+import binascii
+import collections
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+
+from .core import get_url_authority
+
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - windows
+    fcntl = None
+
+
+logger = logging.getLogger(__name__)
+
+_LOCK_EX = getattr(fcntl, "LOCK_EX", None)
+_LOCK_UN = getattr(fcntl, "LOCK_UN", None)
+
+DEFAULT_SLOTS = 1024
+MAX_PROBES = 16
+
+_MAGIC = b"RNTLMHC\x01"
+_HEADER = struct.Struct("<8sI4x")  # magic, number of slots
+_RECORD = struct.Struct("<QBBHfdI4x")  # key, scheme, flags, reserved, keep-alive, updated, crc
+_RECORD_DATA = struct.Struct("<QBBHfd")
+
+_SCHEMES = {None: 0, "NTLM": 1, "Negotiate": 2}
+_SCHEME_NAMES = {v: k for k, v in _SCHEMES.items()}
+
+_FLAG_STRICT_MODE = 0x01
+
+_host_caches = {}
+_host_caches_lock = threading.Lock()
+
+
+HostCapabilities = collections.namedtuple(
+    "HostCapabilities",
+    ("auth_type", "strict_mode", "keep_alive_timeout", "updated")
+)
+
+
+def _get_key(authority):
+    digest = hashlib.sha1(get_url_authority(authority).encode("utf-8")).digest()
+    return struct.unpack("<Q", digest[:8])[0] or 1
+
+
+def _pack(key, capabilities):
+    flags = 0
+    if capabilities.strict_mode:
+        flags |= _FLAG_STRICT_MODE
+
+    data = _RECORD_DATA.pack(
+        key,
+        _SCHEMES.get(capabilities.auth_type, 0),
+        flags,
+        0,
+        capabilities.keep_alive_timeout or 0.0,
+        capabilities.updated,
+    )
+    return _RECORD.pack(*(_RECORD_DATA.unpack(data) + (binascii.crc32(data) & 0xFFFFFFFF,)))
+
+
+def _unpack(record):
+    key, scheme, flags, _, keep_alive_timeout, updated, crc = _RECORD.unpack(record)
+    if binascii.crc32(record[:_RECORD_DATA.size]) & 0xFFFFFFFF != crc:
+        return key, None
+    return key, HostCapabilities(
+        auth_type=_SCHEME_NAMES.get(scheme),
+        strict_mode=bool(flags & _FLAG_STRICT_MODE),
+        keep_alive_timeout=keep_alive_timeout or None,
+        updated=updated,
+    )
+
+
+class HostCapabilityCache(object):
+    """
+    Small memory-mapped file that remembers what was learnt about each server:
+    the auth type it uses, whether it needs `ntlm_strict_mode` and how long it
+    keeps idle connections alive (as written by
+    `requests_ntlm2.keepalive.KeepAliveTracker`).
+
+    The file is a fixed-size open-addressing hash table of 32-byte records, so
+    many processes on the same box can share it. Writers take an exclusive
+    `flock`; readers don't lock and use a checksum to ignore torn records.
+    """
+
+    def __init__(self, path, slots=DEFAULT_SLOTS):
+        if slots < 1:
+            raise ValueError("slots must be at least 1, got {}".format(slots))
+        self.path = path
+        self._lock = threading.Lock()
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            self.slots = self._initialise(slots)
+            self._mmap = mmap.mmap(self._fd, self._get_size(self.slots))
+        except Exception:
+            os.close(self._fd)
+            raise
+
+    @staticmethod
+    def _get_size(slots):
+        return _HEADER.size + slots * _RECORD.size
+
+    def _flock(self, operation):
+        if fcntl is not None:
+            fcntl.flock(self._fd, operation)
+
+    def _initialise(self, slots):
+        self._flock(_LOCK_EX)
+        try:
+            header = os.read(self._fd, _HEADER.size)
+            if len(header) == _HEADER.size:
+                magic, existing_slots = _HEADER.unpack(header)
+                if magic == _MAGIC and os.fstat(self._fd).st_size == self._get_size(existing_slots):
+                    return existing_slots
+                logger.warning("host capability cache %r is invalid; recreating it", self.path)
+
+            os.ftruncate(self._fd, 0)
+            os.ftruncate(self._fd, self._get_size(slots))
+            os.lseek(self._fd, 0, os.SEEK_SET)
+            os.write(self._fd, _HEADER.pack(_MAGIC, slots))
+            return slots
+        finally:
+            self._flock(_LOCK_UN)
+
+    def _offset(self, index):
+        return _HEADER.size + index * _RECORD.size
+
+    def _probe(self, key):
+        start = key % self.slots
+        for i in range(min(MAX_PROBES, self.slots)):
+            index = (start + i) % self.slots
+            offset = self._offset(index)
+            yield offset, _unpack(self._mmap[offset:offset + _RECORD.size])
+
+    def get(self, authority):
+        """gets the HostCapabilities recorded for "scheme://host:port", or None"""
+        key = _get_key(authority)
+        for _, (record_key, capabilities) in self._probe(key):
+            if record_key == 0:
+                return None
+            if record_key == key:
+                return capabilities
+        return None
+
+    def update(self, authority, **kwargs):
+        """records the given HostCapabilities fields for "scheme://host:port\""""
+        key = _get_key(authority)
+        with self._lock:
+            self._flock(_LOCK_EX)
+            try:
+                target = None
+                oldest = None
+                current = None
+                for offset, (record_key, capabilities) in self._probe(key):
+                    if record_key == key:
+                        target, current = offset, capabilities
+                        break
+                    if record_key == 0 or capabilities is None:
+                        target = offset
+                        break
+                    if oldest is None or capabilities.updated < oldest[1].updated:
+                        oldest = offset, capabilities
+                if target is None:
+                    target = oldest[0]
+
+                if current is None:
+                    current = HostCapabilities(None, False, None, 0.0)
+                capabilities = current._replace(updated=time.time(), **kwargs)
+                self._mmap[target:target + _RECORD.size] = _pack(key, capabilities)
+            finally:
+                self._flock(_LOCK_UN)
+        return capabilities
+
+    def clear(self):
+        with self._lock:
+            self._flock(_LOCK_EX)
+            try:
+                self._mmap[_HEADER.size:] = b"\x00" * (self.slots * _RECORD.size)
+            finally:
+                self._flock(_LOCK_UN)
+
+    @property
+    def closed(self):
+        return self._mmap is None
+
+    def close(self):
+        with self._lock:
+            if self._mmap is not None:
+                self._mmap.close()
+                self._mmap = None
+                os.close(self._fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def get_host_cache(host_cache):
+    """
+    accepts either a HostCapabilityCache or the path of its file; all the
+    callers that give the same path share one (open) HostCapabilityCache
+    """
+    if host_cache is None or isinstance(host_cache, HostCapabilityCache):
+        return host_cache
+    path = os.path.abspath(host_cache)
+    with _host_caches_lock:
+        cache = _host_caches.get(path)
+        if cache is None or cache.closed:
+            cache = _host_caches[path] = HostCapabilityCache(path)
+        return cache
@@ -0,0 +1,200 @@
+import logging
+import socket
+import threading
+
+from requests.packages.urllib3.util.wait import wait_for_read
+
+from .cache import LRUCache
+from .core import get_url_authority
+
+
+logger = logging.getLogger(__name__)
+
+KEEP_ALIVE_CACHE_SIZE = 1024
+# what is learnt about a host is forgotten after that many seconds, in case it changes
+KEEP_ALIVE_CACHE_TTL = 3600
+# connections are retired that many seconds before the host would close them
+RETIREMENT_MARGIN = 1.0
+# connections closed sooner than that were not closed for being idle
+MIN_IDLE_CLOSE = 1.0
+# how many connections a host has to close after being idle for less than
+# what was known before it is taken as its idle timeout (rather than eg a restart)
+IDLE_CLOSE_OBSERVATIONS = 2
+# the idle timeouts learnt from the closed connections are forgotten after that many
+# seconds, as connections are retired before they could show that it went up
+IDLE_CLOSE_TTL = 600
+
+
+def parse_keep_alive_timeout(value):
+    """the `timeout` parameter of a Keep-Alive header (eg "timeout=5, max=100"), if any"""
+    for parameter in (value or "").split(","):
+        name, _, timeout = parameter.partition("=")
+        if name.strip().lower() != "timeout":
+            continue
+        try:
+            timeout = float(timeout.strip().strip('"'))
+        except ValueError:
+            return None
+        return timeout if timeout >= 0 else None
+    return None
+
+
+def is_socket_alive(sock):
+    """
+    Cheap check that an idle connection has not been closed by the other end:
+    an idle connection has nothing to read. Anything else (the end of the
+    stream, or bytes nobody asked for) means it cannot be reused.
+    """
+    if sock is None:
+        return False
+    try:
+        pending = getattr(sock, "pending", None)
+        if pending is not None and pending():
+            # TLS data that was received but not read
+            return False
+        # python waits for up to the timeout of the socket even with
+        # MSG_DONTWAIT, so it is only peeked at once there is something to read
+        if not wait_for_read(sock, timeout=0.0):
+            return True
+        if isinstance(sock, socket.socket):
+            # peeks at the TCP stream itself, which works for TLS connections too
+            data = socket.socket.recv(sock, 1, socket.MSG_PEEK)
+            logger.debug("idle connection %s", "sent unexpected data" if data else "was closed")
+    except (socket.error, ValueError, TypeError):
+        pass
+    return False
+
+
+class KeepAliveTracker(object):
+    """
+    Learns how long each host (ie "scheme://host:port" of a server or of a
+    proxy) keeps idle connections open, from the timeout it advertises in its
+    Keep-Alive headers and from how long the connections it closed had been
+    idle. Connections can then be retired shortly before the host would close
+    them, instead of failing on their next request and going through the NTLM
+    dance again on a new connection.
+
+    With a `requests_ntlm2.hostcache.HostCapabilityCache` as `host_cache`, the
+    advertised timeouts are written to it, and read back from it for the hosts
+    that have not advertised one to this process yet, so that they survive
+    restarts and are shared with the other processes using the same file.
+
+    A single early close (eg a reset, or a restart of the server) is not
+    mistaken for the idle timeout: it takes `idle_close_observations` closes
+    to lower it. What was learnt from the closes goes back up once a
+    connection that was idle for longer is reused, and is forgotten after
+    `idle_close_ttl` seconds.
+    """
+
+    def __init__(
+        self,
+        margin=RETIREMENT_MARGIN,
+        min_idle_close=MIN_IDLE_CLOSE,
+        maxsize=KEEP_ALIVE_CACHE_SIZE,
+        ttl=KEEP_ALIVE_CACHE_TTL,
+        idle_close_observations=IDLE_CLOSE_OBSERVATIONS,
+        idle_close_ttl=IDLE_CLOSE_TTL,
+        host_cache=None
+    ):
+        if idle_close_observations < 1:
+            raise ValueError("idle_close_observations must be at least 1, got {}".format(idle_close_observations))
+        self.margin = margin
+        self.min_idle_close = min_idle_close
+        self.idle_close_observations = idle_close_observations
+        self.host_cache = host_cache
+        self._lock = threading.Lock()
+        self._advertised = LRUCache(maxsize=maxsize, ttl=ttl)
+        # the authorities that were looked up in the host cache
+        self._loaded = LRUCache(maxsize=maxsize, ttl=ttl)
+        self._closed_after = LRUCache(maxsize=maxsize, ttl=idle_close_ttl)
+        # idle times of the closes that are not trusted yet
+        self._idle_closes = LRUCache(maxsize=maxsize, ttl=idle_close_ttl)
+
+    def observe_headers(self, authority, headers):
+        """remembers the idle timeout advertised in the Keep-Alive header of a response"""
+        timeout = parse_keep_alive_timeout(headers.get("keep-alive"))
+        authority = get_url_authority(authority)
+        if timeout is not None and self._get_advertised(authority) != timeout:
+            logger.debug("%s keeps idle connections open for %ss", authority, timeout)
+            self._advertised.set(authority, timeout)
+            if self.host_cache is not None:
+                self.host_cache.update(authority, keep_alive_timeout=timeout)
+        return timeout
+
+    def _get_advertised(self, authority):
+        timeout = self._advertised.get(authority)
+        if timeout is not None or self.host_cache is None or self._loaded.get(authority):
+            return timeout
+        self._loaded.set(authority, True)
+        capabilities = self.host_cache.get(authority)
+        if capabilities is not None and capabilities.keep_alive_timeout is not None:
+            timeout = capabilities.keep_alive_timeout
+            self._advertised.set(authority, timeout)
+        return timeout
+
+    def observe_idle_close(self, authority, idle):
+        """remembers that a connection to `authority` was closed after being idle for `idle` seconds"""
+        if idle < self.min_idle_close:
+            return
+        authority = get_url_authority(authority)
+        with self._lock:
+            closed_after = self._closed_after.get(authority)
+            if closed_after is not None and idle >= closed_after:
+                return
+            idle_closes = self._idle_closes.get(authority, ()) + (idle,)
+            if len(idle_closes) < self.idle_close_observations:
+                self._idle_closes.set(authority, idle_closes)
+                return
+            self._idle_closes.pop(authority)
+            # the longest of them, so as not to retire connections too early
+            closed_after = max(idle_closes)
+            logger.debug("%s closes connections that were idle for %.1fs", authority, closed_after)
+            self._closed_after.set(authority, closed_after)
+
+    def observe_idle_reuse(self, authority, idle):
+        """remembers that a connection to `authority` was still open after being idle for `idle` seconds"""
+        authority = get_url_authority(authority)
+        with self._lock:
+            closed_after = self._closed_after.get(authority)
+            if closed_after is not None and idle >= closed_after:
+                logger.debug("%s kept a connection open for %.1fs idle", authority, idle)
+                self._closed_after.pop(authority)
+            idle_closes = self._idle_closes.get(authority)
+            if idle_closes:
+                idle_closes = tuple(idle_close for idle_close in idle_closes if idle_close > idle)
+                if idle_closes:
+                    self._idle_closes.set(authority, idle_closes)
+                else:
+                    self._idle_closes.pop(authority)
+
+    def get_idle_timeout(self, authority):
+        """how long `authority` is expected to keep an idle connection open, if known"""
+        authority = get_url_authority(authority)
+        timeouts = [
+            timeout for timeout in (self._get_advertised(authority), self._closed_after.get(authority))
+            if timeout is not None
+        ]
+        return min(timeouts) if timeouts else None
+
+    def is_expiring(self, idle, *authorities):
+        """whether a connection idle for `idle` seconds is about to be closed by any of `authorities`"""
+        for authority in authorities:
+            timeout = self.get_idle_timeout(authority)
+            if timeout is not None and idle >= max(timeout - self.margin, timeout / 2.0):
+                return True
+        return False
+
+
+default_keep_alive_tracker = KeepAliveTracker()
+
+
+def get_keep_alive_tracker(keep_alive_tracker, host_cache=None):
+    """
+    Defaults to the tracker shared by the whole process, or to one of its own
+    when there is a `host_cache` to remember the timeouts in.
+    """
+    if keep_alive_tracker is not None:
+        return keep_alive_tracker
+    if host_cache is not None:
+        return KeepAliveTracker(host_cache=host_cache)
+    return default_keep_alive_tracker
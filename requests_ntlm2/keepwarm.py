@@ -0,0 +1,295 @@
+import collections
+import logging
+import socket
+import threading
+import weakref
+
+from six.moves.http_client import PROXY_AUTHENTICATION_REQUIRED, UNAUTHORIZED, HTTPException
+
+from . import clock
+from .cache import LRUCache
+from .core import response_will_close
+from .pool import AUTHENTICATED, get_warmth
+
+
+logger = logging.getLogger(__name__)
+
+# connections idle for that long are pinged, or sooner if their host closes them sooner
+KEEP_WARM_INTERVAL = 30.0
+# connections are no longer kept warm once they have gone that long without a request of their own
+KEEP_WARM_MAX_IDLE = 600.0
+KEEP_WARM_MAX_PER_HOST = 10
+KEEP_WARM_MAX_TOTAL = 100
+# how many hosts the budgets of `max_per_host` are kept for
+KEEP_WARM_MAX_HOSTS = 1024
+KEEP_WARM_PERIOD = 60.0
+KEEP_WARM_TIMEOUT = 5.0
+KEEP_WARM_TICK = 1.0
+# past that many bytes, the body of a ping response is not read and its connection is closed
+KEEP_WARM_MAX_BODY = 64 * 1024
+
+
+class _RateBudget(object):
+    """allows up to `limit` events in any `period` seconds"""
+
+    def __init__(self, limit, period, timer):
+        self.limit = limit
+        self.period = period
+        self._timer = timer
+        self._events = collections.deque()
+
+    def _expire(self, now):
+        while self._events and now - self._events[0] >= self.period:
+            self._events.popleft()
+
+    def has_room(self):
+        if self.limit is None:
+            return True
+        self._expire(self._timer())
+        return len(self._events) < self.limit
+
+    def spend(self):
+        self._events.append(self._timer())
+
+
+class KeepWarmScheduler(object):
+    """
+    Pings the idle connections of the pools of `HttpNtlmAdapter` from a
+    background thread with a lightweight request (eg HEAD or OPTIONS) before
+    the server closes them, so that bursty traffic does not have to go
+    through the NTLM dance again after every quiet spell. Only the connections
+    that are authenticated with the server, or that have a tunnel through the
+    proxy, are kept warm.
+
+    Each host gets at most `max_per_host` pings, and all of them together at
+    most `max_total` pings, in any `period` seconds. A connection is no longer
+    kept warm once it has gone `max_idle` seconds without serving a request of
+    its own.
+    """
+
+    def __init__(
+        self,
+        method="HEAD",
+        path="/",
+        headers=None,
+        interval=KEEP_WARM_INTERVAL,
+        max_idle=KEEP_WARM_MAX_IDLE,
+        max_per_host=KEEP_WARM_MAX_PER_HOST,
+        max_total=KEEP_WARM_MAX_TOTAL,
+        period=KEEP_WARM_PERIOD,
+        timeout=KEEP_WARM_TIMEOUT,
+        tick=KEEP_WARM_TICK,
+        timer=clock.now
+    ):
+        """
+        :param str method: Method of the pings
+        :param str path: Path the pings are sent to
+        :param dict headers: Extra headers of the pings
+        :param float interval: Connections idle for that many seconds are pinged, or sooner
+                               if the server (or the proxy) is known to close them sooner
+        :param float max_idle: Connections that have not served a request for that many
+                               seconds are left to expire (None to keep them warm forever)
+        :param int max_per_host: Pings per host in any `period` seconds (None for no limit)
+        :param int max_total: Pings in total in any `period` seconds (None for no limit)
+        :param float period: Length in seconds of the window of `max_per_host` and `max_total`
+        :param float timeout: How long a ping may take before its connection is closed
+        :param float tick: How often the idle connections are looked at
+        """
+        for name, value in (("max_per_host", max_per_host), ("max_total", max_total)):
+            if value is not None and value < 1:
+                raise ValueError("{} must be at least 1, got {}".format(name, value))
+        self.method = method.upper()
+        self.path = path
+        self.headers = dict(headers or {})
+        self.interval = interval
+        self.max_idle = max_idle
+        self.max_per_host = max_per_host
+        self.period = period
+        self.timeout = timeout
+        self.tick = tick
+        self._timer = timer
+        self._lock = threading.Lock()
+        self._pools = weakref.WeakSet()
+        # conn -> (when it last served a request of its own, when it was last pinged)
+        self._unused_since = weakref.WeakKeyDictionary()
+        self._host_budgets = LRUCache(maxsize=KEEP_WARM_MAX_HOSTS)
+        self._total_budget = _RateBudget(max_total, period, timer)
+        self._thread = None
+        self._stopped = threading.Event()
+        self.pings = 0
+        self.failed_pings = 0
+        self.skipped_pings = 0
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                "pings": self.pings,
+                "failed_pings": self.failed_pings,
+                "skipped_pings": self.skipped_pings,
+            }
+
+    def __repr__(self):
+        return "{}({})".format(
+            self.__class__.__name__,
+            ", ".join("{}={}".format(k, v) for k, v in sorted(self.as_dict().items()))
+        )
+
+    def add_pool(self, pool):
+        """keeps the connections of `pool` warm, starting the background thread if needed"""
+        with self._lock:
+            self._pools.add(pool)
+            if self._thread is None:
+                self._stopped.clear()
+                self._thread = threading.Thread(target=self._run, name="requests-ntlm2-keep-warm")
+                self._thread.daemon = True
+                self._thread.start()
+
+    def remove_pools(self, *pool_classes):
+        """stops keeping warm the connections of the pools that are instances of `pool_classes`"""
+        with self._lock:
+            for pool in [pool for pool in self._pools if isinstance(pool, pool_classes)]:
+                self._pools.discard(pool)
+
+    def stop(self):
+        """stops the background thread and forgets the pools"""
+        with self._lock:
+            thread, self._thread = self._thread, None
+            self._pools.clear()
+            self._stopped.set()
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(self.tick):
+            try:
+                self.ping_idle_connections()
+            except Exception:
+                logger.exception("failed to keep the idle connections warm")
+
+    def ping_idle_connections(self):
+        """pings the idle connections that are due for it; returns how many were pinged"""
+        with self._lock:
+            pools = list(self._pools)
+        pinged = 0
+        for pool in pools:
+            if pool.pool is None:
+                # the pool is closed
+                with self._lock:
+                    self._pools.discard(pool)
+                continue
+            pinged += self._ping_pool(pool)
+        return pinged
+
+    def _get_ping_after(self, pool):
+        tracker = pool.keep_alive_tracker
+        if tracker is None:
+            return self.interval
+        timeouts = [tracker.get_idle_timeout(authority) for authority in pool._get_authorities()]
+        timeouts = [timeout for timeout in timeouts if timeout is not None]
+        if not timeouts:
+            return self.interval
+        # well before the pool would retire them
+        return min([self.interval, min(timeouts) / 3.0])
+
+    def _is_due(self, conn, idle_since, ping_after, now):
+        if now - idle_since < ping_after:
+            return False
+        unused_since, pinged_at = self._unused_since.get(conn, (None, None))
+        if pinged_at != idle_since:
+            # it has served a request since it was last pinged (if ever)
+            unused_since = idle_since
+            self._unused_since[conn] = (unused_since, None)
+        return self.max_idle is None or now - unused_since < self.max_idle
+
+    def _get_host_budget(self, authority):
+        budget = self._host_budgets.get(authority)
+        if budget is None:
+            budget = _RateBudget(self.max_per_host, self.period, self._timer)
+            self._host_budgets.set(authority, budget)
+        return budget
+
+    def _ping_pool(self, pool):
+        now = self._timer()
+        ping_after = self._get_ping_after(pool)
+        due = [
+            (idle_since, conn) for conn, idle_since in pool._get_idle_conns()
+            if is_worth_keeping_warm(conn) and self._is_due(conn, idle_since, ping_after, now)
+        ]
+        authority = pool._get_peer_authority()
+        budget = self._get_host_budget(authority)
+        pinged = 0
+        # the connections closest to being closed go first
+        for _, conn in sorted(due, key=lambda item: item[0]):
+            if not (budget.has_room() and self._total_budget.has_room()):
+                with self._lock:
+                    self.skipped_pings += 1
+                continue
+            if not pool._take_conn(conn):
+                # handed out in the meantime
+                continue
+            budget.spend()
+            self._total_budget.spend()
+            pinged += 1
+            self._ping(pool, conn)
+        return pinged
+
+    def _get_ping_url(self, pool):
+        if pool.proxy is not None and pool.scheme == "http":
+            # sent to the proxy, which needs to know where it goes
+            return "{}://{}:{}{}".format(pool.scheme, pool.host, pool.port, self.path)
+        return self.path
+
+    def _ping(self, pool, conn):
+        unused_since = self._unused_since.get(conn, (None, None))[0]
+        headers = dict(self.headers)
+        if pool.proxy is not None and pool.scheme == "http":
+            headers.update(pool.proxy_headers)
+        try:
+            # urllib3 sets the timeout of the socket from it on each request
+            conn.timeout = self.timeout
+            conn.sock.settimeout(self.timeout)
+            conn.request(self.method, self._get_ping_url(pool), headers=headers)
+            response = conn.getresponse()
+            response.read(KEEP_WARM_MAX_BODY)
+            reusable = response.isclosed() and not response_will_close(response) and response.status not in (
+                UNAUTHORIZED, PROXY_AUTHENTICATION_REQUIRED
+            )
+        except (socket.error, HTTPException) as e:
+            logger.debug("failed to ping idle connection to %s: %s", pool.host, e)
+            reusable, response = False, None
+
+        if response is not None and pool.keep_alive_tracker is not None:
+            pool.keep_alive_tracker.observe_headers(pool._get_peer_authority(), response.headers)
+        with self._lock:
+            self.pings += 1
+            if not reusable:
+                self.failed_pings += 1
+        if not reusable:
+            logger.debug("closing idle connection to %s that could not be kept warm", pool.host)
+            conn.close()
+            # an empty slot is put back for a closed connection, like urllib3 does
+            pool._put_conn(None)
+            return
+
+        pool._put_conn(conn)
+        idle_since = pool._idle_since.get(conn)
+        if idle_since is not None:
+            self._unused_since[conn] = (unused_since, idle_since)
+
+
+def is_worth_keeping_warm(conn):
+    """whether `conn` is authenticated with the server, or has a tunnel through the proxy"""
+    if getattr(conn, "sock", None) is None:
+        return False
+    return get_warmth(conn) == AUTHENTICATED or bool(getattr(conn, "_tunnel_host", None))
+
+
+def get_keep_warm_scheduler(keep_warm):
+    """accepts either a KeepWarmScheduler, or True for a KeepWarmScheduler with the default settings"""
+    if keep_warm is None or keep_warm is False:
+        return None
+    if isinstance(keep_warm, KeepWarmScheduler):
+        return keep_warm
+    if keep_warm is True:
+        return KeepWarmScheduler()
+    raise TypeError("expected a KeepWarmScheduler, got {!r}".format(keep_warm))
@@ -0,0 +1,166 @@
+import collections
+import contextlib
+import logging
+import socket
+import threading
+
+from . import clock
+
+
+logger = logging.getLogger(__name__)
+
+
+class HandshakeTimeout(socket.timeout):
+    """raised when a handshake waited too long for its turn"""
+
+
+class HandshakeLimiter(object):
+    """
+    Limits how many NTLM handshakes can be in flight at once, per host (ie
+    per "scheme://host:port" of the server, or "host:port" of the proxy) and
+    in total. Every handshake ends up as a request to the domain controller,
+    so a burst of them (eg after the connection pools were flushed) can get
+    all of them throttled; past the limits, handshakes wait for their turn.
+
+    Share a single instance between the auth objects and adapters to apply
+    the limits to the whole process. A thread that already holds a slot (eg
+    a server handshake that has to open a new tunnel through the proxy) takes
+    nested slots without counting against `max_total`, so that it cannot end
+    up waiting for itself.
+    """
+
+    def __init__(self, max_per_host=None, max_total=None, timeout=None, timer=clock.now):
+        """
+        :param int max_per_host: Handshakes in flight with a single host (None for no limit)
+        :param int max_total: Handshakes in flight in total (None for no limit)
+        :param float timeout: How long a handshake may wait for its turn before
+                              `HandshakeTimeout` is raised (None to wait for as long as it takes)
+        """
+        for name, value in (("max_per_host", max_per_host), ("max_total", max_total)):
+            if value is not None and value < 1:
+                raise ValueError("{} must be at least 1, got {}".format(name, value))
+        self.max_per_host = max_per_host
+        self.max_total = max_total
+        self.timeout = timeout
+        self._timer = timer
+        self._condition = threading.Condition(threading.Lock())
+        self._in_flight = collections.Counter()
+        self._queued = collections.Counter()
+        # handshakes counting against max_total, ie not nested in another one
+        self._outer_in_flight = 0
+        # per thread, whether each slot it holds is nested in another one
+        self._local = threading.local()
+        self.in_flight = 0
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.timeouts = 0
+
+    def queue_depth_for(self, authority):
+        """number of handshakes with `authority` waiting for their turn"""
+        with self._condition:
+            return self._queued[authority]
+
+    def as_dict(self):
+        with self._condition:
+            return {
+                "in_flight": self.in_flight,
+                "queue_depth": self.queue_depth,
+                "max_queue_depth": self.max_queue_depth,
+                "waits": self.waits,
+                "wait_time": self.wait_time,
+                "max_wait_time": self.max_wait_time,
+                "timeouts": self.timeouts,
+            }
+
+    def __repr__(self):
+        return "{}({})".format(
+            self.__class__.__name__,
+            ", ".join("{}={}".format(k, v) for k, v in sorted(self.as_dict().items()))
+        )
+
+    def _get_held_slots(self):
+        held = getattr(self._local, "held", None)
+        if held is None:
+            held = self._local.held = []
+        return held
+
+    def _can_start(self, authority, nested):
+        if not nested and self.max_total is not None and self._outer_in_flight >= self.max_total:
+            return False
+        return self.max_per_host is None or self._in_flight[authority] < self.max_per_host
+
+    def _start(self, authority, nested):
+        self._in_flight[authority] += 1
+        self.in_flight += 1
+        if not nested:
+            self._outer_in_flight += 1
+        self._get_held_slots().append(nested)
+
+    def _wait(self, authority, nested):
+        start = self._timer()
+        while not self._can_start(authority, nested):
+            remaining = None
+            if self.timeout is not None:
+                remaining = self.timeout - (self._timer() - start)
+                if remaining <= 0:
+                    self.timeouts += 1
+                    raise HandshakeTimeout(
+                        "gave up waiting for an NTLM handshake with {} after {}s".format(authority, self.timeout)
+                    )
+            self._condition.wait(remaining)
+        return self._timer() - start
+
+    def acquire(self, authority):
+        """
+        Blocks until a handshake with `authority` can start, and returns
+        whether it had to wait for that. Each call must be followed by a call
+        to `release` once the handshake is over.
+        """
+        nested = bool(self._get_held_slots())
+        with self._condition:
+            if self._can_start(authority, nested):
+                self._start(authority, nested)
+                return False
+
+            self._queued[authority] += 1
+            self.queue_depth += 1
+            self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+            try:
+                waited = self._wait(authority, nested)
+            finally:
+                self._queued[authority] -= 1
+                if not self._queued[authority]:
+                    del self._queued[authority]
+                self.queue_depth -= 1
+
+            self.waits += 1
+            self.wait_time += waited
+            self.max_wait_time = max(self.max_wait_time, waited)
+            self._start(authority, nested)
+        logger.debug("waited %.3fs for an NTLM handshake with %s", waited, authority)
+        return True
+
+    def release(self, authority):
+        """must be called by the thread that called `acquire`"""
+        held = self._get_held_slots()
+        nested = held.pop() if held else False
+        with self._condition:
+            self._in_flight[authority] -= 1
+            if not self._in_flight[authority]:
+                del self._in_flight[authority]
+            self.in_flight -= 1
+            if not nested:
+                self._outer_in_flight -= 1
+            self._condition.notify_all()
+
+    @contextlib.contextmanager
+    def slot(self, authority):
+        """context manager around `acquire` and `release`; gives whether it had to wait"""
+        waited = self.acquire(authority)
+        try:
+            yield waited
+        finally:
+            self.release(authority)
@@ -0,0 +1,193 @@
+import logging
+import weakref
+
+from requests.packages.urllib3.connectionpool import HTTPConnectionPool as _HTTPConnectionPool
+from requests.packages.urllib3.connectionpool import HTTPSConnectionPool as _HTTPSConnectionPool
+from requests.packages.urllib3.exceptions import ClosedPoolError, EmptyPoolError
+from six.moves import queue
+from six.moves.queue import LifoQueue
+
+from . import clock
+from .core import get_authority
+from .keepalive import default_keep_alive_tracker, is_socket_alive
+from .state import is_authenticated_socket
+
+
+logger = logging.getLogger(__name__)
+
+# how warm a pooled connection is: the warmest ones are handed out first
+COLD = 0  # not connected (or an empty slot of the pool)
+CONNECTED = 1  # connected, eg with its tunnel through the proxy already open
+AUTHENTICATED = 2  # authenticated with the server by HttpNtlmAuth
+
+
+def get_warmth(conn):
+    sock = getattr(conn, "sock", None)
+    if sock is None:
+        return COLD
+    if is_authenticated_socket(sock):
+        return AUTHENTICATED
+    return CONNECTED
+
+
+class AffinityQueue(LifoQueue):
+    """
+    Queue of the connections of a pool that hands out the authenticated
+    connections first, then the connected ones, and the most recently used
+    one among those that are as warm.
+    """
+
+    def _find(self, key):
+        return max(range(len(self.queue)), key=lambda i: key(get_warmth(self.queue[i]), i))
+
+    def _get(self):
+        index = self._find(lambda warmth, i: (warmth, i))
+        item = self.queue[index]
+        del self.queue[index]
+        return item
+
+    def replace_coldest(self, item):
+        """
+        Puts `item` in the place of the least used of the coldest items if
+        `item` is warmer than it. Returns the item that did not make it in.
+        """
+        with self.mutex:
+            if not self.queue:
+                return item
+            index = self._find(lambda warmth, i: (-warmth, -i))
+            if get_warmth(self.queue[index]) >= get_warmth(item):
+                return item
+            evicted = self.queue[index]
+            del self.queue[index]
+            self._put(item)
+            self.not_empty.notify()
+            return evicted
+
+    def remove(self, item):
+        """takes `item` out of the queue, as `get` would; returns whether it was there"""
+        with self.mutex:
+            for index, queued in enumerate(self.queue):
+                if queued is item:
+                    del self.queue[index]
+                    self.not_full.notify()
+                    return True
+            return False
+
+
+class AffinityPoolMixin(object):
+    """
+    Makes urllib3's connection pools prefer the connections that are already
+    authenticated: they are handed out first, and when the pool is full the
+    cold connections are closed before the warm ones.
+
+    Idle connections that the server (or the proxy) has closed, or is about
+    to close going by what `keep_alive_tracker` learnt about it, are retired
+    before they are handed out, rather than failing the next request.
+    """
+
+    QueueCls = AffinityQueue
+    keep_alive_tracker = default_keep_alive_tracker
+    # a `requests_ntlm2.keepwarm.KeepWarmScheduler` that pings the idle connections
+    keep_warm = None
+
+    def __init__(self, *args, **kwargs):
+        super(AffinityPoolMixin, self).__init__(*args, **kwargs)
+        self._idle_since = weakref.WeakKeyDictionary()
+        if self.keep_warm is not None:
+            self.keep_warm.add_pool(self)
+
+    def _get_authorities(self):
+        """the server and proxy whose idle timeouts apply to the connections of this pool"""
+        authorities = [get_authority(self.scheme, self.host, self.port)]
+        if self.proxy is not None:
+            authorities.append(get_authority(self.proxy.scheme, self.proxy.host, self.proxy.port))
+        return authorities
+
+    def _get_peer_authority(self):
+        """the other end of the connections of this pool: the proxy, unless they are tunnelled"""
+        if self.proxy is not None and self.scheme == "http":
+            return get_authority(self.proxy.scheme, self.proxy.host, self.proxy.port)
+        return get_authority(self.scheme, self.host, self.port)
+
+    def _is_reusable(self, conn):
+        idle_since = self._idle_since.pop(conn, None)
+        tracker = self.keep_alive_tracker
+        if conn.sock is None:
+            return False
+
+        idle = None if idle_since is None else clock.now() - idle_since
+        if not is_socket_alive(conn.sock):
+            if idle is not None and tracker is not None:
+                logger.debug("connection to %s was closed after %.1fs idle", self.host, idle)
+                tracker.observe_idle_close(self._get_peer_authority(), idle)
+            return False
+        if idle is None or tracker is None:
+            return True
+        if tracker.is_expiring(idle, *self._get_authorities()):
+            logger.debug("retiring connection to %s after %.1fs idle, before it gets closed", self.host, idle)
+            return False
+        tracker.observe_idle_reuse(self._get_peer_authority(), idle)
+        return True
+
+    def _get_conn(self, timeout=None):
+        """same as urllib3's, but checks (and learns from) the idle connections in its own way"""
+        conn = None
+        try:
+            conn = self.pool.get(block=self.block, timeout=timeout)
+        except AttributeError:  # self.pool is None
+            raise ClosedPoolError(self, "Pool is closed.")
+        except queue.Empty:
+            if self.block:
+                raise EmptyPoolError(self, "Pool reached maximum size and no more connections are allowed.")
+
+        if conn and not self._is_reusable(conn):
+            getattr(conn, "retire", conn.close)()
+            if getattr(conn, "auto_open", 1) == 0:
+                # a connection that had a tunnel cannot be opened again
+                # without going through the proxy
+                conn = None
+        return conn or self._new_conn()
+
+    def _get_idle_conns(self):
+        """the connections waiting in the pool, with when they were put back"""
+        queue_ = self.pool
+        if queue_ is None:
+            return []
+        with queue_.mutex:
+            conns = [conn for conn in queue_.queue if conn is not None]
+        idle_conns = []
+        for conn in conns:
+            # handed out (and forgotten) since the queue was looked at
+            idle_since = self._idle_since.get(conn)
+            if idle_since is not None:
+                idle_conns.append((conn, idle_since))
+        return idle_conns
+
+    def _take_conn(self, conn):
+        """takes `conn` out of the pool unless it was handed out in the meantime"""
+        queue_ = self.pool
+        return queue_ is not None and queue_.remove(conn)
+
+    def _put_conn(self, conn):
+        if conn is not None and conn.sock is not None:
+            self._idle_since[conn] = clock.now()
+        try:
+            self.pool.put(conn, block=False)
+            return
+        except AttributeError:
+            # the pool is closed
+            pass
+        except queue.Full:
+            conn = self.pool.replace_coldest(conn)
+            if conn:
+                logger.debug("connection pool of %s is full, discarding its coldest connection", self.host)
+        if conn:
+            conn.close()
+
+
+class HTTPConnectionPool(AffinityPoolMixin, _HTTPConnectionPool):
+    pass
+
+
+class HTTPSConnectionPool(AffinityPoolMixin, _HTTPSConnectionPool):
+    pass
@@ -1,9 +1,41 @@
+import functools
 import io
+import logging
 
 from requests.auth import AuthBase
+from requests.exceptions import RequestException
 
-from .core import NtlmCompatibility, get_auth_type_from_header, get_cbt_data, get_ntlm_credentials
+from .body import DEFAULT_SPOOL_THRESHOLD, ReplayableBody, is_streaming_body
+from .cache import LRUCache
+from .core import (
+    DRAIN_MAX_BYTES,
+    DRAIN_TIMEOUT,
+    NtlmCompatibility,
+    drain_response,
+    get_auth_type_from_header,
+    get_cbt_data,
+    get_ntlm_credentials,
+    get_request_stub,
+    get_response_socket,
+    get_response_stub,
+    get_url_authority
+)
 from .dance import HttpNtlmContext
+from .hostcache import get_host_cache
+from .keepalive import get_keep_alive_tracker, is_socket_alive
+from .pool import AffinityQueue
+from .state import ConnectionStateRegistry
+
+
+logger = logging.getLogger(__name__)
+
+AUTH_SCHEME_CACHE_SIZE = 256
+AUTH_SCHEME_CACHE_TTL = 3600
+BODYLESS_HANDSHAKE_THRESHOLD = 64 * 1024
+
+
+class ChallengeBodyTooLarge(RequestException):
+    """The body of a challenge response could not be drained within the limits of HttpNtlmAuth"""
 
 
 class HttpNtlmAuth(AuthBase):
@@ -16,7 +48,18 @@ class HttpNtlmAuth(AuthBase):
         password,
         send_cbt=True,
         ntlm_compatibility=NtlmCompatibility.NTLMv2_DEFAULT,
-        ntlm_strict_mode=False
+        ntlm_strict_mode=False,
+        preemptive=False,
+        auth_scheme_cache=None,
+        host_cache=None,
+        body_spool_threshold=DEFAULT_SPOOL_THRESHOLD,
+        bodyless_handshake_methods=None,
+        bodyless_handshake_threshold=BODYLESS_HANDSHAKE_THRESHOLD,
+        drain_max_bytes=DRAIN_MAX_BYTES,
+        drain_timeout=DRAIN_TIMEOUT,
+        lightweight_history=False,
+        handshake_limiter=None,
+        keep_alive_tracker=None
     ):
         """Create an authentication handler for NTLM over HTTP.
 
@@ -27,6 +70,47 @@ class HttpNtlmAuth(AuthBase):
         :param ntlm_compatibility: The Lan Manager Compatibility Level to use with the auth message
         :param ntlm_strict_mode: If False, tries to Type 2 (ie challenge response) NTLM message
                                 that does not conform to the NTLM spec
+        :param bool preemptive: If True, requests to servers that are known to use
+                                NTLM or Negotiate carry the Type 1 (negotiate) message
+                                straight away instead of waiting for a 401 (Default: False)
+        :param auth_scheme_cache: A `requests_ntlm2.cache.LRUCache` mapping "scheme://host:port"
+                                  to the auth type it advertised. Used when `preemptive` is True
+        :param host_cache: A `requests_ntlm2.hostcache.HostCapabilityCache` (or the path of its
+                           file) used to persist what was learnt about each server across
+                           processes and restarts
+        :param int body_spool_threshold: Streaming (non-seekable) request bodies are kept
+                                         in memory up to this many bytes so that they can be
+                                         resent during the NTLM dance, and spilled to a
+                                         temporary file after that
+        :param bodyless_handshake_methods: HTTP methods (eg `("POST", "PUT")`) whose large
+                                           request bodies are only sent once the connection
+                                           is authenticated. The negotiate leg of the NTLM
+                                           dance is sent with an empty body instead
+        :param int bodyless_handshake_threshold: Request bodies smaller than this many bytes
+                                                 are sent on every leg as usual. Bodies of
+                                                 unknown size are always treated as large
+        :param int drain_max_bytes: The bodies of the 401 responses received during the NTLM
+                                    dance are read and thrown away. Past this many bytes the
+                                    connection is closed instead (None for no limit). If
+                                    that was the challenge, the dance starts over once on a
+                                    new connection, and `ChallengeBodyTooLarge` is raised
+                                    if that challenge cannot be drained either
+        :param float drain_timeout: Same as `drain_max_bytes`, but in seconds
+        :param bool lightweight_history: If True, the legs of the NTLM dance are sent by updating
+                                         the headers of a single prepared request instead of
+                                         copying it for each leg, and the history of the final
+                                         response only holds stubs of the 401 responses, which
+                                         keep their status, headers and a copy of their request
+                                         that shares its body with the final one (Default: False)
+        :param handshake_limiter: A `requests_ntlm2.limiter.HandshakeLimiter` limiting how many
+                                  NTLM dances can be in flight at once. A request with a small
+                                  body that had to wait for its turn is first resent when the
+                                  pool of `HttpNtlmAdapter` holds an idle connection that another
+                                  thread has just authenticated
+        :param keep_alive_tracker: A `requests_ntlm2.keepalive.KeepAliveTracker` that learns from the
+                                   Keep-Alive headers of the NTLM dance how long each server keeps
+                                   idle connections open. Defaults to one shared by the whole process,
+                                   or to one that persists the timeouts in `host_cache` when given
         """
 
         self.username, self.password, self.domain = get_ntlm_credentials(username, password)
@@ -41,11 +125,228 @@ class HttpNtlmAuth(AuthBase):
         # This exposes the encrypt/decrypt methods used to encrypt and decrypt
         # messages sent after ntlm authentication. These methods are utilised
         # by libraries that call requests_ntlm to encrypt and decrypt the
-        # messages sent after authentication
+        # messages sent after authentication. This is the one from the latest
+        # NTLM dance; use `get_session_security` when the auth object is shared
+        # by several threads, as each connection has its own
         self.session_security = None
 
+        # NTLM authenticates connections, not requests. This keeps track of the
+        # pooled connections that have already been through the NTLM dance
+        self.connection_state = ConnectionStateRegistry()
+
+        self.preemptive = preemptive
+        if auth_scheme_cache is None:
+            auth_scheme_cache = LRUCache(
+                maxsize=AUTH_SCHEME_CACHE_SIZE, ttl=AUTH_SCHEME_CACHE_TTL
+            )
+        self.auth_scheme_cache = auth_scheme_cache
+        self.host_cache = get_host_cache(host_cache)
+        self.body_spool_threshold = body_spool_threshold
+        self.bodyless_handshake_methods = frozenset(
+            method.upper() for method in bodyless_handshake_methods or ()
+        )
+        self.bodyless_handshake_threshold = bodyless_handshake_threshold
+        self.drain_max_bytes = drain_max_bytes
+        self.drain_timeout = drain_timeout
+        self.lightweight_history = lightweight_history
+        self.handshake_limiter = handshake_limiter
+        self.keep_alive_tracker = get_keep_alive_tracker(keep_alive_tracker, self.host_cache)
+
+    @property
+    def stats(self):
+        """counters for handshakes done vs authenticated connections reused"""
+        return self.connection_state.stats
+
+    def get_session_security(self, response):
+        """
+        The session security (ie the object used to sign and seal messages)
+        negotiated on the connection that served `response`, or None if that
+        connection was not authenticated with NTLM.
+        """
+        state = self.connection_state.get_for_response(response)
+        if state is None:
+            state = self.connection_state.get(get_response_socket(response))
+        return None if state is None else state.session_security
+
+    def _get_host_capabilities(self, authority):
+        if self.host_cache is None:
+            return None
+        return self.host_cache.get(authority)
+
+    def _new_ntlm_context(self, auth_type, cbt_data=None, authority=None):
+        ntlm_strict_mode = self.ntlm_strict_mode
+        capabilities = self._get_host_capabilities(authority)
+        if capabilities is not None and capabilities.strict_mode:
+            ntlm_strict_mode = True
+
+        return HttpNtlmContext(
+            self.username,
+            self.password,
+            domain=self.domain,
+            auth_type=auth_type,
+            cbt_data=cbt_data,
+            ntlm_compatibility=self.ntlm_compatibility,
+            ntlm_strict_mode=ntlm_strict_mode
+        )
+
+    def _remember_auth_type(self, authority, auth_type):
+        if self.preemptive or self.bodyless_handshake_methods:
+            self.auth_scheme_cache.set(authority, auth_type)
+
+        capabilities = self._get_host_capabilities(authority)
+        if self.host_cache is not None and (
+            capabilities is None or capabilities.auth_type != auth_type
+        ):
+            self.host_cache.update(authority, auth_type=auth_type)
+
+    def _forget_auth_type(self, authority):
+        self.auth_scheme_cache.pop(authority)
+        capabilities = self._get_host_capabilities(authority)
+        if capabilities is not None and capabilities.auth_type is not None:
+            self.host_cache.update(authority, auth_type=None)
+
+    def _remember_handshake_result(self, authority, ntlm_context, succeeded):
+        if self.host_cache is None or not ntlm_context.challenge_fixed:
+            return
+
+        # a server that rejected the authenticate message built from the
+        # modified challenge needs `ntlm_strict_mode`
+        strict_mode = not succeeded
+        capabilities = self._get_host_capabilities(authority)
+        if capabilities is None or capabilities.strict_mode != strict_mode:
+            self.host_cache.update(authority, strict_mode=strict_mode)
+
+    @staticmethod
+    def _rewind_request_body(request):
+        content_length = int(
+            request.headers.get("Content-Length", "0"), base=10
+        )
+        if hasattr(request.body, "seek"):
+            if content_length > 0:
+                try:
+                    request.body.seek(-content_length, 1)
+                except (io.UnsupportedOperation, OSError, IOError, ValueError):
+                    request.body.seek(0, 0)
+            else:
+                request.body.seek(0, 0)
+
+    def _use_bodyless_handshake(self, request):
+        """whether the body of `request` should be held back until the connection is authenticated"""
+        if request.body is None or (request.method or "").upper() not in self.bodyless_handshake_methods:
+            return False
+        content_length = request.headers.get("Content-Length")
+        if content_length is None:
+            # chunked, so the size is not known up front
+            return True
+        return int(content_length, base=10) >= self.bodyless_handshake_threshold
+
+    @staticmethod
+    def _remove_request_body(request):
+        request.body = None
+        request.headers.pop("Transfer-Encoding", None)
+        request.headers["Content-Length"] = "0"
+
+    def _drain_response(self, response):
+        return drain_response(response, max_bytes=self.drain_max_bytes, timeout=self.drain_timeout)
+
+    def _get_next_request(self, response, request=None):
+        """the request to send the next leg of the NTLM dance with, after `response`"""
+        request = request or response.request
+        if not self.lightweight_history:
+            return request.copy()
+        # only the auth and cookie headers change from one leg to the next, so
+        # `response` keeps a copy of the headers it was sent with
+        if response.request is request:
+            response.request = get_request_stub(request)
+        return request
+
+    def _extend_history(self, response, *previous_responses):
+        """puts `previous_responses` before what is already in the history of `response`"""
+        history = []
+        for previous_response in previous_responses:
+            if previous_response is response:
+                continue
+            if self.lightweight_history:
+                previous_response = get_response_stub(previous_response)
+            history.append(previous_response)
+        response.history[:0] = history
+
     def retry_using_http_ntlm_auth(
         self, auth_header_field, auth_header, response, auth_type, kwargs
+    ):
+        if self.handshake_limiter is None:
+            return self._retry_using_http_ntlm_auth(
+                auth_header_field, auth_header, response, auth_type, kwargs
+            )
+
+        authority = get_url_authority(response.url)
+        with self.handshake_limiter.slot(authority) as waited:
+            if not (
+                waited
+                and auth_header_field == "www-authenticate"
+                and auth_header not in response.request.headers
+                and self._is_cheap_to_resend(response.request)
+                and self._has_idle_authenticated_connection(response, authority)
+            ):
+                return self._retry_using_http_ntlm_auth(
+                    auth_header_field, auth_header, response, auth_type, kwargs
+                )
+
+            # another thread has authenticated a connection while this one was
+            # waiting, which is the one the pool hands out next
+            retried = self._resend_request(response, kwargs)
+            if retried.status_code != 401:
+                return retried
+            response3 = self._retry_using_http_ntlm_auth(
+                auth_header_field, auth_header, retried, auth_type, kwargs
+            )
+            if response3 is not retried:
+                response3.history[:0] = retried.history
+            return response3
+
+    def _is_cheap_to_resend(self, request):
+        """whether the body of `request` is small enough to be sent once more just in case"""
+        if request.body is None:
+            return True
+        if isinstance(request.body, ReplayableBody) or is_streaming_body(request.body):
+            return False
+        content_length = request.headers.get("Content-Length")
+        return content_length is not None and int(content_length, base=10) < self.bodyless_handshake_threshold
+
+    def _has_idle_authenticated_connection(self, response, authority):
+        """
+        whether the pool that served `response` has an idle connection to
+        `authority` authenticated by this auth, and hands it out before the
+        connection of `response` once that one is released
+        """
+        queue = getattr(getattr(response.raw, "_pool", None), "pool", None)
+        if not isinstance(queue, AffinityQueue):
+            # urllib3's own pools would hand the connection of `response` back
+            return False
+        with queue.mutex:
+            socks = [getattr(conn, "sock", None) for conn in queue.queue if conn is not None]
+        return any(
+            getattr(self.connection_state.get(sock), "authority", None) == authority and is_socket_alive(sock)
+            for sock in socks if sock is not None
+        )
+
+    def _resend_request(self, response, kwargs):
+        """sends the request of `response` again, on whichever connection the pool hands out"""
+        self._rewind_request_body(response.request)
+        self._drain_response(response)
+        response.raw.release_conn()
+        retried = response.connection.send(self._get_next_request(response), **kwargs)
+        sock = get_response_socket(retried)
+        if retried.status_code == 401:
+            if self.connection_state.forget(sock) is not None:
+                self.stats.increment("expired_connections")
+        elif self.connection_state.bind_response(retried, sock) is not None:
+            self.stats.increment("reused_connections")
+        self._extend_history(retried, response)
+        return retried
+
+    def _retry_using_http_ntlm_auth(
+        self, auth_header_field, auth_header, response, auth_type, kwargs
     ):
         # Get the certificate of the server if using HTTPS for CBT
         cbt_data = None
@@ -56,32 +357,25 @@ class HttpNtlmAuth(AuthBase):
         if auth_header in response.request.headers:
             return response
 
-        content_length = int(
-            response.request.headers.get("Content-Length", "0"), base=10
-        )
-        if hasattr(response.request.body, "seek"):
-            if content_length > 0:
-                try:
-                    response.request.body.seek(-content_length, 1)
-                except (io.UnsupportedOperation, OSError, IOError, ValueError):
-                    response.request.body.seek(0, 0)
-            else:
-                response.request.body.seek(0, 0)
+        self._rewind_request_body(response.request)
 
         # Consume content and release the original connection
-        # to allow our new request to reuse the same one.
-        _ = response.content
+        # to allow our new request to reuse the same one. If the connection
+        # has to be closed instead, the NTLM dance starts on a new one
+        self._drain_response(response)
         response.raw.release_conn()
-        request = response.request.copy()
+        if self._use_bodyless_handshake(response.request):
+            # the negotiate message always gets a 401 back, so there is no
+            # point in sending the body along with it
+            request = response.request.copy()
+            self._remove_request_body(request)
+            body_request = self._get_next_request(response)
+        else:
+            request = self._get_next_request(response)
+            body_request = None
 
-        ntlm_context = HttpNtlmContext(
-            self.username,
-            self.password,
-            domain=self.domain,
-            auth_type=auth_type,
-            cbt_data=cbt_data,
-            ntlm_compatibility=self.ntlm_compatibility,
-            ntlm_strict_mode=self.ntlm_strict_mode
+        ntlm_context = self._new_ntlm_context(
+            auth_type, cbt_data=cbt_data, authority=get_url_authority(response.url)
         )
         request.headers[auth_header] = ntlm_context.get_negotiate_header()
 
@@ -96,11 +390,36 @@ class HttpNtlmAuth(AuthBase):
 
         # needed to make NTLM auth compatible with requests-2.3.0
 
+        response3 = self._send_authenticate_request(
+            auth_header_field, auth_header, response2, auth_type, ntlm_context, kwargs,
+            body_request=body_request
+        )
+
+        # Update the history.
+        self._extend_history(response3, response, response2)
+        return response3
+
+    def _send_authenticate_request(
+        self, auth_header_field, auth_header, response2, auth_type, ntlm_context, kwargs,
+        body_request=None, retry=True
+    ):
+        """
+        Answers the challenge in `response2` with the Type 3 (authenticate) message.
+        `body_request` is the request to send instead of `response2.request` when the
+        latter had its body held back.
+        """
+
         # Consume content and release the original connection
         # to allow our new request to reuse the same one.
-        _ = response2.content
+        drained = self._drain_response(response2)
         response2.raw.release_conn()
-        request = response2.request.copy()
+        if not drained:
+            # the challenge is only valid on the connection that was just closed
+            return self._resend_negotiate_request(
+                auth_header_field, auth_header, response2, auth_type, ntlm_context, kwargs,
+                body_request=body_request, retry=retry
+            )
+        request = self._get_next_request(response2, body_request)
 
         # this is important for some web applications that store
         # authentication-related info in cookies (it took a long time to
@@ -115,25 +434,114 @@ class HttpNtlmAuth(AuthBase):
         # Get the response based on the challenge message
         request.headers[auth_header] = ntlm_context.get_authenticate_header()
         response3 = response2.connection.send(request, **kwargs)
-
-        # Update the history.
-        response3.history.append(response)
-        response3.history.append(response2)
+        authority = get_url_authority(response2.url)
+        for response in (response2, response3):
+            self.keep_alive_tracker.observe_headers(authority, response.headers)
 
         # Get the session_security object created by ntlm-auth for signing and
         # sealing of messages
         self.session_security = ntlm_context.session_security
 
+        succeeded = response3.status_code not in (401, 407)
+        self._remember_handshake_result(authority, ntlm_context, succeeded)
+        if not succeeded:
+            self.stats.increment("failed_handshakes")
+        else:
+            self.stats.increment("handshakes")
+            sock = get_response_socket(response3)
+            if sock is not None:
+                self.connection_state.mark_authenticated(
+                    sock, auth_type, get_url_authority(response3.url), ntlm_context.session_security
+                )
+                self.connection_state.bind_response(response3, sock)
+
         return response3
 
+    def _resend_negotiate_request(
+        self, auth_header_field, auth_header, response2, auth_type, ntlm_context, kwargs,
+        body_request=None, retry=True
+    ):
+        """
+        Sends the Type 1 (negotiate) message of `response2` again, on a new connection
+        since the one of `response2` was closed without reading its body to the end.
+        """
+        authority = get_url_authority(response2.url)
+        if not retry:
+            self.stats.increment("failed_handshakes")
+            raise ChallengeBodyTooLarge(
+                "gave up on the NTLM dance with {}: the body of its challenge response could not be "
+                "drained within {} bytes and {} seconds".format(authority, self.drain_max_bytes, self.drain_timeout),
+                response=response2,
+            )
+
+        logger.info(
+            "closed the connection to %s as the body of its challenge response is too big; starting over",
+            authority
+        )
+        request = self._get_next_request(response2)
+        self._rewind_request_body(request)
+        response2b = response2.connection.send(request, **dict(kwargs, stream=False))
+        response3 = self._send_authenticate_request(
+            auth_header_field, auth_header, response2b, auth_type, ntlm_context, kwargs,
+            body_request=body_request, retry=False
+        )
+        # the caller puts `response2` (and what came before it) in front of it
+        self._extend_history(response3, response2b)
+        return response3
+
+    def preemptive_response_hook(self, r, ntlm_context, auth_type, body_request=None, **kwargs):
+        """
+        Hook handler for requests that were sent with the Type 1 (negotiate)
+        message already attached, so the 401 should already hold the challenge.
+        `body_request` holds the original request when `r` was sent without its body.
+        """
+        challenge = None
+        if r.status_code == 401:
+            challenge = ntlm_context.get_challenge_from_header(r.headers.get("www-authenticate"))
+
+        if challenge is None:
+            # not the challenge we expected; start the NTLM dance from scratch
+            self._forget_auth_type(get_url_authority(r.url))
+            if body_request is not None:
+                if r.status_code != 401:
+                    logger.warning(
+                        "%s %s was accepted without its body while expecting an NTLM challenge",
+                        r.request.method, r.url
+                    )
+                    return r
+                r.request = body_request
+            r.request.headers.pop("Authorization", None)
+            return self.response_hook(r, **kwargs)
+
+        self.connection_state.forget(get_response_socket(r))
+        if self.send_cbt:
+            ntlm_context.cbt_data = get_cbt_data(r)
+
+        self._rewind_request_body(body_request or r.request)
+        response2 = self._send_authenticate_request(
+            "www-authenticate", "Authorization", r, auth_type, ntlm_context, kwargs,
+            body_request=body_request
+        )
+        self._extend_history(response2, r)
+        return response2
+
     def response_hook(self, r, **kwargs):
         """The actual hook handler."""
+        sock = get_response_socket(r)
+        if r.status_code in (401, 407):
+            if self.connection_state.forget(sock) is not None:
+                # the server has forgotten that this connection was authenticated
+                self.stats.increment("expired_connections")
+        elif self.connection_state.bind_response(r, sock) is not None:
+            self.stats.increment("reused_connections")
+
         if r.status_code == 401:
             # Handle server auth.
             www_authenticate = r.headers.get("www-authenticate", "")
             auth_type = get_auth_type_from_header(www_authenticate)
 
             if auth_type is not None:
+                self._remember_auth_type(get_url_authority(r.url), auth_type)
                 return self.retry_using_http_ntlm_auth(
                     "www-authenticate", "Authorization", r, auth_type, kwargs
                 )
@@ -153,9 +561,54 @@ class HttpNtlmAuth(AuthBase):
         # connection, not single requests
         r.headers["Connection"] = "Keep-Alive"
 
-        r.register_hook("response", self.response_hook)
+        # the request may have to be sent up to three times
+        if is_streaming_body(r.body):
+            r.body = ReplayableBody(r.body, spool_threshold=self.body_spool_threshold)
+
+        bodyless = self._use_bodyless_handshake(r)
+        auth_type = self._get_preemptive_auth_type(r, bodyless)
+        if auth_type is None:
+            r.register_hook("response", self.response_hook)
+            return r
+
+        # the server is known to use NTLM, so skip the unauthenticated probe
+        # and start the NTLM dance with this request
+        body_request = None
+        if bodyless:
+            # keep the body for the authenticate message and send the negotiate
+            # message without it
+            body_request = r.copy()
+            self._remove_request_body(r)
+        ntlm_context = self._new_ntlm_context(auth_type, authority=get_url_authority(r.url))
+        r.headers["Authorization"] = ntlm_context.get_negotiate_header()
+        r.register_hook(
+            "response",
+            functools.partial(
+                self.preemptive_response_hook,
+                ntlm_context=ntlm_context,
+                auth_type=auth_type,
+                body_request=body_request
+            )
+        )
         return r
 
+    def _get_preemptive_auth_type(self, r, bodyless=False):
+        if not (self.preemptive or bodyless) or "Authorization" in r.headers:
+            return None
+
+        authority = get_url_authority(r.url)
+        if self.connection_state.has_authenticated(authority):
+            # most likely this request will be sent on an already authenticated
+            # connection; a new negotiate message would restart the NTLM dance
+            return None
+        auth_type = self.auth_scheme_cache.get(authority)
+        if auth_type is None:
+            capabilities = self._get_host_capabilities(authority)
+            if capabilities is not None and capabilities.auth_type is not None:
+                auth_type = capabilities.auth_type
+                self.auth_scheme_cache.set(authority, auth_type)
+        return auth_type
+
     def extract_username_and_password(self):
         if self.domain:
             return r"{}\{}".format(self.domain, self.username), self.password
@@ -0,0 +1,230 @@
+import binascii
+import hashlib
+import hmac
+import struct
+import tempfile
+
+import ntlm_auth.rc4
+import ntlm_auth.session_security
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.ciphers import Cipher
+from ntlm_auth.constants import NegotiateFlags
+
+from .body import DEFAULT_CHUNK_SIZE, DEFAULT_SPOOL_THRESHOLD, iter_chunks
+
+
+try:
+    from cryptography.hazmat.decrepit.ciphers.algorithms import ARC4
+except ImportError:  # cryptography < 43
+    try:
+        from cryptography.hazmat.primitives.ciphers.algorithms import ARC4
+    except ImportError:  # pragma: no cover
+        ARC4 = None
+
+
+_SEQ_NUM = struct.Struct("<I")
+_SIGNATURE_VERSION = b"\x01\x00\x00\x00"
+_RANDOM_PAD = b"\x00\x00\x00\x00"
+_SIGN_OR_SEAL = NegotiateFlags.NTLMSSP_NEGOTIATE_SIGN | NegotiateFlags.NTLMSSP_NEGOTIATE_SEAL
+
+
+class _Checksum(object):
+    """incremental version of the checksum part of a message signature"""
+
+    def __init__(self, negotiate_flags, signing_key, seq_num):
+        self._negotiate_flags = negotiate_flags
+        self._seq_num = _SEQ_NUM.pack(seq_num)
+        self._hmac = None
+        self._crc = 0
+        if negotiate_flags & NegotiateFlags.NTLMSSP_NEGOTIATE_EXTENDED_SESSIONSECURITY:
+            self._hmac = hmac.new(signing_key, self._seq_num, digestmod=hashlib.md5)
+
+    def update(self, data):
+        if self._hmac is not None:
+            self._hmac.update(data)
+        else:
+            self._crc = binascii.crc32(data, self._crc)
+
+    def finish(self, handle):
+        """returns the (checksum, sequence number) parts of the signature"""
+        if self._hmac is not None:
+            checksum = self._hmac.digest()[:8]
+            if self._negotiate_flags & NegotiateFlags.NTLMSSP_NEGOTIATE_KEY_EXCH:
+                checksum = handle.update(checksum)
+            return checksum, self._seq_num
+
+        checksum = _SEQ_NUM.pack(self._crc & 0xFFFFFFFF)
+        handle.update(_RANDOM_PAD)
+        return handle.update(checksum), handle.update(self._seq_num)
+
+
+def new_rc4_handle(key):
+    """RC4 cipher from `cryptography`, or the pure python one from ntlm-auth if that has no RC4"""
+    if ARC4 is None:
+        return ntlm_auth.rc4._PythonARC4(key)
+    return Cipher(ARC4(key), mode=None, backend=default_backend()).encryptor()
+
+
+class SessionSecurity(ntlm_auth.session_security.SessionSecurity):
+    """
+    Drop-in replacement for ntlm-auth's SessionSecurity (ie the object used to
+    sign and seal messages once authenticated) that always uses the RC4 from
+    `cryptography`, feeds messages to HMAC-MD5 without concatenating them and
+    accepts bytes, bytearray or memoryview messages.
+    """
+
+    def reset_rc4_state(self, outgoing=True):
+        if self._source == "client":
+            outgoing_key, incoming_key = self._client_sealing_key, self._server_sealing_key
+        else:
+            outgoing_key, incoming_key = self._server_sealing_key, self._client_sealing_key
+
+        if outgoing:
+            self.outgoing_handle = new_rc4_handle(outgoing_key)
+        else:
+            self.incoming_handle = new_rc4_handle(incoming_key)
+
+    @property
+    def is_sealed(self):
+        return bool(self.negotiate_flags & NegotiateFlags.NTLMSSP_NEGOTIATE_SEAL)
+
+    @property
+    def is_signed(self):
+        return bool(self.negotiate_flags & _SIGN_OR_SEAL)
+
+    def _new_outgoing_checksum(self):
+        return _Checksum(self.negotiate_flags, self.outgoing_signing_key, self.outgoing_seq_num)
+
+    def _new_incoming_checksum(self):
+        return _Checksum(self.negotiate_flags, self.incoming_signing_key, self.incoming_seq_num)
+
+    def _finish_signature(self, checksum):
+        checksum, seq_num = checksum.finish(self.outgoing_handle)
+        self.outgoing_seq_num += 1
+        if self.negotiate_flags & NegotiateFlags.NTLMSSP_NEGOTIATE_EXTENDED_SESSIONSECURITY:
+            return _SIGNATURE_VERSION + checksum + seq_num
+        return _SIGNATURE_VERSION + _RANDOM_PAD + checksum + seq_num
+
+    def _finish_verification(self, checksum, signature):
+        signature = bytes(signature)
+        if self.negotiate_flags & NegotiateFlags.NTLMSSP_NEGOTIATE_EXTENDED_SESSIONSECURITY:
+            actual_checksum = signature[4:12]
+        else:
+            actual_checksum = signature[8:12]
+        actual_seq_num = signature[12:16]
+
+        expected_checksum, expected_seq_num = checksum.finish(self.incoming_handle)
+        if actual_checksum != expected_checksum:
+            raise Exception("The signature checksum does not match, message has been altered")
+        if actual_seq_num != expected_seq_num:
+            raise Exception(
+                "The signature sequence number does not match up, "
+                "message not received in the correct sequence"
+            )
+        self.incoming_seq_num += 1
+
+    def get_signature(self, message):
+        checksum = self._new_outgoing_checksum()
+        checksum.update(message)
+        return self._finish_signature(checksum)
+
+    def verify_signature(self, message, signature):
+        checksum = self._new_incoming_checksum()
+        checksum.update(message)
+        self._finish_verification(checksum, signature)
+
+    def wrap_stream(self, source, chunk_size=DEFAULT_CHUNK_SIZE):
+        """streaming version of `wrap`; see `WrapStream`"""
+        return WrapStream(self, source, chunk_size=chunk_size)
+
+    def unwrap_stream(self, source, signature, chunk_size=DEFAULT_CHUNK_SIZE):
+        """streaming version of `unwrap`; see `UnwrapStream`"""
+        return UnwrapStream(self, source, signature, chunk_size=chunk_size)
+
+
+class WrapStream(object):
+    """
+    Signs (and seals, if negotiated) a message that is read from a file
+    object or an iterable of buffers, one chunk at a time.
+
+    Iterating yields the sealed chunks; `signature` is set once they have all
+    been yielded (and left as None if neither signing nor sealing was
+    negotiated, like `wrap` does). The RC4 state and sequence number are shared with the
+    SessionSecurity, so no other message may be wrapped until this one is done.
+    """
+
+    def __init__(self, session_security, source, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.session_security = session_security
+        self.source = source
+        self.chunk_size = chunk_size
+        self.signature = None
+
+    def __iter__(self):
+        session_security = self.session_security
+        checksum = session_security._new_outgoing_checksum()
+        for chunk in iter_chunks(self.source, self.chunk_size):
+            checksum.update(chunk)
+            if session_security.is_sealed:
+                chunk = session_security.outgoing_handle.update(chunk)
+            yield chunk
+        if session_security.is_signed:
+            self.signature = session_security._finish_signature(checksum)
+
+    def write_to(self, output):
+        """writes the sealed message to the `output` file object and returns the signature"""
+        for chunk in self:
+            output.write(chunk)
+        return self.signature
+
+    def iter_signed(self, spool_threshold=DEFAULT_SPOOL_THRESHOLD):
+        """
+        Yields the signature (if any) followed by the sealed message, eg to be used as
+        a `requests` body. The signature is only known once the whole message
+        has been sealed, so the sealed message is spooled first: in memory up
+        to `spool_threshold` bytes and in a temporary file after that.
+        """
+        with tempfile.SpooledTemporaryFile(max_size=spool_threshold) as spool:
+            signature = self.write_to(spool)
+            if signature is not None:
+                yield signature
+            spool.seek(0)
+            for chunk in iter_chunks(spool, self.chunk_size):
+                yield chunk
+
+
+class UnwrapStream(object):
+    """
+    Unseals (if negotiated) and verifies a message that is read from a file
+    object or an iterable of buffers, one chunk at a time.
+
+    Iterating yields the unsealed chunks and raises once they have all been
+    yielded if the message does not match `signature`, so nothing should be
+    trusted before the iteration is over. The RC4 state and sequence number
+    are shared with the SessionSecurity, so no other message may be unwrapped
+    until this one is done.
+    """
+
+    def __init__(self, session_security, source, signature, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.session_security = session_security
+        self.source = source
+        self.signature = signature
+        self.chunk_size = chunk_size
+
+    def __iter__(self):
+        session_security = self.session_security
+        checksum = session_security._new_incoming_checksum()
+        for chunk in iter_chunks(self.source, self.chunk_size):
+            if session_security.is_sealed:
+                chunk = session_security.incoming_handle.update(chunk)
+            checksum.update(chunk)
+            yield chunk
+        if session_security.is_signed:
+            session_security._finish_verification(checksum, self.signature)
+
+    def write_to(self, output):
+        """
+        writes the unsealed message to the `output` file object; it raises
+        after writing if the message does not match the signature
+        """
+        for chunk in self:
+            output.write(chunk)
@@ -0,0 +1,170 @@
+import logging
+import threading
+import weakref
+
+
+logger = logging.getLogger(__name__)
+
+# the registries that authenticated each socket, so that the connection pools can
+# tell the connections that are already authenticated (by any registry) apart
+_authenticated_sockets = weakref.WeakKeyDictionary()
+_authenticated_sockets_lock = threading.Lock()
+
+
+def is_authenticated_socket(sock):
+    with _authenticated_sockets_lock:
+        try:
+            return bool(_authenticated_sockets.get(sock))
+        except TypeError:
+            return False
+
+
+def _set_socket_authenticated(sock, registry, authenticated):
+    with _authenticated_sockets_lock:
+        if authenticated:
+            _authenticated_sockets.setdefault(sock, weakref.WeakSet()).add(registry)
+            return
+        registries = _authenticated_sockets.get(sock)
+        if registries is not None:
+            registries.discard(registry)
+            if not registries:
+                del _authenticated_sockets[sock]
+
+
+class HandshakeStats(object):
+    """Counters describing how often the NTLM dance had to be done"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.handshakes = 0
+        self.failed_handshakes = 0
+        self.reused_connections = 0
+        self.expired_connections = 0
+
+    def increment(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                "handshakes": self.handshakes,
+                "failed_handshakes": self.failed_handshakes,
+                "reused_connections": self.reused_connections,
+                "expired_connections": self.expired_connections,
+            }
+
+    def __repr__(self):
+        return "{}({})".format(
+            self.__class__.__name__,
+            ", ".join("{}={}".format(k, v) for k, v in sorted(self.as_dict().items()))
+        )
+
+
+class ConnectionState(object):
+    """NTLM state of a single pooled connection"""
+
+    def __init__(self, auth_type, authority, session_security=None):
+        self.auth_type = auth_type
+        self.authority = authority
+        # signs and seals the messages sent on this connection once authenticated
+        self.session_security = session_security
+
+
+class ConnectionStateRegistry(object):
+    """
+    Keeps track of which sockets have completed the NTLM dance.
+
+    NTLM authenticates the TCP connection rather than the request, so the registry is keyed
+    weakly by the socket: once urllib3 drops a connection its entry disappears with it.
+    The responses served by an authenticated connection are tracked (weakly too) so that
+    its state can still be found once the response has given the connection back.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._states = weakref.WeakKeyDictionary()
+        self._responses = weakref.WeakKeyDictionary()
+        self.stats = HandshakeStats()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._states)
+
+    def get(self, sock):
+        if sock is None:
+            return None
+        with self._lock:
+            try:
+                return self._states.get(sock)
+            except TypeError:
+                return None
+
+    def is_authenticated(self, sock):
+        return self.get(sock) is not None
+
+    def has_authenticated(self, authority):
+        """whether any live connection to `authority` has been authenticated"""
+        with self._lock:
+            items = list(self._states.items())
+        return any(
+            state.authority == authority and not _is_closed(sock) for sock, state in items
+        )
+
+    def mark_authenticated(self, sock, auth_type, authority=None, session_security=None):
+        if sock is None:
+            return None
+        state = ConnectionState(auth_type, authority, session_security)
+        with self._lock:
+            try:
+                self._states[sock] = state
+            except TypeError:
+                logger.debug("cannot track connection state for %r", sock)
+                return None
+            self._prune()
+        _set_socket_authenticated(sock, self, True)
+        return state
+
+    def _prune(self):
+        # closed sockets can stay around for a while before being collected
+        closed = [sock for sock in self._states.keys() if hasattr(sock, "fileno") and _is_closed(sock)]
+        for sock in closed:
+            del self._states[sock]
+
+    def bind_response(self, response, sock):
+        """remembers that `response` was served by the connection of `sock`"""
+        state = self.get(sock)
+        if state is not None:
+            with self._lock:
+                try:
+                    self._responses[response] = state
+                except TypeError:
+                    logger.debug("cannot track connection state for %r", response)
+        return state
+
+    def get_for_response(self, response):
+        """the state of the connection that served `response`, if it was authenticated"""
+        with self._lock:
+            try:
+                return self._responses.get(response)
+            except TypeError:
+                return None
+
+    def forget(self, sock):
+        if sock is None:
+            return None
+        with self._lock:
+            try:
+                state = self._states.pop(sock, None)
+            except TypeError:
+                return None
+        if state is not None:
+            _set_socket_authenticated(sock, self, False)
+        return state
+
+
+def _is_closed(sock):
+    try:
+        return sock.fileno() == -1
+    except Exception:
+        return True
@@ -0,0 +1,130 @@
+import collections
+import itertools
+import logging
+import threading
+
+from . import clock
+
+
+logger = logging.getLogger(__name__)
+
+TUNNEL_POOL_SIZE = 32
+TUNNEL_MAX_IDLE = 30.0
+TUNNEL_MAX_AGE = 600.0
+
+Tunnel = collections.namedtuple("Tunnel", ("sock", "created_at", "idle_since", "is_verified"))
+
+
+class TunnelPool(object):
+    """
+    Keeps idle CONNECT tunnels that have already been through the NTLM dance
+    with the proxy (and the TLS handshake with the target), so that a new
+    connection to the same target can take one over instead of doing all of
+    that again. This is what happens when a burst of requests needs more
+    connections than urllib3 keeps in its pools: the connections that do not
+    fit are closed, and their tunnels end up here.
+
+    Tunnels are keyed by (proxy host, proxy port, target host, target port)
+    plus whatever else makes one unsuitable for another connection, eg the
+    credentials or the certificate checks. A tunnel is dropped once it has
+    been idle for `max_idle` seconds or open for `max_age` seconds, and the
+    least recently used tunnels are dropped when there are more than `maxsize`.
+    """
+
+    def __init__(self, maxsize=TUNNEL_POOL_SIZE, max_idle=TUNNEL_MAX_IDLE, max_age=TUNNEL_MAX_AGE, timer=clock.now):
+        if maxsize < 1:
+            raise ValueError("maxsize must be at least 1, got {}".format(maxsize))
+        self.maxsize = maxsize
+        self.max_idle = max_idle
+        self.max_age = max_age
+        self._timer = timer
+        self._lock = threading.Lock()
+        # token -> (key, Tunnel), least recently used first
+        self._tunnels = collections.OrderedDict()
+        self._tokens = itertools.count()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        with self._lock:
+            return len(self._tunnels)
+
+    def _is_expired(self, tunnel, now):
+        if self.max_idle is not None and now - tunnel.idle_since >= self.max_idle:
+            return True
+        return self.max_age is not None and now - tunnel.created_at >= self.max_age
+
+    def _pop_expired(self, now):
+        expired = [token for token, (_, tunnel) in self._tunnels.items() if self._is_expired(tunnel, now)]
+        return [self._tunnels.pop(token)[1] for token in expired]
+
+    @staticmethod
+    def _close(tunnels):
+        for tunnel in tunnels:
+            try:
+                tunnel.sock.close()
+            except (OSError, IOError):
+                pass
+
+    def put(self, key, sock, created_at, is_verified=False):
+        """
+        Adds the socket of an idle tunnel to the pool. Returns False if it is
+        already too old to be kept, in which case it is left to the caller.
+        """
+        now = self._timer()
+        tunnel = Tunnel(sock, created_at, now, is_verified)
+        if self.max_age is not None and now - created_at >= self.max_age:
+            return False
+
+        with self._lock:
+            dropped = self._pop_expired(now)
+            self._tunnels[next(self._tokens)] = key, tunnel
+            while len(self._tunnels) > self.maxsize:
+                dropped.append(self._tunnels.popitem(last=False)[1][1])
+            self.evictions += len(dropped)
+        self._close(dropped)
+        logger.debug("keeping idle tunnel to %s:%s through %s:%s", key[2], key[3], key[0], key[1])
+        return True
+
+    def get(self, key):
+        """takes the most recently used tunnel for `key` out of the pool, or returns None"""
+        with self._lock:
+            dropped = self._pop_expired(self._timer())
+            self.evictions += len(dropped)
+            for token in reversed(self._tunnels):
+                if self._tunnels[token][0] == key:
+                    tunnel = self._tunnels.pop(token)[1]
+                    self.hits += 1
+                    break
+            else:
+                tunnel = None
+                self.misses += 1
+        self._close(dropped)
+        return tunnel
+
+    def prune(self):
+        """closes the tunnels that have been idle or open for too long"""
+        with self._lock:
+            dropped = self._pop_expired(self._timer())
+            self.evictions += len(dropped)
+        self._close(dropped)
+        return len(dropped)
+
+    def clear(self):
+        """closes every tunnel in the pool"""
+        with self._lock:
+            dropped = [tunnel for _, tunnel in self._tunnels.values()]
+            self._tunnels.clear()
+        self._close(dropped)
+
+
+def get_tunnel_pool(tunnel_pool):
+    """accepts either a TunnelPool, or True for a TunnelPool with the default limits"""
+    if tunnel_pool is None or tunnel_pool is False:
+        return None
+    if isinstance(tunnel_pool, TunnelPool):
+        return tunnel_pool
+    if tunnel_pool is True:
+        return TunnelPool()
+    raise TypeError("expected a TunnelPool, got {!r}".format(tunnel_pool))
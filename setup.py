@@ -22,6 +22,7 @@ requirements = [
     "ntlm-auth>=1.0.2",
     "cryptography>=1.3",
     "six>=1.10",
+    "futures>=3; python_version == '2.7'",
 ]
 
 testing_requirements = [
@@ -0,0 +1,52 @@
+import socket
+import sys
+
+import pytest
+
+import requests_ntlm2.state
+
+
+collect_ignore = []
+if sys.version_info < (3, 5):
+    # the asyncio support uses async/await
+    collect_ignore.append("unit/test_aio.py")
+
+
+@pytest.fixture
+def registry():
+    return requests_ntlm2.state.ConnectionStateRegistry()
+
+
+@pytest.fixture
+def sockets():
+    """makes unconnected sockets that are closed after the test"""
+    socks = []
+
+    def new_socket():
+        socks.append(socket.socket())
+        return socks[-1]
+
+    yield new_socket
+    for sock in socks:
+        sock.close()
+
+
+@pytest.fixture
+def socket_pairs():
+    """makes pairs of connected sockets that are closed after the test"""
+    pairs = []
+
+    def new_socket_pair():
+        pairs.append(socket.socketpair())
+        pairs[-1][0].settimeout(5)
+        return pairs[-1]
+
+    yield new_socket_pair
+    for sock, peer in pairs:
+        sock.close()
+        peer.close()
+
+
+@pytest.fixture
+def socket_pair(socket_pairs):
+    return socket_pairs()
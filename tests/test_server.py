@@ -9,17 +9,17 @@ from tests.test_utils import domain, password, username
 app = Flask(__name__)
 
 
-@app.route("/ntlm")
+@app.route("/ntlm", methods=["GET", "POST"])
 def ntlm_auth():
     return get_auth_response("NTLM")
 
 
-@app.route("/negotiate")
+@app.route("/negotiate", methods=["GET", "POST"])
 def negotiate_auth():
     return get_auth_response("Negotiate")
 
 
-@app.route("/both")
+@app.route("/both", methods=["GET", "POST"])
 def negotiate_and_ntlm_auth():
     return get_auth_response("NTLM", advertise_nego_and_ntlm=True)
 
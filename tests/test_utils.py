@@ -2,3 +2,13 @@
 username = "username"
 domain = "domain"
 password = "password"
+
+
+class FakeTimer(object):
+    """a timer for `LRUCache`, `TunnelPool` and the like that only moves when told to"""
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
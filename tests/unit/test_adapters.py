@@ -1,10 +1,19 @@
+import socket
+
 import mock
 import requests.adapters
 import requests.sessions
 from requests.packages.urllib3.connection import HTTPConnection, HTTPSConnection
+from requests.packages.urllib3.poolmanager import pool_classes_by_scheme
 
 import requests_ntlm2.adapters
 import requests_ntlm2.connection
+import requests_ntlm2.hostcache
+import requests_ntlm2.keepalive
+import requests_ntlm2.keepwarm
+import requests_ntlm2.limiter
+import requests_ntlm2.pool
+import requests_ntlm2.tunnels
 
 
 class TestHttpProxyAdapter(object):
@@ -133,6 +142,17 @@ class TestHttpNtlmAdapter(object):
         mock_setup.assert_called_once_with("username", "password", 3, True, "HTTP/1.0")
         mock_teardown.assert_not_called()
 
+    @mock.patch("requests_ntlm2.adapters.HttpNtlmAdapter._teardown")
+    @mock.patch("requests_ntlm2.adapters.HttpNtlmAdapter._setup")
+    def test_init__user_agent(self, mock_setup, mock_teardown):
+        adapter = requests_ntlm2.adapters.HttpNtlmAdapter(
+            "username", "password", 3, False, "HTTP/1.0", "fake-ua/1.0", tunnel_pool=True
+        )
+        assert adapter._user_agent == "fake-ua/1.0"
+        assert adapter.host_cache is None
+        assert adapter.tunnel_pool is not None
+        mock_setup.assert_called_once_with("username", "password", 3, False, "HTTP/1.0")
+
     @mock.patch("requests_ntlm2.adapters.HttpNtlmAdapter._teardown")
     @mock.patch("requests_ntlm2.adapters.HttpNtlmAdapter._setup")
     def close(self, mock_setup, mock_teardown):
@@ -141,63 +161,226 @@ class TestHttpNtlmAdapter(object):
         mock_setup.assert_called_once_with("username", "password", 3)
         mock_teardown.assert_called_once()
 
-    @mock.patch("requests_ntlm2.connection.HTTPSConnection.set_http_version")
-    @mock.patch("requests_ntlm2.connection.HTTPSConnection.set_ntlm_auth_credentials")
-    def test__setup(self, mock_set_ntlm_auth_credentials, mock_set_http_version):
-        from requests.packages.urllib3.poolmanager import pool_classes_by_scheme
-        adapter = requests_ntlm2.adapters.HttpNtlmAdapter("username", "password")
-        mock_set_ntlm_auth_credentials.assert_called_once_with("username", "password")
-        mock_set_http_version.assert_called_once_with("HTTP/1.0")
+    def test__setup(self):
+        adapter = requests_ntlm2.adapters.HttpNtlmAdapter(r"DOMAIN\username", "password")
+        connection_cls = adapter.connection_cls
+        assert issubclass(connection_cls, requests_ntlm2.connection.HTTPSConnection)
+        assert connection_cls is not requests_ntlm2.connection.HTTPSConnection
+        assert connection_cls._ntlm_credentials == ("username", "password", "DOMAIN")
+        assert connection_cls._http_version == "HTTP/1.0"
+        assert connection_cls.ntlm_compatibility == 3
+        assert connection_cls.ntlm_strict_mode is False
 
-        http_conn_cls = pool_classes_by_scheme["http"].ConnectionCls
-        https_conn_cls = pool_classes_by_scheme["https"].ConnectionCls
+        http_conn_cls = adapter.pool_classes_by_scheme["http"].ConnectionCls
+        https_conn_cls = adapter.pool_classes_by_scheme["https"].ConnectionCls
         assert http_conn_cls is requests_ntlm2.connection.HTTPConnection
-        assert https_conn_cls is requests_ntlm2.connection.HTTPSConnection
+        assert https_conn_cls is connection_cls
+        assert issubclass(adapter.pool_classes_by_scheme["https"], requests_ntlm2.pool.HTTPSConnectionPool)
+        # nothing global is touched
+        assert pool_classes_by_scheme["http"].ConnectionCls is HTTPConnection
+        assert pool_classes_by_scheme["https"].ConnectionCls is HTTPSConnection
+        assert not hasattr(requests_ntlm2.connection.HTTPSConnection, "_ntlm_credentials")
         adapter.close()
 
-    @mock.patch("requests_ntlm2.connection.HTTPSConnection.set_http_version")
-    @mock.patch("requests_ntlm2.connection.HTTPSConnection.set_ntlm_auth_credentials")
-    def test__setup__http_version(self, mock_set_ntlm_auth_credentials, mock_set_http_version):
-        from requests.packages.urllib3.poolmanager import pool_classes_by_scheme
+    def test__setup__settings(self):
         adapter = requests_ntlm2.adapters.HttpNtlmAdapter(
             "username",
             "password",
+            ntlm_compatibility=1,
+            ntlm_strict_mode=True,
             proxy_tunnelling_http_version="HTTP/1.1"
         )
-        mock_set_ntlm_auth_credentials.assert_called_once_with("username", "password")
-        mock_set_http_version.assert_called_once_with("HTTP/1.1")
+        assert adapter.connection_cls._http_version == "HTTP/1.1"
+        assert adapter.connection_cls.ntlm_compatibility == 1
+        assert adapter.connection_cls.ntlm_strict_mode is True
+        assert requests_ntlm2.connection.HTTPSConnection.ntlm_strict_mode is False
+        adapter.close()
 
-        http_conn_cls = pool_classes_by_scheme["http"].ConnectionCls
-        https_conn_cls = pool_classes_by_scheme["https"].ConnectionCls
-        assert http_conn_cls is requests_ntlm2.connection.HTTPConnection
-        assert https_conn_cls is requests_ntlm2.connection.HTTPSConnection
+    def test__setup__pool_managers(self):
+        adapter = requests_ntlm2.adapters.HttpNtlmAdapter("username", "password")
+        pool = adapter.get_connection("https://example.com")
+        assert pool.ConnectionCls is adapter.connection_cls
+        pool = adapter.get_connection("https://example.com", proxies={"https": "http://proxy:8080"})
+        assert pool.ConnectionCls is adapter.connection_cls
+        assert pool.proxy.host == "proxy"
+        pool = adapter.get_connection("http://example.com", proxies={"http": "http://proxy:8080"})
+        assert pool.ConnectionCls is requests_ntlm2.connection.HTTPConnection
         adapter.close()
 
-    @mock.patch("requests_ntlm2.connection.HTTPSConnection.clear_http_version")
-    @mock.patch("requests_ntlm2.connection.HTTPSConnection.set_http_version")
-    @mock.patch("requests_ntlm2.connection.HTTPSConnection.clear_ntlm_auth_credentials")
-    @mock.patch("requests_ntlm2.connection.HTTPSConnection.set_ntlm_auth_credentials")
-    def test_close(
-            self,
-            set_ntlm_auth_credentials,
-            clear_ntlm_auth_credentials,
-            set_http_version,
-            clear_http_version
-    ):
-        from requests.packages.urllib3.poolmanager import pool_classes_by_scheme
+    def test__setup__several_adapters(self):
+        first = requests_ntlm2.adapters.HttpNtlmAdapter("first", "password1")
+        second = requests_ntlm2.adapters.HttpNtlmAdapter("second", "password2")
+        first_pool = first.get_connection("https://example.com", proxies={"https": "http://proxy1:8080"})
+        second_pool = second.get_connection("https://example.com", proxies={"https": "http://proxy2:8080"})
+        assert first_pool.ConnectionCls._ntlm_credentials[0] == "first"
+        assert second_pool.ConnectionCls._ntlm_credentials[0] == "second"
+
+        # closing one adapter leaves the other one alone
+        first.close()
+        assert second.connection_cls._ntlm_credentials[0] == "second"
+        second.close()
+
+    def test_close(self):
         adapter = requests_ntlm2.adapters.HttpNtlmAdapter("username2", "password")
-        set_ntlm_auth_credentials.assert_called_once_with("username2", "password")
-        set_http_version.assert_called_once_with("HTTP/1.0")
+        connection_cls = adapter.connection_cls
+        adapter.close()
+        assert not hasattr(connection_cls, "_ntlm_credentials")
 
-        http_conn_cls = pool_classes_by_scheme["http"].ConnectionCls
-        https_conn_cls = pool_classes_by_scheme["https"].ConnectionCls
-        assert http_conn_cls is requests_ntlm2.connection.HTTPConnection
-        assert https_conn_cls is requests_ntlm2.connection.HTTPSConnection
+    def test_host_cache(self):
+        host_cache = mock.MagicMock(spec=requests_ntlm2.hostcache.HostCapabilityCache)
+        adapter = requests_ntlm2.adapters.HttpNtlmAdapter(
+            "username", "password", host_cache=host_cache
+        )
+        assert adapter.host_cache is host_cache
+        assert adapter.connection_cls.ntlm_host_cache is host_cache
+        assert requests_ntlm2.connection.HTTPSConnection.ntlm_host_cache is None
+
+        adapter.close()
+        assert adapter.connection_cls.ntlm_host_cache is None
+
+    def test_tunnel_pool(self):
+        adapter = requests_ntlm2.adapters.HttpNtlmAdapter("username", "password", tunnel_pool=True)
+        assert isinstance(adapter.tunnel_pool, requests_ntlm2.tunnels.TunnelPool)
+        assert adapter.connection_cls.ntlm_tunnel_pool is adapter.tunnel_pool
+        assert requests_ntlm2.connection.HTTPSConnection.ntlm_tunnel_pool is None
+
+        with mock.patch.object(adapter.tunnel_pool, "clear") as mock_clear:
+            adapter.close()
+        mock_clear.assert_called_once_with()
+        assert adapter.connection_cls.ntlm_tunnel_pool is None
+
+    def test_prewarm(self):
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(8)
+        url = "http://127.0.0.1:{}/".format(listener.getsockname()[1])
+        adapter = requests_ntlm2.adapters.HttpNtlmAdapter("username", "password")
+        try:
+            results = adapter.prewarm([url], connections=3)
+            assert [(r.url, r.host, r.port, r.error) for r in results] == [
+                (url, "127.0.0.1", listener.getsockname()[1], None)
+            ] * 3
+            assert all(r.elapsed >= 0 for r in results)
+
+            pool = adapter.get_connection(url)
+            assert len([conn for conn in pool.pool.queue if conn is not None and conn.sock is not None]) == 3
+            # the connections are already open
+            assert adapter.prewarm([url], connections=3) == []
+        finally:
+            adapter.close()
+            listener.close()
+
+    def test_prewarm__some_already_open(self):
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(8)
+        url = "http://127.0.0.1:{}/".format(listener.getsockname()[1])
+        adapter = requests_ntlm2.adapters.HttpNtlmAdapter("username", "password")
+        try:
+            assert len(adapter.prewarm([url])) == 1
+            results = adapter.prewarm([url], connections=3)
+            assert len(results) == 2
+            pool = adapter.get_connection(url)
+            assert len({conn for conn in pool.pool.queue if conn is not None and conn.sock is not None}) == 3
+        finally:
+            adapter.close()
+            listener.close()
+
+    def test_prewarm__timeout(self):
+        adapter = requests_ntlm2.adapters.HttpNtlmAdapter("username", "password")
+        pool = mock.Mock(proxy=None)
+        conn = mock.Mock(sock=None)
+        timeouts = []
+        conn.connect.side_effect = lambda: timeouts.append(conn.timeout)
+        pool._get_conn.return_value = conn
+        with mock.patch.object(adapter, "get_connection", return_value=pool):
+            results = adapter.prewarm(["http://example.com"], timeout=2.5)
+        adapter.close()
+        assert [r.error for r in results] == [None]
+        assert timeouts == [2.5]
+
+    def test_prewarm__failed(self):
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        url = "http://127.0.0.1:{}/".format(listener.getsockname()[1])
+        listener.close()
+        adapter = requests_ntlm2.adapters.HttpNtlmAdapter("username", "password")
+        try:
+            results = adapter.prewarm([url], connections=2)
+            assert len(results) == 2
+            assert all(r.error is not None for r in results)
+            pool = adapter.get_connection(url)
+            assert pool.pool.qsize() == pool.pool.maxsize
+            assert all(conn is None for conn in pool.pool.queue)
+        finally:
+            adapter.close()
+
+    def test_prewarm__proxy(self):
+        adapter = requests_ntlm2.adapters.HttpNtlmAdapter("username", "password")
+        pool = mock.Mock(proxy=mock.Mock(), scheme="https", host="example.com", port=443)
+        conn = mock.Mock(sock=None)
+        pool._get_conn.return_value = conn
+        with mock.patch.object(adapter, "get_connection", return_value=pool) as mock_get_connection:
+            results = adapter.prewarm(["https://example.com"], proxies={"https": "http://proxy:8080"})
+        adapter.close()
+
+        mock_get_connection.assert_called_once_with("https://example.com", {"https": "http://proxy:8080"})
+        pool._prepare_proxy.assert_called_once_with(conn)
+        pool._put_conn.assert_called_once_with(conn)
+        conn.connect.assert_not_called()
+        assert [(r.host, r.port, r.error) for r in results] == [("example.com", 443, None)]
+
+    def test_handshake_limiter(self):
+        limiter = requests_ntlm2.limiter.HandshakeLimiter(max_per_host=1)
+        adapter = requests_ntlm2.adapters.HttpNtlmAdapter("username", "password", handshake_limiter=limiter)
+        assert adapter.connection_cls.ntlm_handshake_limiter is limiter
+        assert requests_ntlm2.connection.HTTPSConnection.ntlm_handshake_limiter is None
+        adapter.close()
+
+    def test_keep_alive_tracker(self):
+        adapter = requests_ntlm2.adapters.HttpNtlmAdapter("username", "password")
+        assert adapter.keep_alive_tracker is requests_ntlm2.keepalive.default_keep_alive_tracker
 
+        tracker = requests_ntlm2.keepalive.KeepAliveTracker()
+        adapter = requests_ntlm2.adapters.HttpNtlmAdapter("username", "password", keep_alive_tracker=tracker)
+        assert adapter.connection_cls.ntlm_keep_alive_tracker is tracker
+        assert adapter.pool_classes_by_scheme["http"].keep_alive_tracker is tracker
+        assert adapter.pool_classes_by_scheme["https"].keep_alive_tracker is tracker
+        assert requests_ntlm2.pool.HTTPSConnectionPool.keep_alive_tracker is not tracker
         adapter.close()
-        clear_ntlm_auth_credentials.assert_called_once()
-        clear_http_version.assert_called_once_with()
-        http_conn_cls = pool_classes_by_scheme["http"].ConnectionCls
-        https_conn_cls = pool_classes_by_scheme["https"].ConnectionCls
-        assert http_conn_cls is HTTPConnection
-        assert https_conn_cls is HTTPSConnection
+
+    def test_keep_warm(self):
+        adapter = requests_ntlm2.adapters.HttpNtlmAdapter("username", "password")
+        assert adapter.keep_warm is None
+        assert adapter.pool_classes_by_scheme["https"].keep_warm is None
+
+        adapter = requests_ntlm2.adapters.HttpNtlmAdapter("username", "password", keep_warm=True)
+        assert isinstance(adapter.keep_warm, requests_ntlm2.keepwarm.KeepWarmScheduler)
+        assert adapter.pool_classes_by_scheme["http"].keep_warm is adapter.keep_warm
+        assert adapter.pool_classes_by_scheme["https"].keep_warm is adapter.keep_warm
+        assert requests_ntlm2.pool.HTTPSConnectionPool.keep_warm is None
+
+        pool = adapter.get_connection("https://example.com")
+        assert pool in adapter.keep_warm._pools
+        with mock.patch.object(adapter.keep_warm, "stop") as mock_stop:
+            adapter.close()
+        mock_stop.assert_called_once_with()
+        assert pool not in adapter.keep_warm._pools
+        adapter.keep_warm.stop()
+
+    def test_keep_warm__shared(self):
+        scheduler = requests_ntlm2.keepwarm.KeepWarmScheduler(tick=3600)
+        first = requests_ntlm2.adapters.HttpNtlmAdapter("first", "password", keep_warm=scheduler)
+        second = requests_ntlm2.adapters.HttpNtlmAdapter("second", "password", keep_warm=scheduler)
+        first_pool = first.get_connection("https://example.com")
+        second_pool = second.get_connection("https://example.com")
+        try:
+            first.close()
+            # the other adapter's pools are still kept warm
+            assert list(scheduler._pools) == [second_pool]
+            assert first_pool not in scheduler._pools
+            assert scheduler._thread.is_alive()
+            second.close()
+            assert len(scheduler._pools) == 0
+        finally:
+            scheduler.stop()
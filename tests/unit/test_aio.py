@@ -0,0 +1,317 @@
+import asyncio
+import base64
+import ssl
+import struct
+
+import pytest
+import trustme
+
+from requests_ntlm2.aio import AsyncHTTPConnection, AsyncHttpNtlmAuth, open_ntlm_tunnel
+from tests.test_utils import domain, password, username
+
+
+CHALLENGE = (
+    "TlRMTVNTUAACAAAAAwAMADgAAAAzgoriASNFZ4mrze8AAAA"
+    "AAAAAACQAJABEAAAABgBwFwAAAA9TAGUAcgB2AGUAcgACAA"
+    "wARABvAG0AYQBpAG4AAQAMAFMAZQByAHYAZQByAAAAAAA="
+)
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+async def read_request(reader):
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    headers = {}
+    while True:
+        line = (await reader.readline()).decode("latin-1").strip()
+        if not line:
+            break
+        name, _, value = line.partition(":")
+        headers[name.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(headers.get("content-length", "0")))
+    return request_line.decode("latin-1").split()[0], headers, body
+
+
+async def write_response(writer, status, reason, headers, content):
+    lines = ["HTTP/1.1 {} {}".format(status, reason)]
+    lines.extend("{}: {}".format(k, v) for k, v in headers.items())
+    lines.append("Content-Length: {}".format(len(content)))
+    writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + content)
+    await writer.drain()
+
+
+async def pipe(reader, writer):
+    try:
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+    finally:
+        writer.close()
+
+
+class NtlmServer(object):
+    """asyncio stand-in for a server that authenticates connections with NTLM"""
+
+    auth_header = "authorization"
+    challenge_header = "WWW-Authenticate"
+    challenge_status = 401
+
+    def __init__(self, auth_type="NTLM", close_after_challenge=False):
+        self.auth_type = auth_type
+        self.close_after_challenge = close_after_challenge
+        self.requests = []
+        self.connections = 0
+        self.writers = set()
+        self.server = None
+
+    async def start(self, ssl_context=None):
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0, ssl=ssl_context)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+        for writer in list(self.writers):
+            writer.close()
+        while self.writers:
+            await asyncio.sleep(0)
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        self.writers.add(writer)
+        authenticated = False
+        try:
+            while True:
+                request = await read_request(reader)
+                if request is None:
+                    break
+                self.requests.append(request)
+
+                status, response_headers, close = self.respond(request[1], authenticated)
+                authenticated = authenticated or status == 200
+                if status == 200:
+                    await self.write_success(reader, writer)
+                else:
+                    content = b"auth with '%s\\%s':'%s'" % (domain.encode(), username.encode(), password.encode())
+                    await write_response(writer, status, "Unauthorized", response_headers, content)
+                if close:
+                    break
+        finally:
+            writer.close()
+            self.writers.discard(writer)
+
+    async def write_success(self, reader, writer):
+        await write_response(writer, 200, "OK", {}, b"authed")
+
+    def respond(self, headers, authenticated):
+        auth_header = headers.get(self.auth_header, "")
+        if not auth_header:
+            if authenticated:
+                return 200, {}, False
+            return self.challenge_status, {self.challenge_header: self.auth_type}, False
+
+        message = base64.b64decode(auth_header[len(self.auth_type):])
+        assert message[:8] == b"NTLMSSP\x00"
+        message_type = struct.unpack("<I", message[8:12])[0]
+        if message_type == 1:
+            challenge = "{} {}".format(self.auth_type, CHALLENGE)
+            return self.challenge_status, {self.challenge_header: challenge}, self.close_after_challenge
+        assert message_type == 3
+        return 200, {}, False
+
+
+class NtlmProxy(NtlmServer):
+    """asyncio stand-in for a proxy that authenticates CONNECT requests with NTLM"""
+
+    auth_header = "proxy-authorization"
+    challenge_header = "Proxy-Authenticate"
+    challenge_status = 407
+
+    def __init__(self, target_port, **kwargs):
+        super(NtlmProxy, self).__init__(**kwargs)
+        self.target_port = target_port
+
+    async def write_success(self, reader, writer):
+        target_reader, target_writer = await asyncio.open_connection("127.0.0.1", self.target_port)
+        writer.write(b"HTTP/1.0 200 Connection established\r\n\r\n")
+        await asyncio.gather(pipe(reader, target_writer), pipe(target_reader, writer))
+
+
+def get_auth():
+    return AsyncHttpNtlmAuth("{}\\{}".format(domain, username), password)
+
+
+@pytest.mark.parametrize("auth_type", ("NTLM", "Negotiate"))
+def test_ntlm_dance(auth_type):
+    async def main():
+        server = NtlmServer(auth_type)
+        port = await server.start()
+        auth = get_auth()
+        try:
+            async with AsyncHTTPConnection("127.0.0.1", port) as connection:
+                response = await auth.request(connection, "POST", "/ntlm", body=b"data")
+                assert response.status_code == 200
+                assert response.text == "authed"
+                assert [r.status_code for r in response.history] == [401, 401]
+                assert connection.auth_type == auth_type
+                assert connection.session_security is auth.session_security
+
+                # the connection stays authenticated
+                response = await auth.request(connection, "GET", "/ntlm")
+                assert response.status_code == 200
+                assert response.history == []
+        finally:
+            await server.stop()
+
+        assert server.connections == 1
+        assert [method for method, _, _ in server.requests] == ["POST"] * 3 + ["GET"]
+        assert all(body == b"data" for _, _, body in server.requests[:3])
+        assert auth.stats.as_dict() == dict(
+            handshakes=1, failed_handshakes=0, reused_connections=1, expired_connections=0
+        )
+        assert auth.session_security is not None
+
+    run(main())
+
+
+def test_ntlm_dance__concurrent():
+    async def main():
+        server = NtlmServer()
+        port = await server.start()
+        auth = get_auth()
+        connections = [AsyncHTTPConnection("127.0.0.1", port) for _ in range(20)]
+        try:
+            responses = await asyncio.gather(
+                *[auth.request(connection, "GET", "/ntlm") for connection in connections]
+            )
+        finally:
+            for connection in connections:
+                connection.close()
+            await server.stop()
+
+        assert [r.status_code for r in responses] == [200] * 20
+        assert server.connections == 20
+        assert auth.stats.handshakes == 20
+
+    run(main())
+
+
+def test_ntlm_dance__challenge_on_closed_connection():
+    async def main():
+        server = NtlmServer(close_after_challenge=True)
+        port = await server.start()
+        auth = get_auth()
+        try:
+            async with AsyncHTTPConnection("127.0.0.1", port) as connection:
+                response = await auth.request(connection, "GET", "/ntlm")
+        finally:
+            await server.stop()
+
+        assert response.status_code == 401
+        assert auth.stats.failed_handshakes == 1
+
+    run(main())
+
+
+def test_ntlm_dance__not_ntlm():
+    async def main():
+        server = NtlmServer(auth_type="Basic")
+        port = await server.start()
+        try:
+            async with AsyncHTTPConnection("127.0.0.1", port) as connection:
+                response = await get_auth().request(connection, "GET", "/basic")
+        finally:
+            await server.stop()
+
+        assert response.status_code == 401
+        assert len(server.requests) == 1
+
+    run(main())
+
+
+def test_ntlm_dance__cbt():
+    server_context, client_context = get_tls_contexts()
+
+    async def main():
+        server = NtlmServer()
+        port = await server.start(ssl_context=server_context)
+        auth = get_auth()
+        try:
+            async with AsyncHTTPConnection("localhost", port, ssl=client_context) as connection:
+                assert auth._get_cbt_data(connection) is None
+                response = await auth.request(connection, "GET", "/ntlm")
+                cbt_data = auth._get_cbt_data(connection)
+        finally:
+            await server.stop()
+
+        assert response.status_code == 200
+        assert cbt_data is not None
+        assert cbt_data.get_data()
+
+    run(main())
+
+
+def get_tls_contexts():
+    ca = trustme.CA()
+    server_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    ca.issue_server_cert(u"localhost").configure_cert(server_context)
+    client_context = ssl.create_default_context()
+    ca.configure_trust(client_context)
+    return server_context, client_context
+
+
+def test_open_ntlm_tunnel():
+    server_context, client_context = get_tls_contexts()
+
+    async def main():
+        server = NtlmServer()
+        server_port = await server.start(ssl_context=server_context)
+        proxy = NtlmProxy(server_port)
+        proxy_port = await proxy.start()
+        try:
+            reader, writer = await open_ntlm_tunnel(
+                "127.0.0.1", proxy_port, "localhost", server_port,
+                "{}\\{}".format(domain, username), password,
+                ssl=client_context, headers={"User-Agent": "test"}
+            )
+            writer.write(b"GET /ntlm HTTP/1.1\r\nHost: localhost\r\n\r\n")
+            response = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5)
+            writer.close()
+        finally:
+            await proxy.stop()
+            await server.stop()
+
+        assert response.startswith(b"HTTP/1.1 401 Unauthorized\r\n")
+        assert [request[0] for request in proxy.requests] == ["CONNECT"] * 2
+        assert [request[1]["proxy-authorization"][:5] for request in proxy.requests] == ["NTLM "] * 2
+        assert proxy.requests[0][1]["user-agent"] == "test"
+        assert proxy.requests[0][1]["host"] == "localhost:{}".format(server_port)
+        assert server.requests[0][1]["host"] == "localhost"
+
+    run(main())
+
+
+def test_open_ntlm_tunnel__failed():
+    async def main():
+        proxy = NtlmProxy(0, close_after_challenge=True)
+        proxy_port = await proxy.start()
+        try:
+            with pytest.raises(OSError, match="Tunnel connection failed: 407 Unauthorized"):
+                await open_ntlm_tunnel(
+                    "127.0.0.1", proxy_port, "localhost", 443, username, password, ssl=False
+                )
+        finally:
+            await proxy.stop()
+
+    run(main())
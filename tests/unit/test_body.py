@@ -0,0 +1,79 @@
+import io
+
+import requests_ntlm2.body
+
+
+def _generate(chunks):
+    for chunk in chunks:
+        yield chunk
+
+
+class TestReplayableBody(object):
+    def test_replay_from_memory(self):
+        body = requests_ntlm2.body.ReplayableBody(
+            _generate([b"foo", b"", u"bar", b"baz"]), chunk_size=4
+        )
+        assert b"".join(body) == b"foobarbaz"
+        assert body.spooled_size == 9
+        assert body.is_spilled is False
+        assert list(body) == [b"foob", b"arba", b"z"]
+        assert b"".join(body) == b"foobarbaz"
+
+    def test_replay_from_disk(self):
+        chunks = [b"x" * 10, b"y" * 10, b"z" * 10]
+        body = requests_ntlm2.body.ReplayableBody(
+            _generate(chunks), spool_threshold=15, chunk_size=8
+        )
+        assert b"".join(body) == b"".join(chunks)
+        assert body.is_spilled is True
+        replayed = list(body)
+        assert all(len(chunk) <= 8 for chunk in replayed)
+        assert b"".join(replayed) == b"".join(chunks)
+        body.close()
+        assert body.is_spilled is False
+
+    def test_partial_read_is_resumed(self):
+        body = requests_ntlm2.body.ReplayableBody(_generate([b"one", b"two", b"three"]))
+        iterator = iter(body)
+        assert next(iterator) == b"one"
+        del iterator
+        assert b"".join(body) == b"onetwothree"
+
+    def test_file_like_source(self):
+        class Pipe(object):
+            def __init__(self, data):
+                self._fp = io.BytesIO(data)
+
+            def read(self, size=-1):
+                return self._fp.read(size)
+
+        body = requests_ntlm2.body.ReplayableBody(Pipe(b"a" * 100), chunk_size=30)
+        assert [len(chunk) for chunk in body] == [30, 30, 30, 10]
+        assert b"".join(body) == b"a" * 100
+
+    def test_empty_body(self):
+        body = requests_ntlm2.body.ReplayableBody(_generate([]), spool_threshold=0)
+        assert list(body) == []
+        assert list(body) == []
+
+
+def test_is_streaming_body():
+    class NotSeekable(io.RawIOBase):
+        def seekable(self):
+            return False
+
+    assert requests_ntlm2.body.is_streaming_body(None) is False
+    assert requests_ntlm2.body.is_streaming_body(b"data") is False
+    assert requests_ntlm2.body.is_streaming_body(u"data") is False
+    assert requests_ntlm2.body.is_streaming_body([b"data"]) is False
+    assert requests_ntlm2.body.is_streaming_body(io.BytesIO(b"data")) is False
+    assert requests_ntlm2.body.is_streaming_body(NotSeekable()) is True
+    assert requests_ntlm2.body.is_streaming_body(_generate([b"data"])) is True
+    replayable = requests_ntlm2.body.ReplayableBody(_generate([b"data"]))
+    assert requests_ntlm2.body.is_streaming_body(replayable) is False
+
+
+def test_iter_chunks():
+    chunks = list(requests_ntlm2.body.iter_chunks([b"", b"abc", bytearray(b"defghij")], chunk_size=3))
+    assert [bytes(chunk) for chunk in chunks] == [b"abc", b"def", b"ghi", b"j"]
+    assert list(requests_ntlm2.body.iter_chunks(io.BytesIO(b"abcdefg"), chunk_size=4)) == [b"abcd", b"efg"]
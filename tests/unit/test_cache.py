@@ -0,0 +1,63 @@
+import pytest
+
+import requests_ntlm2.cache
+from tests.test_utils import FakeTimer
+
+
+class TestLRUCache(object):
+    def test_init(self):
+        with pytest.raises(ValueError, match="maxsize must be at least 1, got 0"):
+            requests_ntlm2.cache.LRUCache(maxsize=0)
+
+    def test_get_and_set(self):
+        cache = requests_ntlm2.cache.LRUCache(maxsize=2)
+        assert cache.get("a") is None
+        assert cache.get("a", "default") == "default"
+        cache.set("a", 1)
+        assert cache.get("a") == 1
+        assert "a" in cache
+        assert "b" not in cache
+        assert len(cache) == 1
+
+    def test_eviction(self):
+        cache = requests_ntlm2.cache.LRUCache(maxsize=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        assert cache.get("a") == 1  # "b" is now the least recently used
+        cache.set("c", 3)
+        assert len(cache) == 2
+        assert cache.get("b") is None
+        assert cache.get("a") == 1
+        assert cache.get("c") == 3
+
+    def test_ttl(self):
+        timer = FakeTimer()
+        cache = requests_ntlm2.cache.LRUCache(maxsize=2, ttl=10, timer=timer)
+        cache.set("a", 1)
+        timer.now = 9
+        assert cache.get("a") == 1
+        timer.now = 10
+        assert cache.get("a") is None
+        assert len(cache) == 0
+
+        cache.set("b", 2)
+        timer.now = 30
+        assert cache.pop("b") is None
+
+    def test_pop_and_clear(self):
+        cache = requests_ntlm2.cache.LRUCache()
+        cache.set("a", 1)
+        cache.set("b", 2)
+        assert cache.pop("a") == 1
+        assert cache.pop("a", "default") == "default"
+        cache.clear()
+        assert len(cache) == 0
+
+    def test_hits_and_misses(self):
+        cache = requests_ntlm2.cache.LRUCache()
+        cache.get("a")
+        cache.set("a", 1)
+        cache.get("a")
+        cache.get("a")
+        assert cache.hits == 2
+        assert cache.misses == 1
@@ -1,13 +1,24 @@
+import logging
 import socket
 import sys
-import tempfile
 import unittest
 
 import faker
 import mock
-from six.moves.http_client import LineTooLong
-
-from requests_ntlm2.connection import _MAXLINE, VerifiedHTTPSConnection
+import pytest
+from requests.packages.urllib3.response import HTTPResponse
+from six.moves.http_client import BadStatusLine, HTTPException, LineTooLong
+
+from requests_ntlm2 import clock
+from requests_ntlm2.connection import (
+    _MAXLINE,
+    TunnelResponseReader,
+    VerifiedHTTPSConnection,
+    read_headers
+)
+from requests_ntlm2.keepalive import KeepAliveTracker, default_keep_alive_tracker
+from requests_ntlm2.limiter import HandshakeLimiter
+from requests_ntlm2.tunnels import TunnelPool
 
 
 try:
@@ -134,10 +145,9 @@ class TestVerifiedHTTPSConnection(unittest.TestCase):
         with self.assertRaises(AttributeError):
             self.conn._tunnel()
 
-    @mock.patch("requests_ntlm2.connection.select.select")
     @mock.patch("requests_ntlm2.connection.VerifiedHTTPSConnection._get_response")
     @mock.patch("requests_ntlm2.connection.VerifiedHTTPSConnection.send")
-    def test__tunnel__line_too_long(self, mock_send, mock_get_response, mock_select):
+    def test__tunnel__line_too_long(self, mock_send, mock_get_response):
         fp = BytesIO(
             b"Proxy-Authenticate: NTLM TlRMTVNTUAACAAAABgAGADgAAAAGgokAyYpGWqVMA/QAAAAAAAAA"
             b"AH4AfgA+AAAABQCTCAAAAA9ERVROU1cCAAwARABFAFQATgBTAFcAAQAaAFMARwAtADQAOQAxADMAM"
@@ -153,7 +163,6 @@ class TestVerifiedHTTPSConnection(unittest.TestCase):
         )
         response = type("Response", (), dict(fp=fp))
         mock_get_response.return_value = "HTTP/1.1", 407, "Proxy Authentication Required", response
-        mock_select.return_value = [(True), (), ()]
         self.conn.set_ntlm_auth_credentials(r"DOMAIN\username", "password")
 
         with self.assertRaises(LineTooLong):
@@ -165,15 +174,13 @@ class TestVerifiedHTTPSConnection(unittest.TestCase):
         with self.assertRaises(LineTooLong):
             self.conn._tunnel()
 
-    @mock.patch("requests_ntlm2.connection.select.select")
     @mock.patch("requests_ntlm2.connection.VerifiedHTTPSConnection._get_response")
     @mock.patch("requests_ntlm2.connection.VerifiedHTTPSConnection.send")
-    def test_tunnel__no_headers(self, mock_send, mock_get_response, mock_select):
+    def test_tunnel__no_headers(self, mock_send, mock_get_response):
         fp = BytesIO()
         response = type("Response", (), dict(fp=fp))
 
         mock_get_response.return_value = "HTTP/1.1", 407, "Proxy Authentication Required", response
-        mock_select.return_value = [(True), (), ()]
         username = self.fake.user_name()
         password = self.fake.password()
         self.conn.set_ntlm_auth_credentials(username, password)
@@ -187,15 +194,13 @@ class TestVerifiedHTTPSConnection(unittest.TestCase):
         self.assertEqual(mock_get_response.call_count, 2)
         self.assertEqual(mock_send.call_count, 2)
 
-    @mock.patch("requests_ntlm2.connection.select.select")
     @mock.patch("requests_ntlm2.connection.VerifiedHTTPSConnection._get_response")
     @mock.patch("requests_ntlm2.connection.VerifiedHTTPSConnection.send")
-    def test_tunnel__no_proxy_auth_required(self, mock_send, mock_get_response, mock_select):
+    def test_tunnel__no_proxy_auth_required(self, mock_send, mock_get_response):
         fp = BytesIO()
         response = type("Response", (), dict(fp=fp))
 
         mock_get_response.return_value = "HTTP/1.1", 200, "Success", response
-        mock_select.return_value = [(True), (), ()]
         username = self.fake.user_name()
         password = self.fake.password()
         self.conn.set_ntlm_auth_credentials(username, password)
@@ -207,10 +212,9 @@ class TestVerifiedHTTPSConnection(unittest.TestCase):
         self.assertEqual(mock_get_response.call_count, 1)
         self.assertEqual(mock_send.call_count, 1)
 
-    @mock.patch("requests_ntlm2.connection.select.select")
     @mock.patch("requests_ntlm2.connection.VerifiedHTTPSConnection._get_response")
     @mock.patch("requests_ntlm2.connection.VerifiedHTTPSConnection.send")
-    def test_tunnel(self, mock_send, mock_get_response, mock_select):
+    def test_tunnel(self, mock_send, mock_get_response):
         fp = BytesIO(
             b"Proxy-Authenticate: NTLM TlRMTVNTUAACAAAABgAGADgAAAAGgokAyYpGWqVMA/QAAAAAAAAA"
             b"AH4AfgA+AAAABQCTCAAAAA9ERVROU1cCAAwARABFAFQATgBTAFcAAQAaAFMARwAtADQAOQAxADMAM"
@@ -226,8 +230,6 @@ class TestVerifiedHTTPSConnection(unittest.TestCase):
 
         response = type("Response", (), dict(fp=fp))
 
-        mock_select.return_value = [(True), (), ()]
-
         def return_407():
             return "HTTP/1.1", 407, "Proxy Authentication Required", response
 
@@ -246,10 +248,9 @@ class TestVerifiedHTTPSConnection(unittest.TestCase):
         self.assertEqual(mock_get_response.call_count, 2)
         self.assertEqual(mock_send.call_count, 2)
 
-    @mock.patch("requests_ntlm2.connection.select.select")
     @mock.patch("requests_ntlm2.connection.VerifiedHTTPSConnection._get_response")
     @mock.patch("requests_ntlm2.connection.VerifiedHTTPSConnection.send")
-    def test_tunnel__no_continue_read_headers(self, mock_send, mock_get_response, mock_select):
+    def test_tunnel__no_continue_read_headers(self, mock_send, mock_get_response):
         fp = BytesIO(
             b"Proxy-Authenticate: NTLM TlRMTVNTUAACAAAABgAGADgAAAAGgokAyYpGWqVMA/QAAAAAAAAA"
             b"AH4AfgA+AAAABQCTCAAAAA9ERVROU1cCAAwARABFAFQATgBTAFcAAQAaAFMARwAtADQAOQAxADMAM"
@@ -265,8 +266,6 @@ class TestVerifiedHTTPSConnection(unittest.TestCase):
 
         response = type("Response", (), dict(fp=fp))
 
-        mock_select.return_value = [(True), (), ()]
-
         def return_407():
             return "HTTP/1.1", 407, "Proxy Authentication Required", response
 
@@ -288,10 +287,9 @@ class TestVerifiedHTTPSConnection(unittest.TestCase):
         self.assertEqual(mock_send.call_count, 2)
         self.conn._continue_reading_headers = continue_reading_headers
 
-    @mock.patch("requests_ntlm2.connection.select.select")
     @mock.patch("requests_ntlm2.connection.VerifiedHTTPSConnection._get_response")
     @mock.patch("requests_ntlm2.connection.VerifiedHTTPSConnection.send")
-    def test_tunnel_only_headers(self, mock_send, mock_get_response, mock_select):
+    def test_tunnel_only_headers(self, mock_send, mock_get_response):
         fp = BytesIO(
             b"Proxy-Authenticate: NTLM TlRMTVNTUAACAAAABgAGADgAAAAGgokAyYpGWqVMA/QAAAAAAAAA"
             b"AH4AfgA+AAAABQCTCAAAAA9ERVROU1cCAAwARABFAFQATgBTAFcAAQAaAFMARwAtADQAOQAxADMAM"
@@ -304,8 +302,6 @@ class TestVerifiedHTTPSConnection(unittest.TestCase):
 
         response = type("Response", (), dict(fp=fp))
 
-        mock_select.return_value = [(True), (), ()]
-
         def return_407():
             return "HTTP/1.1", 407, "authenticationrequired", response
 
@@ -324,18 +320,36 @@ class TestVerifiedHTTPSConnection(unittest.TestCase):
         self.assertEqual(mock_get_response.call_count, 2)
         self.assertEqual(mock_send.call_count, 2)
 
-    @mock.patch("requests.packages.urllib3.connection.VerifiedHTTPSConnection.response_class")
-    def test__get_response(self, mock_response_class):
-        mock_response_class.return_value._read_status.return_value = (1, 2, 3)
+    def test__remember_tunnel_result(self):
+        self.conn._remember_tunnel_result(mock.MagicMock(), 200)  # no host cache
+
+        host_cache = mock.MagicMock()
+        host_cache.get.return_value = None
+        self.conn.set_host_cache(host_cache)
+        self.addCleanup(self.conn.clear_host_cache)
+
+        self.conn._remember_tunnel_result(mock.MagicMock(challenge_fixed=True), 407)
+        host_cache.update.assert_called_once_with("http://srv-93.shaw.com:6789", strict_mode=True)
+
+        host_cache.reset_mock()
+        self.conn._remember_tunnel_result(mock.MagicMock(challenge_fixed=False), 407)
+        host_cache.update.assert_not_called()
+
+        self.conn._remember_tunnel_result(mock.MagicMock(challenge_fixed=False), 200)
+        host_cache.update.assert_called_once_with("http://srv-93.shaw.com:6789", auth_type="NTLM")
+
+    @mock.patch("requests_ntlm2.connection.TunnelResponseReader.read_status")
+    def test__get_response(self, mock_read_status):
+        mock_read_status.return_value = (1, 2, 3)
         response = self.conn._get_response()
         self.assertIsInstance(response, tuple)
         self.assertEqual(len(response), 4)
         self.assertEqual(response[:3], (1, 2, 3))
 
-    @mock.patch("requests.packages.urllib3.connection.VerifiedHTTPSConnection.response_class")
+    @mock.patch("requests_ntlm2.connection.TunnelResponseReader.read_status")
     @mock.patch("requests_ntlm2.connection.VerifiedHTTPSConnection.handle_http09_response")
-    def test__get_response__http09(self, mock_handle_http09_response, mock_response_class):
-        mock_response_class.return_value._read_status.return_value = ("HTTP/0.9", 200, "")
+    def test__get_response__http09(self, mock_handle_http09_response, mock_read_status):
+        mock_read_status.return_value = ("HTTP/0.9", 200, "")
         mock_handle_http09_response.return_value = None
         response = self.conn._get_response()
         self.assertIsInstance(response, tuple)
@@ -343,10 +357,10 @@ class TestVerifiedHTTPSConnection(unittest.TestCase):
         self.assertEqual(response[:3], ("HTTP/0.9", 200, ""))
         mock_handle_http09_response.assert_called_once()
 
-    @mock.patch("requests.packages.urllib3.connection.VerifiedHTTPSConnection.response_class")
+    @mock.patch("requests_ntlm2.connection.TunnelResponseReader.read_status")
     @mock.patch("requests_ntlm2.connection.VerifiedHTTPSConnection.handle_http09_response")
-    def test__get_response__http09_status(self, mock_handle_http09_response, mock_response_class):
-        mock_response_class.return_value._read_status.return_value = ("HTTP/0.9", 200, "")
+    def test__get_response__http09_status(self, mock_handle_http09_response, mock_read_status):
+        mock_read_status.return_value = ("HTTP/0.9", 200, "")
         mock_handle_http09_response.return_value = (10, 20, 30)
         response = self.conn._get_response()
         self.assertIsInstance(response, tuple)
@@ -425,102 +439,6 @@ class TestVerifiedHTTPSConnection(unittest.TestCase):
         status_line = self.conn.handle_http09_response(response)
         self.assertIsNone(status_line)
 
-    def test__read_response_line_if_ready(self):
-        data = (
-            b"<!DOCTYPE html>\r\n"
-            b"<html class='#{theme}' lang='en'>\r\n"
-            b"<head data-theme='#{theme}' data-revision='865b887'>\r\n"
-            b"<meta charset='utf-8'/>\r\n"
-            b"<meta http-equiv='X-UA-Compatible' content='IE=edge'/>\r\n"
-            b"<meta name='viewport' content='width=device-width, initial-scale=1'/>\r\n"
-            b"<base/>\r\n"
-            b"<title>401 Unauthorised</title><!--[if lt IE 9]>\r\n"
-            b"<script src=\'https://oss.maxcdn.com/html5shiv/3.7.2/html5shiv.min.js\' type=\'text/javascript\' />\r\n"  # noqa
-            b"<script src=\'https://oss.maxcdn.com/respond/1.4.2/respond.min.js\' type=\'text/javascript\' />\r\n"  # noqa
-            b"<![endif]-->\r\n"
-            b"<script type='text/javascript'>\r\n"
-            b"function showURL()\r\n"
-            b"{\r\n"
-            b"document.write('<a href=\"mailto:itweb-admin@abc.def.com?subject=Proxy Authentication\">EDConnect</a>');\r\n"  # noqa
-            b"}\r\n"
-            b"\r\n"
-            b"function URL()\r\n"
-            b"{\r\n"
-            b"document.write(document.URL);\r\n"
-            b"}\r\n"
-            b"</script>\r\n"
-            b"<style media='screen'>\r\n"
-            b"</div>\r\n"
-            b"</div>\r\n"
-            b"</div>\r\n"
-            b"</aside></body>\r\n"
-            b"</html>\r\n"
-        )
-        with tempfile.TemporaryFile() as fd:
-            fd.write(data)
-            fd.seek(0)
-            response = type("Response", (), dict(fp=fd))
-            line = self.conn._read_response_line_if_ready(response)
-            assert line == b"<!DOCTYPE html>\r\n"
-
-        with tempfile.TemporaryFile() as fd:
-            fd.write(data)
-            fd.seek(0)
-            response = type("Response", (), dict(fp=fd))
-            with mock.patch("select.select", return_value=((), (), ())) as mock_select:
-                line = self.conn._read_response_line_if_ready(response)
-                assert line is None
-                mock_select.assert_called_once_with([response.fp], (), (), 0.1)
-
-    def test__flush_response_buffer(self):
-        data = (
-            b"<!DOCTYPE html>\r\n"
-            b"<html class='#{theme}' lang='en'>\r\n"
-            b"<head data-theme='#{theme}' data-revision='865b887'>\r\n"
-            b"<meta charset='utf-8'/>\r\n"
-            b"<meta http-equiv='X-UA-Compatible' content='IE=edge'/>\r\n"
-            b"<meta name='viewport' content='width=device-width, initial-scale=1'/>\r\n"
-            b"<base/>\r\n"
-            b"<title>401 Unauthorised</title><!--[if lt IE 9]>\r\n"
-            b"<script src=\'https://oss.maxcdn.com/html5shiv/3.7.2/html5shiv.min.js\' type=\'text/javascript\' />\r\n"  # noqa
-            b"<script src=\'https://oss.maxcdn.com/respond/1.4.2/respond.min.js\' type=\'text/javascript\' />\r\n"  # noqa
-            b"<![endif]-->\r\n"
-            b"<script type='text/javascript'>\r\n"
-            b"function showURL()\r\n"
-            b"{\r\n"
-            b"document.write('<a href=\"mailto:itweb-admin@abc.def.com?subject=Proxy Authentication\">EDConnect</a>');\r\n"  # noqa
-            b"}\r\n"
-            b"\r\n"
-            b"function URL()\r\n"
-            b"{\r\n"
-            b"document.write(document.URL);\r\n"
-            b"}\r\n"
-            b"</script>\r\n"
-            b"<style media='screen'>\r\n"
-            b"</div>\r\n"
-            b"</div>\r\n"
-            b"</div>\r\n"
-            b"</aside></body>\r\n"
-            b"</html>\r\n"
-        )
-        with tempfile.TemporaryFile() as fd:
-            fd.write(data)
-            fd.seek(0)
-            response = type("Response", (), dict(fp=fd))
-            result = self.conn._flush_response_buffer(response)
-            assert result is None
-            assert fd.read() == b""
-
-        with tempfile.TemporaryFile() as fd:
-            fd.write(data)
-            fd.seek(0)
-            response = type("Response", (), dict(fp=fd))
-            with mock.patch("select.select", return_value=((), (), ())) as mock_select:
-                result = self.conn._flush_response_buffer(response)
-                assert result is None
-                mock_select.assert_called_once_with([response.fp], (), (), 0.1)
-                assert fd.read() == data
-
     def test_set_http_version(self):
         self.assertFalse(hasattr(self.conn, "_http_version"))
         self.assertIsNone(self.conn.set_http_version("HTTP/1.0"))
@@ -544,6 +462,319 @@ class TestVerifiedHTTPSConnection(unittest.TestCase):
         self.assertFalse(hasattr(self.conn, "_http_version"))
 
 
+CHALLENGE_HEADER = (
+    b"Proxy-Authenticate: NTLM TlRMTVNTUAACAAAABgAGADgAAAAGgokAyYpGWqVMA/QAAAAAAAAA"
+    b"AH4AfgA+AAAABQCTCAAAAA9ERVROU1cCAAwARABFAFQATgBTAFcAAQAaAFMARwAtADQAOQAxADMAM"
+    b"wAwADAAMAAwADkABAAUAEQARQBUAE4AUwBXAC4AVwBJAE4AAwAwAHMAZwAtADQAOQAxADMAMwAwAD"
+    b"AAMAAwADkALgBkAGUAdABuAHMAdwAuAHcAaQBuAAAAAAA=\r\n"
+)
+
+
+class TestTunnelResponseReader(unittest.TestCase):
+    def setUp(self):
+        self.sock, self.peer = socket.socketpair()
+        self.sock.settimeout(5)
+        self.addCleanup(self.sock.close)
+        self.addCleanup(self.peer.close)
+
+    def test_readline(self):
+        reader = TunnelResponseReader(self.sock, recv_size=4)
+        self.peer.sendall(b"HTTP/1.1 200 OK\r\nServer: x\r\n\r\nrest")
+        self.assertEqual(reader.read_status(), ("HTTP/1.1", 200, "OK"))
+        self.assertEqual(reader.readline(), b"Server: x\r\n")
+        self.assertEqual(reader.readline(), b"\r\n")
+        self.assertEqual(reader.read(2), b"re")
+        self.peer.close()
+        self.assertEqual(reader.readline(), b"st")
+        self.assertEqual(reader.readline(), b"")
+        self.assertEqual(reader.read(2), b"")
+
+    def test_readline__too_long(self):
+        reader = TunnelResponseReader(self.sock)
+        self.peer.sendall(b"x" * (_MAXLINE + 10))
+        with self.assertRaises(LineTooLong):
+            reader.readline()
+
+    def test_readline__timeout(self):
+        self.sock.settimeout(0.01)
+        with self.assertRaises(socket.timeout):
+            TunnelResponseReader(self.sock).readline()
+
+    def test_read_status(self):
+        reader = TunnelResponseReader(self.sock)
+        self.peer.sendall(b"HTTP/1.0 407\r\n<html>\r\nHTTP/1.1 abc Bad\r\n")
+        self.assertEqual(reader.read_status(), ("HTTP/1.0", 407, ""))
+        self.assertEqual(reader.read_status(), ("HTTP/0.9", 200, ""))
+        with self.assertRaises(BadStatusLine):
+            reader.read_status()
+        self.peer.close()
+        with self.assertRaises(BadStatusLine):
+            reader.read_status()
+
+    @mock.patch("requests_ntlm2.connection.VerifiedHTTPSConnection.send")
+    def test_tunnel(self, mock_send):
+        body = b"<html>" + b"x" * 20000 + b"</html>"
+        self.peer.sendall(
+            b"HTTP/1.1 407 Proxy Authentication Required\r\n"
+            b"Proxy-Authenticate: Negotiate\r\n"
+            + CHALLENGE_HEADER
+            + b"Content-Length: %d\r\n" % len(body)
+            + b"Proxy-Connection: Keep-Alive\r\n"
+            b"Keep-Alive: timeout=30, max=100\r\n"
+            b"\r\n"
+            + body
+            + b"HTTP/1.1 200 Connection established\r\n"
+            b"Keep-Alive: timeout=20\r\n"
+            b"\r\n"
+        )
+        tracker = KeepAliveTracker()
+        connection_cls = VerifiedHTTPSConnection.with_ntlm_settings(
+            r"DOMAIN\username", "password", keep_alive_tracker=tracker
+        )
+        conn = connection_cls("srv-93.shaw.com", port=6789)
+        conn.set_tunnel("email-20.henry-burgess.com", 8080)
+        conn.sock = self.sock
+
+        conn._tunnel()
+
+        self.assertEqual(tracker.get_idle_timeout("http://srv-93.shaw.com:6789"), 20)
+        self.assertEqual(mock_send.call_count, 2)
+        self.assertIn(b"Proxy-Authorization: NTLM ", mock_send.call_args[0][0])
+        self.peer.sendall(b"next")
+        self.assertEqual(self.sock.recv(4), b"next")
+
+
+class TestTunnelPooling(unittest.TestCase):
+    def setUp(self):
+        self.sock, self.peer = socket.socketpair()
+        self.sock.settimeout(5)
+        self.addCleanup(self.sock.close)
+        self.addCleanup(self.peer.close)
+
+        self.pool = TunnelPool()
+        VerifiedHTTPSConnection.set_tunnel_pool(self.pool)
+        self.addCleanup(VerifiedHTTPSConnection.clear_tunnel_pool)
+        VerifiedHTTPSConnection.set_ntlm_auth_credentials(r"DOMAIN\username", "password")
+        self.addCleanup(VerifiedHTTPSConnection.clear_ntlm_auth_credentials)
+        self.tracker = KeepAliveTracker(idle_close_observations=1)
+        VerifiedHTTPSConnection.ntlm_keep_alive_tracker = self.tracker
+        self.addCleanup(setattr, VerifiedHTTPSConnection, "ntlm_keep_alive_tracker", default_keep_alive_tracker)
+
+        patcher = mock.patch("requests_ntlm2.connection._VerifiedHTTPSConnection.connect", autospec=True)
+        self.mock_connect = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.mock_connect.side_effect = lambda conn: setattr(conn, "sock", self.sock)
+
+    def get_connection(self, host="target"):
+        conn = VerifiedHTTPSConnection("proxy", port=6789, timeout=5)
+        conn.set_tunnel(host, 443)
+        return conn
+
+    @staticmethod
+    def send_request(conn):
+        try:
+            # urllib3 2.x would otherwise read the body of the response in getresponse
+            conn.request("GET", "/", preload_content=False)
+        except TypeError:
+            conn.request("GET", "/")
+
+    def test_reuse(self):
+        conn = self.get_connection()
+        conn.connect()
+        conn.close()
+        self.assertIsNone(conn.sock)
+        self.assertEqual(len(self.pool), 1)
+
+        other = self.get_connection(host="other")
+        other.connect()
+        self.assertEqual(self.mock_connect.call_count, 2)
+        other.sock = None
+
+        conn = self.get_connection()
+        conn.connect()
+        self.assertIs(conn.sock, self.sock)
+        self.assertEqual(conn.auto_open, 0)
+        self.assertEqual(self.mock_connect.call_count, 2)
+        self.assertEqual(len(self.pool), 0)
+
+    def test_reuse__after_response(self):
+        conn = self.get_connection()
+        conn.connect()
+        self.send_request(conn)
+        self.peer.sendall(b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok")
+        self.assertEqual(conn.getresponse().read(), b"ok")
+        conn.close()
+        self.assertEqual(len(self.pool), 1)
+
+        # urllib3 2.x forgets the tunnel of a closed connection, and sets it again
+        conn = self.get_connection()
+        conn.connect()
+        self.assertEqual(self.mock_connect.call_count, 1)
+        self.send_request(conn)
+        self.peer.sendall(b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok")
+        response = conn.getresponse()
+        conn.close()
+        self.assertEqual(len(self.pool), 0)  # the body has not been read
+        response.close()
+
+    def test_reuse__urllib3_2_response(self):
+        conn = self.get_connection()
+        conn.connect()
+        original_response = mock.Mock(spec=["will_close"], will_close=False)
+        # the responses of urllib3 2.x wrap the one of http.client, without its will_close
+        response = HTTPResponse(body=BytesIO(b""), original_response=original_response, preload_content=False)
+        with mock.patch("requests_ntlm2.connection._VerifiedHTTPSConnection.getresponse", return_value=response):
+            self.assertIs(conn.getresponse(), response)
+        self.assertTrue(conn._tunnel_reusable)
+
+        original_response.will_close = True
+        with mock.patch("requests_ntlm2.connection._VerifiedHTTPSConnection.getresponse", return_value=response):
+            conn.getresponse()
+        self.assertFalse(conn._tunnel_reusable)
+
+    def test_getresponse__no_tunnel_pool(self):
+        VerifiedHTTPSConnection.clear_tunnel_pool()
+        conn = self.get_connection()
+        conn.connect()
+        response = mock.Mock(spec=[])
+        with mock.patch("requests_ntlm2.connection._VerifiedHTTPSConnection.getresponse", return_value=response):
+            self.assertIs(conn.getresponse(), response)
+
+    def test_no_reuse__connection_close(self):
+        conn = self.get_connection()
+        conn.connect()
+        self.send_request(conn)
+        self.peer.sendall(b"HTTP/1.1 200 OK\r\nConnection: close\r\nContent-Length: 2\r\n\r\nok")
+        self.assertEqual(conn.getresponse().read(), b"ok")
+        conn.close()
+        self.assertEqual(len(self.pool), 0)
+
+    def test_no_reuse__closed_by_proxy(self):
+        conn = self.get_connection()
+        conn.connect()
+        self.peer.close()
+        conn.close()
+        self.assertEqual(len(self.pool), 0)
+
+    def test_pooled_tunnel_closed_by_proxy(self):
+        conn = self.get_connection()
+        conn.connect()
+        conn.close()
+        self.peer.close()
+
+        conn = self.get_connection()
+        conn.connect()
+        self.assertEqual(self.mock_connect.call_count, 2)
+        self.assertEqual(len(self.pool), 0)
+
+    def test_pooled_tunnel_expiring(self):
+        conn = self.get_connection()
+        conn.connect()
+        conn.close()
+        self.assertEqual(len(self.pool), 1)
+        # the proxy would close the tunnel right away
+        self.tracker.observe_headers("http://proxy:6789", {"keep-alive": "timeout=0"})
+
+        conn = self.get_connection()
+        conn.connect()
+        self.assertEqual(self.mock_connect.call_count, 2)
+        self.assertEqual(len(self.pool), 0)
+
+    def test_pooled_tunnel_closed_by_proxy__learnt(self):
+        conn = self.get_connection()
+        conn.connect()
+        conn.close()
+        self.peer.close()
+
+        conn = self.get_connection()
+        with mock.patch("requests_ntlm2.clock.now", return_value=clock.now() + 42):
+            conn.connect()
+        self.assertEqual(self.mock_connect.call_count, 2)
+        self.assertAlmostEqual(self.tracker.get_idle_timeout("http://proxy:6789"), 42, delta=1)
+
+    def test_retire(self):
+        conn = self.get_connection()
+        conn.connect()
+        conn.retire()
+        self.assertIsNone(conn.sock)
+        self.assertEqual(len(self.pool), 0)
+
+    def test_handshake_limiter(self):
+        limiter = HandshakeLimiter(max_per_host=1)
+        VerifiedHTTPSConnection.ntlm_handshake_limiter = limiter
+        self.addCleanup(setattr, VerifiedHTTPSConnection, "ntlm_handshake_limiter", None)
+        conn = self.get_connection()
+        conn.connect()
+        self.assertEqual(limiter.in_flight, 0)
+
+        acquire = limiter.acquire
+
+        def wait_for_other_connection(authority):
+            # the other connection is done with its tunnel while this one waits
+            conn.close()
+            acquire(authority)
+            return True
+
+        other = self.get_connection()
+        with mock.patch.object(limiter, "acquire", side_effect=wait_for_other_connection):
+            other.connect()
+        self.assertEqual(self.mock_connect.call_count, 1)
+        self.assertIs(other.sock, self.sock)
+        self.assertEqual(limiter.in_flight, 0)
+
+    def test_handshake_limiter__shared_with_auth(self):
+        # the auth holds a slot for the server while the negotiate leg opens a new tunnel
+        limiter = HandshakeLimiter(max_total=1, timeout=1)
+        VerifiedHTTPSConnection.ntlm_handshake_limiter = limiter
+        self.addCleanup(setattr, VerifiedHTTPSConnection, "ntlm_handshake_limiter", None)
+        conn = self.get_connection()
+        with limiter.slot("https://target"):
+            conn.connect()
+            self.assertEqual(limiter.waits, 0)
+        self.assertIs(conn.sock, self.sock)
+        self.assertEqual(limiter.in_flight, 0)
+
+    def test_no_pool(self):
+        VerifiedHTTPSConnection.clear_tunnel_pool()
+        conn = self.get_connection()
+        conn.connect()
+        conn.close()
+        self.assertEqual(len(self.pool), 0)
+
+
+def test_read_headers():
+    fp = BytesIO(
+        b"Proxy-Authenticate: Negotiate\r\n"
+        + CHALLENGE_HEADER
+        + b"content-length:  12 \r\n"
+        b"X-Custom: a:b\r\n"
+        b"\r\n"
+        b"Body: not a header\r\n"
+    )
+    with mock.patch("requests_ntlm2.connection.logger") as mock_logger:
+        headers = read_headers(fp)
+
+    assert len(headers) == 4
+    assert headers.get("Proxy-Authenticate") == "Negotiate"
+    assert headers.get_all("proxy-authenticate")[1].startswith("NTLM TlRMTVNTUAACAAAABgAGADgAAAAGgok")
+    assert headers.content_length == 12
+    assert headers.get("x-custom") == "a:b"
+    assert "body" not in headers
+    assert headers.get("body", "default") == "default"
+    assert [c[0][0] for c in mock_logger.log.call_args_list] == [logging.DEBUG, logging.DEBUG, logging.INFO]
+    assert fp.read() == b"Body: not a header\r\n"
+
+
+def test_read_headers__limits():
+    with pytest.raises(HTTPException):
+        read_headers(BytesIO(b"X-Header: value\r\n" * 101))
+    with pytest.raises(LineTooLong):
+        read_headers(BytesIO(b"X-Header: %s\r\n" % (b"x" * _MAXLINE)))
+
+    headers = read_headers(BytesIO(b"Content-Length: x\r\n"))
+    assert headers.content_length == 0
+
+
 def test_import_error():
     with mock.patch("requests_ntlm2.core.noop") as mock_noop:
         mock_noop.side_effect = ImportError()
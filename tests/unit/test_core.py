@@ -1,10 +1,17 @@
 import base64
+import io
 import struct
 
 import faker
 import mock
 import ntlm_auth.gss_channel_bindings
+import ntlm_auth.messages
+import pytest
 import trustme
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.serialization import Encoding
+import requests
 from requests.packages.urllib3.response import HTTPResponse
 
 import requests_ntlm2.core
@@ -45,6 +52,36 @@ class TestCoreFunctions(object):
             b"tls-server-end-point:"
         )
 
+    def test_get_cached_certificate_hash_bytes(self):
+        certificate = x509.load_pem_x509_certificate(
+            trustme.CA().cert_pem.bytes(), default_backend()
+        )
+        certificate_der = certificate.public_bytes(Encoding.DER)
+        expected_hash = requests_ntlm2.core.get_certificate_hash_bytes(certificate_der)
+
+        cache = requests_ntlm2.core.certificate_hash_cache
+        hits = cache.hits
+        spec = "requests_ntlm2.core.get_certificate_hash_bytes"
+        with mock.patch(spec, wraps=requests_ntlm2.core.get_certificate_hash_bytes) as mock_hash:
+            for _ in range(3):
+                assert requests_ntlm2.core.get_cached_certificate_hash_bytes(
+                    certificate_der
+                ) == expected_hash
+        mock_hash.assert_called_once_with(certificate_der)
+        assert cache.hits == hits + 2
+
+    @mock.patch("requests_ntlm2.core.get_server_cert")
+    def test_get_cbt_data__cached(self, mock_get_server_cert):
+        cert_hash_bytes = b"\x01" * 32
+        mock_get_server_cert.return_value = cert_hash_bytes
+        cbt_data = requests_ntlm2.core.get_cbt_data(HTTPResponse())
+        assert isinstance(cbt_data, ntlm_auth.gss_channel_bindings.GssChannelBindingsStruct)
+        assert requests_ntlm2.core.get_cbt_data(HTTPResponse()) is cbt_data
+
+        expected = ntlm_auth.gss_channel_bindings.GssChannelBindingsStruct()
+        expected[expected.APPLICATION_DATA] = b"tls-server-end-point:" + cert_hash_bytes
+        assert cbt_data.get_data() == expected.get_data()
+
     def test_get_ntlm_credentials(self):
         fake = faker.Factory.create()
         username = fake.user_name()
@@ -91,6 +128,182 @@ class TestCoreFunctions(object):
         assert response is not None
         mock_get_certificate_hash_bytes.assert_called_once()
 
+    def test_get_response_socket(self):
+        raw = HTTPResponse()
+        raw._fp = mock.MagicMock()
+        response = type("Response", (), {"raw": raw})
+        sock = requests_ntlm2.core.get_response_socket(response)
+        assert sock is not None
+
+        response = type("Response", (), {"raw": HTTPResponse()})
+        assert requests_ntlm2.core.get_response_socket(response) is None
+
+        response = type("Response", (), {"raw": None})
+        assert requests_ntlm2.core.get_response_socket(response) is None
+
+    def test_response_will_close(self):
+        original_response = mock.Mock(will_close=False)
+        assert requests_ntlm2.core.response_will_close(original_response) is False
+        original_response.will_close = True
+        assert requests_ntlm2.core.response_will_close(original_response) is True
+
+        # the responses of urllib3 2.x connections wrap the one of http.client
+        response = HTTPResponse(body=io.BytesIO(b""), original_response=original_response, preload_content=False)
+        assert requests_ntlm2.core.response_will_close(response) is True
+        original_response.will_close = False
+        assert requests_ntlm2.core.response_will_close(response) is False
+        response = HTTPResponse(body=original_response, preload_content=False)
+        assert requests_ntlm2.core.response_will_close(response) is False
+        assert requests_ntlm2.core.response_will_close(HTTPResponse()) is True
+
+    def test_get_url_authority(self):
+        assert requests_ntlm2.core.get_url_authority(
+            "https://Example.com:8443/path?q=1"
+        ) == "https://example.com:8443"
+        assert requests_ntlm2.core.get_url_authority(
+            "http://example.com/path"
+        ) == "http://example.com"
+        assert requests_ntlm2.core.get_url_authority(None) == "://"
+        # the default port of the scheme is dropped, so a host has one authority
+        assert requests_ntlm2.core.get_url_authority(
+            "HTTP://Example.com:80/path"
+        ) == "http://example.com"
+        assert requests_ntlm2.core.get_url_authority(
+            "https://[::1]:443"
+        ) == "https://[::1]"
+        assert requests_ntlm2.core.get_url_authority(
+            "http://example.com:port"
+        ) == "http://example.com:port"
+
+    @pytest.mark.parametrize("args, authority", [
+        (("https", "Example.com", 443), "https://example.com"),
+        (("http", "example.com", 80), "http://example.com"),
+        (("http", "example.com", 8080), "http://example.com:8080"),
+        (("https", "example.com", None), "https://example.com"),
+        (("https", "::1", 8443), "https://[::1]:8443"),
+    ])
+    def test_get_authority(self, args, authority):
+        assert requests_ntlm2.core.get_authority(*args) == authority
+
+    def test_drain_response(self):
+        def get_response(body, headers=None):
+            response = requests.Response()
+            response.raw = HTTPResponse(
+                body=io.BytesIO(body), headers=headers, preload_content=False
+            )
+            response.headers = response.raw.headers
+            return response
+
+        response = get_response(b"x" * 100)
+        with mock.patch.object(response.raw, "close") as mock_close:
+            assert requests_ntlm2.core.drain_response(response, chunk_size=8) is True
+        mock_close.assert_not_called()
+        assert response.raw.tell() == 100
+        assert response.content == b""
+
+        response = get_response(b"x" * 100)
+        assert requests_ntlm2.core.drain_response(response, max_bytes=50, chunk_size=8) is False
+        assert response.raw.closed is True
+        assert response.content == b""
+
+        response = get_response(b"x" * 100, headers={"Content-Length": "100"})
+        with mock.patch.object(response.raw, "read") as mock_read:
+            assert requests_ntlm2.core.drain_response(response, max_bytes=50) is False
+        mock_read.assert_not_called()
+
+        response = get_response(b"x" * 100)
+        with mock.patch("requests_ntlm2.clock.now", side_effect=[0, 0, 5]):
+            assert requests_ntlm2.core.drain_response(response, timeout=1, chunk_size=8) is False
+        assert response.raw.tell() == 16
+
+        response = requests.Response()
+        response.raw = mock.MagicMock()
+        response.raw.stream.return_value = iter([b"body"])
+        assert requests_ntlm2.core.drain_response(response) is True
+        assert response.content == b"body"
+
+    def test_get_response_stub(self):
+        response = requests.Response()
+        response.status_code = 401
+        response.reason = "Unauthorized"
+        response.headers["WWW-Authenticate"] = "NTLM"
+        response.url = "http://example.com"
+        response.request = requests.Request("GET", "http://example.com").prepare()
+        response.raw = mock.MagicMock()
+        response.connection = mock.MagicMock()
+
+        stub = requests_ntlm2.core.get_response_stub(response)
+        assert stub is not response
+        assert stub.status_code == 401
+        assert stub.reason == "Unauthorized"
+        assert stub.headers["www-authenticate"] == "NTLM"
+        assert stub.url == "http://example.com"
+        assert stub.request is response.request
+        assert stub.raw is None
+        assert stub.content == b""
+        assert not hasattr(stub, "connection")
+
+    def test_get_request_stub(self):
+        request = requests.Request("POST", "http://example.com", data=b"body", headers={"foo": "bar"}).prepare()
+        stub = requests_ntlm2.core.get_request_stub(request)
+        assert stub is not request
+        assert stub.method == "POST"
+        assert stub.url == "http://example.com/"
+        assert stub.body is request.body
+        request.headers["Authorization"] = "NTLM"
+        assert stub.headers["foo"] == "bar"
+        assert "Authorization" not in stub.headers
+
+    def test_parse_challenge(self):
+        msg = base64.b64decode(
+            "TlRMTVNTUAACAAAAAwAMADgAAAAzgoriASNFZ4mrze8AAAAAAAAAACQAJABEAAAABgBwFwAAAA9TAGUAcgB2AGUA"
+            "cgACAAwARABvAG0AYQBpAG4AAQAMAFMAZQByAHYAZQByAAAAAAA="
+        )
+        expected = ntlm_auth.messages.ChallengeMessage(msg)
+        challenge = requests_ntlm2.core.parse_challenge(msg)
+        assert challenge.message is msg
+        assert challenge.fixed is False
+        assert challenge.negotiate_flags == expected.negotiate_flags
+        assert challenge.server_challenge == expected.server_challenge
+        assert challenge.version == expected.version
+        assert challenge.target_name == expected.target_name
+        assert [(av_id, value.tobytes()) for av_id, value in challenge.target_info] == [
+            (av_id, value) for av_id, value in expected.target_info.fields.items()
+            if av_id != ntlm_auth.constants.AvId.MSV_AV_EOL
+        ]
+
+    def test_parse_challenge__target_info_fix(self):
+        good_message = base64.b64decode(
+            "TlRMTVNTUAACAAAAAAAAAAAAAAAGggkAmuCpt5hD4IIAAAAAAAAAAAAAAAAAAAAA"
+        )
+        challenge = requests_ntlm2.core.parse_challenge(good_message)
+        assert challenge.message is good_message
+        assert challenge.fixed is False
+        assert challenge.target_info is None
+
+        bad_message = base64.b64decode(
+            "TlRMTVNTUAACAAAAAAAAAAAAAAAGgokAmuCpt5hD4IIAAAAAAAAAAAAAAAAAAAAA"
+        )
+        with pytest.raises(ValueError, match="target info is not terminated"):
+            requests_ntlm2.core.parse_challenge(bad_message, fix=False)
+
+        challenge = requests_ntlm2.core.parse_challenge(bad_message)
+        assert challenge.fixed is True
+        assert challenge.message == requests_ntlm2.core.fix_target_info(bad_message)
+        assert not challenge.negotiate_flags & ntlm_auth.constants.NegotiateFlags.NTLMSSP_NEGOTIATE_TARGET_INFO
+        assert requests_ntlm2.core.parse_challenge(challenge.message, fix=False) == challenge._replace(fixed=False)
+
+    def test_parse_challenge__invalid(self):
+        good_message = base64.b64decode(
+            "TlRMTVNTUAACAAAAAAAAAAAAAAAGggkAmuCpt5hD4IIAAAAAAAAAAAAAAAAAAAAA"
+        )
+        with pytest.raises(ValueError, match="too short"):
+            requests_ntlm2.core.parse_challenge(good_message[:40])
+        with pytest.raises(ValueError, match="invalid signature"):
+            requests_ntlm2.core.parse_challenge(b"X" + good_message[1:])
+        with pytest.raises(ValueError, match="message type 3"):
+            requests_ntlm2.core.parse_challenge(good_message[:8] + b"\x03" + good_message[9:])
+
     def test_fix_challenge_message(self):
         good_message = base64.b64decode(
             "TlRMTVNTUAACAAAAAAAAAAAAAAAGggkAmuCpt5hD4IIAAAAAAAAAAAAAAAAAAAAA"
@@ -8,6 +8,7 @@ import pytest
 import requests_ntlm2
 import requests_ntlm2.core
 import requests_ntlm2.dance
+import requests_ntlm2.session_security
 
 
 class TestHttpNtlmContext(object):
@@ -53,6 +54,35 @@ class TestHttpNtlmContext(object):
         authenticate_header = ctx.get_negotiate_header()
         assert  authenticate_header == "NTLM TlRMTVNTUAABAAAAMYCI4gAAAAAoAAAAAAAAACgAAAAGAbEdAAAADw=="  # noqa
 
+    def test_get_negotiate_header__memoized(self):
+        requests_ntlm2.dance.negotiate_header_cache.clear()
+        ctx1 = requests_ntlm2.dance.HttpNtlmContext("user1", "password1", domain="", auth_type="NTLM")
+        negotiate_header = ctx1.get_negotiate_header()
+
+        spec = "requests_ntlm2.dance.HttpNtlmContext.create_negotiate_message"
+        with mock.patch(spec) as mock_create_negotiate_message:
+            ctx2 = requests_ntlm2.dance.HttpNtlmContext(
+                "user2", "password2", domain="", auth_type="NTLM"
+            )
+            assert ctx2.get_negotiate_header() == negotiate_header
+            mock_create_negotiate_message.assert_not_called()
+        assert ctx2.negotiate_message is ctx1.negotiate_message
+
+        ctx3 = requests_ntlm2.dance.HttpNtlmContext("user1", "password1", domain="", auth_type="Negotiate")
+        assert ctx3.get_negotiate_header() == negotiate_header.replace("NTLM ", "Negotiate ")
+        assert len(requests_ntlm2.dance.negotiate_header_cache) == 2
+
+        # the context moves on to the authenticate message as usual
+        ctx2.set_challenge_from_header(
+            "NTLM TlRMTVNTUAACAAAAAAAAAAAAAAAyAojgAnH/LKem1bAAAA"
+            "AAAAAAAH4AfgA4AAAABQCTCAAAAA8CAAwARABFAFQATgBTAFcAA"
+            "QAaAFMARwAtADAAMgAxADQAMwAwADAAMAAxADUABAAUAEQARQBU"
+            "AE4AUwBXAC4AVwBJAE4AAwAwAHMAZwAtADAAMgAxADQAMwAwADAA"
+            "MAAxADUALgBkAGUAdABuAHMAdwAuAHcAaQBuAAAAAAA="
+        )
+        assert ctx2.get_authenticate_header().startswith("NTLM ")
+        assert ctx2.complete is True
+
     def test_get_authenticate_header(self):
         username = self.fake.user_name()
         password = self.fake.password()
@@ -67,10 +97,15 @@ class TestHttpNtlmContext(object):
         )
         ctx.set_challenge_from_header(challenge)
 
-        authenticate_header = ctx.get_authenticate_header()
+        with mock.patch("ntlm_auth.ntlm.SessionSecurity") as ntlm_auth_session_security:
+            authenticate_header = ctx.get_authenticate_header()
         assert authenticate_header.startswith("NTLM ")
         decoded_authenticate_data = base64.b64decode(authenticate_header.split()[1])
         assert decoded_authenticate_data[:9] == b"NTLMSSP\x00\x03"
+        assert isinstance(ctx.session_security, requests_ntlm2.session_security.SessionSecurity)
+        assert ctx.session_security.exported_session_key == ctx.session_key
+        # only ours is built
+        ntlm_auth_session_security.assert_not_called()
 
     def test_set_challenge_from_header(self):
         username = self.fake.user_name()
@@ -97,6 +132,14 @@ class TestHttpNtlmContext(object):
             b"\x00w\x00.\x00w\x00i\x00n\x00\x00\x00\x00\x00"
         )
 
+    def test_get_challenge_from_header(self):
+        ctx = requests_ntlm2.dance.HttpNtlmContext("username", "password", auth_type="NTLM")
+        assert ctx.get_challenge_from_header(None) is None
+        assert ctx.get_challenge_from_header("NTLM") is None
+        assert ctx.get_challenge_from_header("Negotiate abc") is None
+        assert ctx.get_challenge_from_header("Negotiate, NTLM abc") == "abc"
+        assert ctx.get_challenge_from_header("WWW-Authenticate: NTLM abc") == "abc"
+
     def test_set_challenge_from_header__www_authenticate(self):
         username = self.fake.user_name()
         password = self.fake.password()
@@ -252,9 +295,17 @@ class TestHttpNtlmContext(object):
             auth_type="NTLM",
             ntlm_strict_mode=False
         )
-        with mock.patch("requests_ntlm2.dance.fix_target_info") as mock_fix_target_info:
-            mock_fix_target_info.return_value = b"uh-huh!"
-            ctx.parse_challenge_message(msg)
-            assert ctx._challenge_token != base64.b64decode(msg)
-            mock_fix_target_info.assert_called_once_with(base64.b64decode(msg))
-            assert ctx._challenge_token == b"uh-huh!"
+        ctx.parse_challenge_message(msg)
+        assert ctx._challenge_token != base64.b64decode(msg)
+        assert ctx._challenge_token == requests_ntlm2.core.fix_target_info(base64.b64decode(msg))
+        assert ctx.challenge_fixed is True
+        assert ctx.challenge_info.message is ctx._challenge_token
+        assert ctx.challenge_info.target_info is None
+
+    def test_parse_challenge_message__invalid(self):
+        ctx = requests_ntlm2.dance.HttpNtlmContext("username", "password", auth_type="NTLM")
+        msg = base64.b64encode(b"NTLMSSP\x00foobar")
+        ctx.parse_challenge_message(msg)
+        assert ctx._challenge_token == b"NTLMSSP\x00foobar"
+        assert ctx.challenge_info is None
+        assert ctx.challenge_fixed is False
@@ -0,0 +1,130 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+import unittest
+
+import requests_ntlm2.hostcache
+
+
+def _update_in_subprocess(path, authority):
+    with requests_ntlm2.hostcache.HostCapabilityCache(path) as cache:
+        cache.update(authority, auth_type="Negotiate", keep_alive_timeout=5)
+
+
+class TestHostCapabilityCache(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, "hosts.cache")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_init(self):
+        with self.assertRaises(ValueError):
+            requests_ntlm2.hostcache.HostCapabilityCache(self.path, slots=0)
+
+        with requests_ntlm2.hostcache.HostCapabilityCache(self.path, slots=8) as cache:
+            self.assertEqual(cache.slots, 8)
+        self.assertEqual(os.path.getsize(self.path), 16 + 8 * 32)
+
+        # an existing file keeps its size
+        with requests_ntlm2.hostcache.HostCapabilityCache(self.path, slots=16) as cache:
+            self.assertEqual(cache.slots, 8)
+
+    def test_init__invalid_file(self):
+        with open(self.path, "wb") as fd:
+            fd.write(b"this is not a host capability cache")
+        with requests_ntlm2.hostcache.HostCapabilityCache(self.path, slots=4) as cache:
+            self.assertEqual(cache.slots, 4)
+            self.assertIsNone(cache.get("http://example.com"))
+
+    def test_update(self):
+        with requests_ntlm2.hostcache.HostCapabilityCache(self.path) as cache:
+            self.assertIsNone(cache.get("http://example.com"))
+
+            cache.update("http://example.com", auth_type="NTLM")
+            capabilities = cache.get("http://EXAMPLE.com")
+            self.assertEqual(capabilities.auth_type, "NTLM")
+            self.assertFalse(capabilities.strict_mode)
+            self.assertIsNone(capabilities.keep_alive_timeout)
+            self.assertGreater(capabilities.updated, 0)
+
+            cache.update("http://example.com", strict_mode=True)
+            cache.update("http://example.com", keep_alive_timeout=2.5)
+            capabilities = cache.get("http://example.com")
+            self.assertEqual(capabilities.auth_type, "NTLM")
+            self.assertTrue(capabilities.strict_mode)
+            self.assertEqual(capabilities.keep_alive_timeout, 2.5)
+
+            with self.assertRaises(ValueError):
+                cache.update("http://example.com", foo="bar")
+
+    def test_persistence(self):
+        with requests_ntlm2.hostcache.HostCapabilityCache(self.path) as cache:
+            cache.update("https://example.com:8443", auth_type="Negotiate", keep_alive_timeout=15)
+
+        with requests_ntlm2.hostcache.HostCapabilityCache(self.path) as cache:
+            capabilities = cache.get("https://example.com:8443")
+            self.assertEqual(capabilities.auth_type, "Negotiate")
+            self.assertEqual(capabilities.keep_alive_timeout, 15)
+
+    def test_shared_between_processes(self):
+        cache = requests_ntlm2.hostcache.HostCapabilityCache(self.path)
+        self.addCleanup(cache.close)
+        process = multiprocessing.Process(
+            target=_update_in_subprocess, args=(self.path, "http://example.com")
+        )
+        process.start()
+        process.join()
+        self.assertEqual(process.exitcode, 0)
+
+        capabilities = cache.get("http://example.com")
+        self.assertEqual(capabilities.auth_type, "Negotiate")
+        self.assertEqual(capabilities.keep_alive_timeout, 5)
+
+    def test_full_table_evicts_oldest(self):
+        with requests_ntlm2.hostcache.HostCapabilityCache(self.path, slots=2) as cache:
+            cache.update("http://one.example.com", auth_type="NTLM")
+            cache.update("http://two.example.com", auth_type="NTLM")
+            cache.update("http://three.example.com", auth_type="Negotiate")
+            self.assertIsNone(cache.get("http://one.example.com"))
+            self.assertEqual(cache.get("http://two.example.com").auth_type, "NTLM")
+            self.assertEqual(cache.get("http://three.example.com").auth_type, "Negotiate")
+
+    def test_corrupt_record_is_ignored(self):
+        with requests_ntlm2.hostcache.HostCapabilityCache(self.path, slots=1) as cache:
+            cache.update("http://example.com", auth_type="NTLM")
+            cache._mmap[16 + 9] ^= 0xFF
+            self.assertIsNone(cache.get("http://example.com"))
+
+            cache.update("http://example.com", auth_type="NTLM")
+            self.assertEqual(cache.get("http://example.com").auth_type, "NTLM")
+
+    def test_clear(self):
+        with requests_ntlm2.hostcache.HostCapabilityCache(self.path) as cache:
+            cache.update("http://example.com", auth_type="NTLM")
+            cache.clear()
+            self.assertIsNone(cache.get("http://example.com"))
+
+    def test_normalised_authority(self):
+        with requests_ntlm2.hostcache.HostCapabilityCache(self.path) as cache:
+            cache.update("https://Example.com:443", auth_type="NTLM")
+            self.assertEqual(cache.get("HTTPS://example.com").auth_type, "NTLM")
+            self.assertIsNone(cache.get("https://example.com:8443"))
+
+    def test_get_host_cache(self):
+        self.assertIsNone(requests_ntlm2.hostcache.get_host_cache(None))
+        cache = requests_ntlm2.hostcache.get_host_cache(self.path)
+        self.addCleanup(cache.close)
+        self.assertIsInstance(cache, requests_ntlm2.hostcache.HostCapabilityCache)
+        self.assertIs(requests_ntlm2.hostcache.get_host_cache(cache), cache)
+
+        # one cache (fd and mmap) per path, however many times it is asked for
+        self.assertIs(requests_ntlm2.hostcache.get_host_cache(self.path), cache)
+        cache.close()
+        self.assertTrue(cache.closed)
+        reopened = requests_ntlm2.hostcache.get_host_cache(self.path)
+        self.addCleanup(reopened.close)
+        self.assertIsNot(reopened, cache)
+        self.assertFalse(reopened.closed)
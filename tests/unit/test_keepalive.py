@@ -0,0 +1,146 @@
+import os
+import shutil
+import tempfile
+
+import mock
+import pytest
+
+import requests_ntlm2.core
+import requests_ntlm2.hostcache
+import requests_ntlm2.keepalive
+
+
+@pytest.mark.parametrize("value, timeout", [
+    ("timeout=5, max=100", 5),
+    ("max=100,timeout=2.5", 2.5),
+    ('Timeout="15"', 15),
+    ("max=100", None),
+    ("timeout=soon", None),
+    ("timeout=-1", None),
+    ("", None),
+    (None, None),
+])
+def test_parse_keep_alive_timeout(value, timeout):
+    assert requests_ntlm2.keepalive.parse_keep_alive_timeout(value) == timeout
+
+
+class TestIsSocketAlive(object):
+    def test_idle(self, socket_pair):
+        sock, _ = socket_pair
+        assert requests_ntlm2.keepalive.is_socket_alive(sock) is True
+
+    def test_closed_by_peer(self, socket_pair):
+        sock, peer = socket_pair
+        peer.close()
+        assert requests_ntlm2.keepalive.is_socket_alive(sock) is False
+
+    def test_unexpected_data(self, socket_pair):
+        sock, peer = socket_pair
+        peer.sendall(b"x")
+        assert requests_ntlm2.keepalive.is_socket_alive(sock) is False
+        # the data is only peeked at
+        assert sock.recv(1) == b"x"
+
+    def test_pending_tls_data(self):
+        assert requests_ntlm2.keepalive.is_socket_alive(mock.Mock(pending=mock.Mock(return_value=1))) is False
+
+    def test_no_socket(self, socket_pair):
+        sock, _ = socket_pair
+        sock.close()
+        assert requests_ntlm2.keepalive.is_socket_alive(None) is False
+        assert requests_ntlm2.keepalive.is_socket_alive(sock) is False
+
+
+class TestKeepAliveTracker(object):
+    def test_observe_headers(self):
+        tracker = requests_ntlm2.keepalive.KeepAliveTracker()
+        assert tracker.get_idle_timeout("https://example.com") is None
+        assert tracker.observe_headers("https://example.com:443", {"keep-alive": "timeout=5"}) == 5
+        assert tracker.observe_headers("https://example.com", {}) is None
+        assert tracker.get_idle_timeout("HTTPS://example.com") == 5
+        assert tracker.get_idle_timeout("https://example.com:8443") is None
+        # the same server as the host cache and the tunnels name it
+        tracker.observe_headers("http://[::1]:80/path", {"keep-alive": "timeout=7"})
+        assert tracker.get_idle_timeout(requests_ntlm2.core.get_authority("http", "::1", 80)) == 7
+
+    def test_init(self):
+        with pytest.raises(ValueError, match="idle_close_observations must be at least 1, got 0"):
+            requests_ntlm2.keepalive.KeepAliveTracker(idle_close_observations=0)
+
+    def test_observe_idle_close(self):
+        tracker = requests_ntlm2.keepalive.KeepAliveTracker()
+        tracker.observe_headers("http://proxy:8080", {"keep-alive": "timeout=30"})
+        tracker.observe_idle_close("http://proxy:8080", 20)
+        # a single close could have been a reset or a restart
+        assert tracker.get_idle_timeout("http://proxy:8080") == 30
+        tracker.observe_idle_close("http://proxy:8080", 22)
+        assert tracker.get_idle_timeout("http://proxy:8080") == 22
+        tracker.observe_idle_close("http://proxy:8080", 25)
+        tracker.observe_idle_close("http://proxy:8080", 26)
+        assert tracker.get_idle_timeout("http://proxy:8080") == 22
+        # closed right after being used: that was not for being idle
+        tracker.observe_idle_close("http://proxy:8080", 0.1)
+        tracker.observe_idle_close("http://proxy:8080", 0.1)
+        assert tracker.get_idle_timeout("http://proxy:8080") == 22
+
+    def test_observe_idle_reuse(self):
+        tracker = requests_ntlm2.keepalive.KeepAliveTracker(idle_close_observations=2)
+        for _ in range(2):
+            tracker.observe_idle_close("https://example.com", 5)
+        tracker.observe_idle_reuse("https://example.com", 4)
+        assert tracker.get_idle_timeout("https://example.com") == 5
+        # kept open for longer than that after all
+        tracker.observe_idle_reuse("https://example.com", 6)
+        assert tracker.get_idle_timeout("https://example.com") is None
+
+        # an unrelated close is not counted once a longer idle connection was reused
+        tracker.observe_idle_close("https://example.com", 2)
+        tracker.observe_idle_reuse("https://example.com", 3)
+        tracker.observe_idle_close("https://example.com", 2)
+        assert tracker.get_idle_timeout("https://example.com") is None
+
+    def test_idle_close_ttl(self):
+        tracker = requests_ntlm2.keepalive.KeepAliveTracker(idle_close_observations=1, idle_close_ttl=0)
+        tracker.observe_idle_close("https://example.com", 5)
+        assert tracker.get_idle_timeout("https://example.com") is None
+
+    def test_is_expiring(self):
+        tracker = requests_ntlm2.keepalive.KeepAliveTracker(margin=1)
+        tracker.observe_headers("https://example.com", {"keep-alive": "timeout=5"})
+        tracker.observe_headers("http://proxy:8080", {"keep-alive": "timeout=1"})
+        assert tracker.is_expiring(3.9, "https://example.com") is False
+        assert tracker.is_expiring(4, "https://example.com") is True
+        assert tracker.is_expiring(0.4, "http://proxy:8080") is False
+        assert tracker.is_expiring(0.5, "http://proxy:8080") is True
+        assert tracker.is_expiring(0.5, "https://example.com", "http://proxy:8080") is True
+        assert tracker.is_expiring(100, "https://other.com") is False
+
+    def test_host_cache(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tempdir, "hosts.cache")
+            with requests_ntlm2.hostcache.HostCapabilityCache(path) as host_cache:
+                tracker = requests_ntlm2.keepalive.KeepAliveTracker(host_cache=host_cache)
+                tracker.observe_headers("https://example.com:443", {"keep-alive": "timeout=5"})
+                assert host_cache.get("https://example.com").keep_alive_timeout == 5
+
+            # a fresh process knows it straight away
+            with requests_ntlm2.hostcache.HostCapabilityCache(path) as host_cache:
+                tracker = requests_ntlm2.keepalive.KeepAliveTracker(host_cache=host_cache)
+                assert tracker.get_idle_timeout("https://example.com") == 5
+                assert tracker.get_idle_timeout("https://other.com") is None
+                with mock.patch.object(host_cache, "get") as get:
+                    assert tracker.get_idle_timeout("https://other.com") is None
+                get.assert_not_called()
+        finally:
+            shutil.rmtree(tempdir)
+
+
+def test_get_keep_alive_tracker():
+    tracker = requests_ntlm2.keepalive.KeepAliveTracker()
+    host_cache = mock.MagicMock()
+    assert requests_ntlm2.keepalive.get_keep_alive_tracker(tracker, host_cache) is tracker
+    assert requests_ntlm2.keepalive.get_keep_alive_tracker(None) is requests_ntlm2.keepalive.default_keep_alive_tracker
+    tracker = requests_ntlm2.keepalive.get_keep_alive_tracker(None, host_cache)
+    assert tracker is not requests_ntlm2.keepalive.default_keep_alive_tracker
+    assert tracker.host_cache is host_cache
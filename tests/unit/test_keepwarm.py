@@ -0,0 +1,240 @@
+import mock
+import pytest
+from requests.packages.urllib3.connection import HTTPConnection
+from requests.packages.urllib3.response import HTTPResponse
+
+import requests_ntlm2.keepalive
+import requests_ntlm2.keepwarm
+import requests_ntlm2.pool
+from tests.test_utils import FakeTimer
+
+
+OK = b"HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n"
+
+
+@pytest.fixture
+def timer():
+    timer = FakeTimer()
+    with mock.patch("requests_ntlm2.clock.now", timer):
+        yield timer
+
+
+@pytest.fixture
+def get_scheduler(timer):
+    schedulers = []
+
+    def new_scheduler(**kwargs):
+        schedulers.append(requests_ntlm2.keepwarm.KeepWarmScheduler(timer=timer, tick=3600, **kwargs))
+        return schedulers[-1]
+
+    yield new_scheduler
+    for scheduler in schedulers:
+        scheduler.stop()
+
+
+def get_pool(scheduler, tracker=None):
+    pool_cls = type("HTTPConnectionPool", (requests_ntlm2.pool.HTTPConnectionPool,), {
+        "keep_warm": scheduler,
+        "keep_alive_tracker": tracker or requests_ntlm2.keepalive.KeepAliveTracker(),
+    })
+    pool = pool_cls("example.com", maxsize=2)
+    for _ in range(2):
+        pool.pool.get(block=False)
+    return pool
+
+
+def get_conn(sock, registry=None):
+    conn = HTTPConnection("example.com", 80)
+    conn.sock = sock
+    if registry is not None:
+        registry.mark_authenticated(sock, "NTLM")
+    return conn
+
+
+def test_get_keep_warm_scheduler():
+    assert requests_ntlm2.keepwarm.get_keep_warm_scheduler(None) is None
+    assert requests_ntlm2.keepwarm.get_keep_warm_scheduler(False) is None
+    scheduler = requests_ntlm2.keepwarm.KeepWarmScheduler()
+    assert requests_ntlm2.keepwarm.get_keep_warm_scheduler(scheduler) is scheduler
+    assert isinstance(
+        requests_ntlm2.keepwarm.get_keep_warm_scheduler(True), requests_ntlm2.keepwarm.KeepWarmScheduler
+    )
+    with pytest.raises(TypeError):
+        requests_ntlm2.keepwarm.get_keep_warm_scheduler("yes")
+
+
+class TestKeepWarmScheduler(object):
+    def test_init(self):
+        with pytest.raises(ValueError, match="max_per_host must be at least 1, got 0"):
+            requests_ntlm2.keepwarm.KeepWarmScheduler(max_per_host=0)
+        with pytest.raises(ValueError, match="max_total must be at least 1, got 0"):
+            requests_ntlm2.keepwarm.KeepWarmScheduler(max_total=0)
+
+    def test_add_pool(self, get_scheduler):
+        scheduler = get_scheduler()
+        get_pool(scheduler)
+        assert scheduler._thread.is_alive()
+        thread = scheduler._thread
+        scheduler.stop()
+        assert not thread.is_alive()
+        assert len(scheduler._pools) == 0
+
+    def test_remove_pools(self, get_scheduler):
+        scheduler = get_scheduler()
+        pool = get_pool(scheduler)
+        other_pool = requests_ntlm2.pool.HTTPConnectionPool("example.com")
+        scheduler.add_pool(other_pool)
+        scheduler.remove_pools(type(pool))
+        assert list(scheduler._pools) == [other_pool]
+        assert scheduler._thread.is_alive()
+
+    def test_ping(self, timer, registry, socket_pairs, get_scheduler):
+        scheduler = get_scheduler(method="options", headers={"X-Keep-Warm": "1"})
+        pool = get_pool(scheduler)
+        sock, peer = socket_pairs()
+        conn = get_conn(sock, registry)
+        pool._put_conn(conn)
+
+        timer.now = 29
+        assert scheduler.ping_idle_connections() == 0
+        peer.sendall(OK)
+        timer.now = 30
+        assert scheduler.ping_idle_connections() == 1
+        request = peer.recv(4096)
+        assert request.startswith(b"OPTIONS / HTTP/1.1\r\n")
+        assert b"X-Keep-Warm: 1\r\n" in request
+        assert pool._get_idle_conns() == [(conn, 30)]
+        assert scheduler.as_dict() == {"pings": 1, "failed_pings": 0, "skipped_pings": 0}
+        assert "pings=1" in repr(scheduler)
+
+    def test_ping__urllib3_2_response(self, timer, registry, socket_pairs, get_scheduler):
+        scheduler = get_scheduler()
+        pool = get_pool(scheduler)
+        sock, peer = socket_pairs()
+        conn = get_conn(sock, registry)
+        pool._put_conn(conn)
+        peer.sendall(OK)
+        timer.now = 30
+
+        getresponse = conn.getresponse
+
+        def wrap_response():
+            # the responses of urllib3 2.x wrap the one of http.client, without its will_close
+            original_response = getresponse()
+            if isinstance(original_response, HTTPResponse):
+                return original_response
+            return HTTPResponse(body=original_response, original_response=original_response, preload_content=False)
+
+        with mock.patch.object(conn, "getresponse", side_effect=wrap_response):
+            assert scheduler.ping_idle_connections() == 1
+        assert conn.sock is sock
+        assert pool._get_idle_conns() == [(conn, 30)]
+        assert scheduler.failed_pings == 0
+
+    def test_not_authenticated(self, timer, socket_pairs, get_scheduler):
+        scheduler = get_scheduler()
+        pool = get_pool(scheduler)
+        pool._put_conn(get_conn(socket_pairs()[0]))
+        timer.now = 100
+        assert scheduler.ping_idle_connections() == 0
+
+    def test_idle_timeout(self, timer, registry, socket_pairs, get_scheduler):
+        tracker = requests_ntlm2.keepalive.KeepAliveTracker()
+        tracker.observe_headers("http://example.com", {"keep-alive": "timeout=9"})
+        scheduler = get_scheduler()
+        pool = get_pool(scheduler, tracker)
+        sock, peer = socket_pairs()
+        pool._put_conn(get_conn(sock, registry))
+        peer.sendall(OK)
+        timer.now = 3
+        assert scheduler.ping_idle_connections() == 1
+
+    def test_failed_ping(self, timer, registry, socket_pairs, get_scheduler):
+        scheduler = get_scheduler()
+        pool = get_pool(scheduler)
+        sock, peer = socket_pairs()
+        conn = get_conn(sock, registry)
+        pool._put_conn(conn)
+        peer.sendall(b"HTTP/1.1 401 Unauthorized\r\nContent-Length: 0\r\n\r\n")
+        timer.now = 30
+        assert scheduler.ping_idle_connections() == 1
+        assert conn.sock is None
+        assert pool._get_idle_conns() == []
+        assert pool.pool.qsize() == 1
+        assert scheduler.failed_pings == 1
+
+    def test_closed_by_server(self, timer, registry, socket_pairs, get_scheduler):
+        scheduler = get_scheduler()
+        pool = get_pool(scheduler)
+        sock, peer = socket_pairs()
+        conn = get_conn(sock, registry)
+        pool._put_conn(conn)
+        peer.close()
+        timer.now = 30
+        assert scheduler.ping_idle_connections() == 1
+        assert conn.sock is None
+        assert scheduler.failed_pings == 1
+
+    def test_max_idle(self, timer, registry, socket_pairs, get_scheduler):
+        scheduler = get_scheduler(max_idle=60)
+        pool = get_pool(scheduler)
+        sock, peer = socket_pairs()
+        conn = get_conn(sock, registry)
+        pool._put_conn(conn)
+        peer.sendall(OK)
+        timer.now = 30
+        assert scheduler.ping_idle_connections() == 1
+        timer.now = 60
+        # idle since 0, even if the ping was at 30
+        assert scheduler.ping_idle_connections() == 0
+
+        # used for a request of its own
+        assert pool._get_conn() is conn
+        pool._put_conn(conn)
+        peer.sendall(OK)
+        timer.now = 90
+        assert scheduler.ping_idle_connections() == 1
+
+    def test_budgets(self, timer, registry, socket_pairs, get_scheduler):
+        scheduler = get_scheduler(max_per_host=1, max_total=2, period=60)
+        pools = [get_pool(scheduler), get_pool(scheduler)]
+        pools[1].host = "other.com"
+        for pool in pools:
+            for _ in range(2):
+                sock, peer = socket_pairs()
+                peer.sendall(OK * 2)
+                pool._put_conn(get_conn(sock, registry))
+
+        timer.now = 30
+        assert scheduler.ping_idle_connections() == 2
+        assert scheduler.skipped_pings == 2
+        timer.now = 60
+        assert scheduler.ping_idle_connections() == 0
+        timer.now = 90
+        assert scheduler.ping_idle_connections() == 2
+
+    def test_host_budgets_are_bounded(self, get_scheduler):
+        scheduler = get_scheduler()
+        with mock.patch.object(scheduler._host_budgets, "maxsize", 2):
+            budgets = [scheduler._get_host_budget("http://{}.com".format(i)) for i in range(3)]
+            assert len(scheduler._host_budgets) == 2
+            assert scheduler._get_host_budget("http://2.com") is budgets[2]
+
+    def test_closed_pool(self, timer, registry, socket_pairs, get_scheduler):
+        scheduler = get_scheduler()
+        pool = get_pool(scheduler)
+        pool._put_conn(get_conn(socket_pairs()[0], registry))
+        pool.close()
+        timer.now = 30
+        assert scheduler.ping_idle_connections() == 0
+        assert len(scheduler._pools) == 0
+
+
+def test_is_worth_keeping_warm(registry, socket_pairs):
+    sock, _ = socket_pairs()
+    conn = get_conn(sock)
+    assert requests_ntlm2.keepwarm.is_worth_keeping_warm(conn) is False
+    conn._tunnel_host = "target"
+    assert requests_ntlm2.keepwarm.is_worth_keeping_warm(conn) is True
+    assert requests_ntlm2.keepwarm.is_worth_keeping_warm(get_conn(sock, registry)) is True
+    assert requests_ntlm2.keepwarm.is_worth_keeping_warm(get_conn(None)) is False
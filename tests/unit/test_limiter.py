@@ -0,0 +1,129 @@
+import threading
+import time
+
+import pytest
+
+import requests_ntlm2.limiter
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, "timed out"
+        time.sleep(0.001)
+
+
+class TestHandshakeLimiter(object):
+    def test_init(self):
+        with pytest.raises(ValueError, match="max_per_host must be at least 1, got 0"):
+            requests_ntlm2.limiter.HandshakeLimiter(max_per_host=0)
+        with pytest.raises(ValueError, match="max_total must be at least 1, got 0"):
+            requests_ntlm2.limiter.HandshakeLimiter(max_total=0)
+
+    def test_no_limits(self):
+        limiter = requests_ntlm2.limiter.HandshakeLimiter()
+        for _ in range(10):
+            assert limiter.acquire("http://a") is False
+        assert limiter.in_flight == 10
+        for _ in range(10):
+            limiter.release("http://a")
+        assert limiter.as_dict() == {
+            "in_flight": 0,
+            "queue_depth": 0,
+            "max_queue_depth": 0,
+            "waits": 0,
+            "wait_time": 0.0,
+            "max_wait_time": 0.0,
+            "timeouts": 0,
+        }
+        assert "in_flight=0" in repr(limiter)
+
+    def start_waiting(self, limiter, authority, results):
+        thread = threading.Thread(target=lambda: results.append(limiter.acquire(authority)))
+        thread.start()
+        wait_for(lambda: limiter.queue_depth_for(authority) == 1)
+        return thread
+
+    def test_max_per_host(self):
+        limiter = requests_ntlm2.limiter.HandshakeLimiter(max_per_host=1)
+        results = []
+        assert limiter.acquire("http://a") is False
+        assert limiter.acquire("http://b") is False
+        thread = self.start_waiting(limiter, "http://a", results)
+        assert limiter.queue_depth == 1
+        assert limiter.queue_depth_for("http://b") == 0
+
+        limiter.release("http://b")
+        assert limiter.queue_depth == 1
+        limiter.release("http://a")
+        thread.join(5)
+        assert results == [True]
+        assert limiter.in_flight == 1
+        assert limiter.queue_depth == 0
+        assert limiter.max_queue_depth == 1
+        assert limiter.waits == 1
+        assert limiter.wait_time > 0
+        assert limiter.max_wait_time == limiter.wait_time
+
+    def test_max_total(self):
+        limiter = requests_ntlm2.limiter.HandshakeLimiter(max_total=2)
+        results = []
+        limiter.acquire("http://a")
+        # from another thread, or it would be nested in the first one
+        thread = threading.Thread(target=limiter.acquire, args=("http://b",))
+        thread.start()
+        thread.join(5)
+        thread = self.start_waiting(limiter, "http://c", results)
+        limiter.release("http://a")
+        thread.join(5)
+        assert results == [True]
+        assert limiter.in_flight == 2
+
+    def test_timeout(self):
+        limiter = requests_ntlm2.limiter.HandshakeLimiter(max_per_host=1, timeout=0.01)
+        limiter.acquire("http://a")
+        with pytest.raises(requests_ntlm2.limiter.HandshakeTimeout, match="http://a"):
+            limiter.acquire("http://a")
+        assert limiter.timeouts == 1
+        assert limiter.queue_depth == 0
+        assert limiter.in_flight == 1
+
+    def test_nested(self):
+        limiter = requests_ntlm2.limiter.HandshakeLimiter(max_total=1, timeout=0.01)
+        with limiter.slot("https://server") as waited:
+            assert waited is False
+            # eg a new tunnel through the proxy for the negotiate leg
+            with limiter.slot("http://proxy:8080") as waited:
+                assert waited is False
+                assert limiter.in_flight == 2
+            # other threads still wait for their turn
+            errors = []
+
+            def acquire():
+                try:
+                    limiter.acquire("https://other")
+                except requests_ntlm2.limiter.HandshakeTimeout as e:
+                    errors.append(e)
+
+            thread = threading.Thread(target=acquire)
+            thread.start()
+            thread.join(5)
+            assert len(errors) == 1
+        assert limiter.in_flight == 0
+        assert limiter.acquire("https://other") is False
+
+    def test_nested__max_per_host(self):
+        limiter = requests_ntlm2.limiter.HandshakeLimiter(max_per_host=1, timeout=0.01)
+        with limiter.slot("https://server"):
+            with pytest.raises(requests_ntlm2.limiter.HandshakeTimeout):
+                limiter.acquire("https://server")
+        assert limiter.in_flight == 0
+
+    def test_slot(self):
+        limiter = requests_ntlm2.limiter.HandshakeLimiter(max_per_host=1)
+        with pytest.raises(RuntimeError):
+            with limiter.slot("http://a") as waited:
+                assert waited is False
+                assert limiter.in_flight == 1
+                raise RuntimeError()
+        assert limiter.in_flight == 0
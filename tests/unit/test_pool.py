@@ -0,0 +1,166 @@
+import mock
+import pytest
+
+import requests_ntlm2.keepalive
+import requests_ntlm2.pool
+
+
+def get_conn(sock=None):
+    return mock.Mock(sock=sock)
+
+
+def test_get_warmth(registry, sockets):
+    authenticated = get_conn(sockets())
+    registry.mark_authenticated(authenticated.sock, "NTLM")
+    assert requests_ntlm2.pool.get_warmth(None) == requests_ntlm2.pool.COLD
+    assert requests_ntlm2.pool.get_warmth(get_conn()) == requests_ntlm2.pool.COLD
+    assert requests_ntlm2.pool.get_warmth(get_conn(sockets())) == requests_ntlm2.pool.CONNECTED
+    assert requests_ntlm2.pool.get_warmth(authenticated) == requests_ntlm2.pool.AUTHENTICATED
+
+    registry.forget(authenticated.sock)
+    assert requests_ntlm2.pool.get_warmth(authenticated) == requests_ntlm2.pool.CONNECTED
+
+
+class TestAffinityQueue(object):
+    def test_get(self, registry, sockets):
+        cold, connected, authenticated, other_authenticated = (
+            get_conn(), get_conn(sockets()), get_conn(sockets()), get_conn(sockets())
+        )
+        registry.mark_authenticated(authenticated.sock, "NTLM")
+        registry.mark_authenticated(other_authenticated.sock, "NTLM")
+
+        pool = requests_ntlm2.pool.AffinityQueue(6)
+        for item in (None, other_authenticated, connected, authenticated, cold, None):
+            pool.put(item)
+
+        items = [pool.get(block=False) for _ in range(6)]
+        assert items == [authenticated, other_authenticated, connected, None, cold, None]
+
+    def test_replace_coldest(self, registry, sockets):
+        cold, connected, authenticated = get_conn(), get_conn(sockets()), get_conn(sockets())
+        registry.mark_authenticated(authenticated.sock, "NTLM")
+
+        pool = requests_ntlm2.pool.AffinityQueue(2)
+        assert pool.replace_coldest(cold) is cold
+        pool.put(cold)
+        pool.put(connected)
+        assert pool.replace_coldest(get_conn()).sock is None
+        assert pool.replace_coldest(authenticated) is cold
+        assert pool.replace_coldest(get_conn(sockets())).sock is not None
+        assert [pool.get(block=False) for _ in range(2)] == [authenticated, connected]
+
+
+class TestAffinityPool(object):
+    def test_queue(self):
+        pool = requests_ntlm2.pool.HTTPSConnectionPool("example.com", maxsize=2)
+        assert isinstance(pool.pool, requests_ntlm2.pool.AffinityQueue)
+
+    def test_put_conn(self, registry, sockets):
+        pool = requests_ntlm2.pool.HTTPConnectionPool("example.com", maxsize=1)
+        cold, authenticated, extra = get_conn(), get_conn(sockets()), get_conn()
+        registry.mark_authenticated(authenticated.sock, "NTLM")
+
+        pool.pool.get(block=False)
+        pool._put_conn(cold)
+        # the pool is full: the cold connection makes room for the warm one
+        pool._put_conn(authenticated)
+        cold.close.assert_called_once_with()
+        pool._put_conn(extra)
+        extra.close.assert_called_once_with()
+        assert pool._get_conn() is authenticated
+
+    def test_put_conn__closed_pool(self):
+        pool = requests_ntlm2.pool.HTTPConnectionPool("example.com", maxsize=1)
+        pool.close()
+        conn = get_conn()
+        pool._put_conn(conn)
+        conn.close.assert_called_once_with()
+
+
+class TestKeepAlive(object):
+    @pytest.fixture
+    def tracker(self):
+        return requests_ntlm2.keepalive.KeepAliveTracker(idle_close_observations=1)
+
+    def get_pool(self, tracker, **kwargs):
+        pool = requests_ntlm2.pool.HTTPSConnectionPool("example.com", maxsize=1, **kwargs)
+        pool.keep_alive_tracker = tracker
+        pool.pool.get(block=False)
+        return pool
+
+    def test_reuse(self, socket_pair, tracker):
+        pool = self.get_pool(tracker)
+        conn = get_conn(socket_pair[0])
+        for _ in range(2):
+            tracker.observe_idle_close("https://example.com", 20)
+        with mock.patch("requests_ntlm2.clock.now", return_value=100):
+            pool._put_conn(conn)
+        with mock.patch("requests_ntlm2.clock.now", return_value=105):
+            assert pool._get_conn() is conn
+        conn.retire.assert_not_called()
+        assert tracker.get_idle_timeout("https://example.com") == 20
+
+    def test_closed_by_server(self, socket_pair, tracker):
+        pool = self.get_pool(tracker)
+        conn = get_conn(socket_pair[0])
+        with mock.patch("requests_ntlm2.clock.now", return_value=100):
+            pool._put_conn(conn)
+        socket_pair[1].close()
+
+        with mock.patch("requests_ntlm2.clock.now", return_value=130):
+            assert pool._get_conn() is conn
+        conn.retire.assert_called_once_with()
+        assert tracker.get_idle_timeout("https://example.com") == 30
+
+    def test_closed_by_proxy(self, socket_pair, tracker):
+        pool = requests_ntlm2.pool.HTTPConnectionPool("example.com", maxsize=1, _proxy=mock.Mock(
+            scheme="http", host="proxy", port=8080
+        ))
+        pool.keep_alive_tracker = tracker
+        pool.pool.get(block=False)
+        conn = get_conn(socket_pair[0])
+        with mock.patch("requests_ntlm2.clock.now", return_value=100):
+            pool._put_conn(conn)
+        socket_pair[1].close()
+
+        with mock.patch("requests_ntlm2.clock.now", return_value=110):
+            pool._get_conn()
+        assert tracker.get_idle_timeout("http://proxy:8080") == 10
+        assert tracker.get_idle_timeout("http://example.com") is None
+
+    def test_expiring(self, socket_pair, tracker):
+        pool = self.get_pool(tracker)
+        tracker.observe_headers("https://example.com", {"keep-alive": "timeout=5"})
+        conn = get_conn(socket_pair[0])
+        with mock.patch("requests_ntlm2.clock.now", return_value=100):
+            pool._put_conn(conn)
+            pool._put_conn(pool._get_conn())
+        conn.retire.assert_not_called()
+
+        with mock.patch("requests_ntlm2.clock.now", return_value=104):
+            assert pool._get_conn() is conn
+        conn.retire.assert_called_once_with()
+
+    def test_expiring__tunnelled(self, socket_pair, tracker):
+        pool = self.get_pool(tracker)
+        tracker.observe_headers("https://example.com", {"keep-alive": "timeout=5"})
+        conn = get_conn(socket_pair[0])
+        conn.auto_open = 0
+        with mock.patch("requests_ntlm2.clock.now", return_value=100):
+            pool._put_conn(conn)
+        with mock.patch("requests_ntlm2.clock.now", return_value=104):
+            new_conn = pool._get_conn()
+        conn.retire.assert_called_once_with()
+        assert new_conn is not conn
+        assert new_conn.sock is None
+
+    def test_get_idle_conns(self, socket_pair, tracker):
+        pool = self.get_pool(tracker)
+        conn = get_conn(socket_pair[0])
+        with mock.patch("requests_ntlm2.clock.now", return_value=100):
+            pool._put_conn(conn)
+        assert pool._get_idle_conns() == [(conn, 100)]
+
+        # handed out by another thread after the queue was looked at
+        pool._idle_since.pop(conn)
+        assert pool._get_idle_conns() == []
@@ -1,12 +1,22 @@
 import base64
+import os
+import socket
+import shutil
+import tempfile
 import warnings
 
 import faker
 import mock
+import pytest
 import requests
+from requests.packages.urllib3.connectionpool import HTTPConnectionPool
 
 import requests_ntlm2
+import requests_ntlm2.body
 import requests_ntlm2.core
+import requests_ntlm2.dance
+import requests_ntlm2.limiter
+import requests_ntlm2.pool
 from tests.test_utils import domain, password, username
 
 
@@ -168,6 +178,414 @@ class TestHttpNtlmAuth(object):
             assert res.history[0].request is not res.history[1].request
             assert res.history[0].request is not res.request
 
+    def test_lightweight_history(self):
+        for auth_type in self.auth_types:
+            auth = requests_ntlm2.HttpNtlmAuth(
+                self.test_server_username, self.test_server_password, lightweight_history=True
+            )
+            res = requests.get(url=self.test_server_url + auth_type, auth=auth)
+            assert res.status_code == 200
+            assert [r.status_code for r in res.history] == [401, 401]
+            assert all(r.raw is None for r in res.history)
+            prefix = "Negotiate " if auth_type == "negotiate" else "NTLM "
+            assert res.history[1].headers["WWW-Authenticate"].startswith(prefix)
+            # each leg keeps the headers it was sent with
+            assert "Authorization" not in res.history[0].request.headers
+            negotiate = res.history[1].request.headers["Authorization"]
+            authenticate = res.request.headers["Authorization"]
+            assert negotiate.startswith(prefix)
+            assert authenticate.startswith(prefix)
+            assert negotiate != authenticate
+            assert res.history[1].request.body is res.request.body
+
+    def test_handshakes_are_counted(self):
+        for auth_type in self.auth_types:
+            auth = requests_ntlm2.HttpNtlmAuth(self.test_server_username, self.test_server_password)
+            res = requests.get(url=self.test_server_url + auth_type, auth=auth)
+            assert res.status_code == 200
+            assert auth.stats.handshakes == 1
+            assert auth.stats.failed_handshakes == 0
+
+    def test_response_hook__reused_connection(self):
+        auth = requests_ntlm2.HttpNtlmAuth(self.test_server_username, self.test_server_password)
+        sock = object.__new__(type("Socket", (), {}))
+        auth.connection_state.mark_authenticated(sock, "NTLM")
+        response = requests.Response()
+        response.status_code = 200
+        with mock.patch("requests_ntlm2.requests_ntlm2.get_response_socket", return_value=sock):
+            assert auth.response_hook(response) is response
+        assert auth.stats.reused_connections == 1
+        assert auth.stats.expired_connections == 0
+
+    def test_get_session_security(self):
+        auth = requests_ntlm2.HttpNtlmAuth(self.test_server_username, self.test_server_password)
+        res1 = requests.get(url=self.test_server_url + "ntlm", auth=auth)
+        res2 = requests.get(url=self.test_server_url + "ntlm", auth=auth)
+        assert auth.stats.handshakes == 2
+
+        # each connection has its own, whichever handshake happened last
+        session_security = auth.get_session_security(res1)
+        assert session_security is not None
+        assert auth.get_session_security(res2) is auth.session_security
+        assert auth.get_session_security(res2) is not session_security
+        assert auth.get_session_security(requests.Response()) is None
+
+    def test_get_session_security__reused_connection(self):
+        auth = requests_ntlm2.HttpNtlmAuth(self.test_server_username, self.test_server_password)
+        sock = object.__new__(type("Socket", (), {}))
+        session_security = mock.Mock()
+        auth.connection_state.mark_authenticated(sock, "NTLM", session_security=session_security)
+        response = requests.Response()
+        response.status_code = 200
+        with mock.patch("requests_ntlm2.requests_ntlm2.get_response_socket", return_value=sock):
+            auth.response_hook(response)
+        assert auth.get_session_security(response) is session_security
+
+    def test_keep_alive_tracker(self):
+        tracker = mock.Mock()
+        auth = requests_ntlm2.HttpNtlmAuth(
+            self.test_server_username, self.test_server_password, keep_alive_tracker=tracker
+        )
+        res = requests.get(url=self.test_server_url + "ntlm", auth=auth)
+        assert res.status_code == 200
+        # the challenge and the final response
+        assert tracker.observe_headers.call_args_list == [
+            mock.call("http://localhost:5000", res.history[1].headers),
+            mock.call("http://localhost:5000", res.headers),
+        ]
+
+    def test_handshake_limiter(self):
+        limiter = requests_ntlm2.limiter.HandshakeLimiter(max_per_host=1)
+        auth = requests_ntlm2.HttpNtlmAuth(
+            self.test_server_username, self.test_server_password, handshake_limiter=limiter
+        )
+        res = requests.get(url=self.test_server_url + "ntlm", auth=auth)
+        assert res.status_code == 200
+        assert auth.stats.handshakes == 1
+        assert limiter.as_dict()["in_flight"] == 0
+        assert limiter.waits == 0
+
+    def test_handshake_limiter__takes_over_authenticated_connection(self):
+        limiter = requests_ntlm2.limiter.HandshakeLimiter(max_per_host=1)
+        auth = requests_ntlm2.HttpNtlmAuth(
+            self.test_server_username, self.test_server_password, handshake_limiter=limiter
+        )
+        response = requests.get(url=self.test_server_url + "ntlm")
+        assert response.status_code == 401
+        authenticated_response = requests.Response()
+        authenticated_response.status_code = 200
+        response.connection = mock.Mock()
+        response.connection.send.return_value = authenticated_response
+
+        # another thread authenticated a connection while this one was waiting
+        with mock.patch.object(limiter, "acquire", return_value=True):
+            with mock.patch.object(auth, "_has_idle_authenticated_connection", return_value=True):
+                res = auth.response_hook(response)
+
+        assert res is authenticated_response
+        assert res.history == [response]
+        assert "Authorization" not in response.connection.send.call_args[0][0].headers
+        assert auth.stats.handshakes == 0
+
+    def test_handshake_limiter__authenticated_connection_is_busy(self):
+        limiter = requests_ntlm2.limiter.HandshakeLimiter(max_per_host=1)
+        auth = requests_ntlm2.HttpNtlmAuth(
+            self.test_server_username, self.test_server_password, handshake_limiter=limiter
+        )
+        with mock.patch.object(limiter, "acquire", return_value=True):
+            with mock.patch.object(auth, "_has_idle_authenticated_connection", return_value=True):
+                res = requests.get(url=self.test_server_url + "ntlm", auth=auth)
+
+        # the request was resent, got another 401 and went through the NTLM dance
+        assert res.status_code == 200
+        assert [r.status_code for r in res.history] == [401, 401, 401]
+        assert "Authorization" not in res.history[1].request.headers
+        assert auth.stats.handshakes == 1
+
+    def test_handshake_limiter__large_body(self):
+        limiter = requests_ntlm2.limiter.HandshakeLimiter(max_per_host=1)
+        auth = requests_ntlm2.HttpNtlmAuth(
+            self.test_server_username,
+            self.test_server_password,
+            handshake_limiter=limiter,
+            bodyless_handshake_threshold=10
+        )
+        with mock.patch.object(limiter, "acquire", return_value=True):
+            with mock.patch.object(auth, "_has_idle_authenticated_connection", return_value=True):
+                res = requests.post(url=self.test_server_url + "ntlm", data=b"x" * 10, auth=auth)
+        # not resent, so the body was not uploaded once more
+        assert res.status_code == 200
+        assert len(res.history) == 2
+
+    def test__is_cheap_to_resend(self):
+        auth = requests_ntlm2.HttpNtlmAuth(
+            self.test_server_username, self.test_server_password, bodyless_handshake_threshold=10
+        )
+        request = requests.Request("POST", self.test_server_url, data=b"x" * 9).prepare()
+        assert auth._is_cheap_to_resend(request) is True
+        request.prepare_body(b"x" * 10, None)
+        assert auth._is_cheap_to_resend(request) is False
+        request.prepare_body(iter([b"x"]), None)
+        assert auth._is_cheap_to_resend(request) is False
+        request.body = requests_ntlm2.body.ReplayableBody(BytesIO(b"x"))
+        request.headers["Content-Length"] = "1"
+        assert auth._is_cheap_to_resend(request) is False
+        assert auth._is_cheap_to_resend(requests.Request("GET", self.test_server_url).prepare()) is True
+
+    def test__has_idle_authenticated_connection(self):
+        auth = requests_ntlm2.HttpNtlmAuth(self.test_server_username, self.test_server_password)
+        sock, peer = socket.socketpair()
+        try:
+            pool = requests_ntlm2.pool.HTTPConnectionPool("example.com", maxsize=1)
+            pool.pool.get(block=False)
+            pool._put_conn(mock.Mock(sock=sock))
+            response = mock.Mock()
+            response.raw._pool = pool
+            assert auth._has_idle_authenticated_connection(response, "http://example.com") is False
+            auth.connection_state.mark_authenticated(sock, "NTLM", "http://example.com")
+            assert auth._has_idle_authenticated_connection(response, "http://example.com") is True
+            assert auth._has_idle_authenticated_connection(response, "http://example.org") is False
+
+            # urllib3's own pools hand out the connection that was released last
+            response.raw._pool = HTTPConnectionPool("example.com", maxsize=1)
+            response.raw._pool.pool.get(block=False)
+            response.raw._pool._put_conn(mock.Mock(sock=sock))
+            assert auth._has_idle_authenticated_connection(response, "http://example.com") is False
+
+            peer.close()
+            response.raw._pool = pool
+            assert auth._has_idle_authenticated_connection(response, "http://example.com") is False
+        finally:
+            sock.close()
+            peer.close()
+
+    def test_handshake_limiter__no_authenticated_connection(self):
+        limiter = requests_ntlm2.limiter.HandshakeLimiter(max_per_host=1)
+        auth = requests_ntlm2.HttpNtlmAuth(
+            self.test_server_username, self.test_server_password, handshake_limiter=limiter
+        )
+        with mock.patch.object(limiter, "acquire", return_value=True):
+            res = requests.get(url=self.test_server_url + "ntlm", auth=auth)
+        assert res.status_code == 200
+        assert len(res.history) == 2
+        assert auth.stats.handshakes == 1
+
+    @mock.patch("requests_ntlm2.HttpNtlmAuth.retry_using_http_ntlm_auth")
+    def test_response_hook__expired_connection(self, mock_retry_using_http_ntlm_auth):
+        auth = requests_ntlm2.HttpNtlmAuth(self.test_server_username, self.test_server_password)
+        sock = object.__new__(type("Socket", (), {}))
+        auth.connection_state.mark_authenticated(sock, "NTLM")
+        response = requests.Response()
+        response.status_code = 401
+        response.headers["WWW-Authenticate"] = "NTLM"
+        with mock.patch("requests_ntlm2.requests_ntlm2.get_response_socket", return_value=sock):
+            auth.response_hook(response)
+        mock_retry_using_http_ntlm_auth.assert_called_once()
+        assert auth.stats.reused_connections == 0
+        assert auth.stats.expired_connections == 1
+        assert auth.connection_state.is_authenticated(sock) is False
+
+    def test_preemptive(self):
+        for auth_type in self.auth_types:
+            auth = requests_ntlm2.HttpNtlmAuth(
+                self.test_server_username, self.test_server_password, preemptive=True
+            )
+            res = requests.get(url=self.test_server_url + auth_type, auth=auth)
+            assert res.status_code == 200
+            assert len(res.history) == 2
+            assert auth.auth_scheme_cache.get("http://localhost:5000") == (
+                "Negotiate" if auth_type == "negotiate" else "NTLM"
+            )
+
+            res = requests.get(url=self.test_server_url + auth_type, auth=auth)
+            assert res.status_code == 200
+            assert len(res.history) == 1
+            assert res.history[0].status_code == 401
+            assert auth.stats.handshakes == 2
+
+    def test_preemptive__disabled(self):
+        auth = requests_ntlm2.HttpNtlmAuth(self.test_server_username, self.test_server_password)
+        res = requests.get(url=self.test_server_url + "ntlm", auth=auth)
+        assert res.status_code == 200
+        assert len(auth.auth_scheme_cache) == 0
+
+        request = requests.Request("GET", self.test_server_url + "ntlm").prepare()
+        assert auth(request).headers.get("Authorization") is None
+
+    @mock.patch("requests_ntlm2.HttpNtlmAuth.response_hook")
+    def test_preemptive__no_challenge(self, mock_response_hook):
+        auth = requests_ntlm2.HttpNtlmAuth(
+            self.test_server_username, self.test_server_password, preemptive=True
+        )
+        auth.auth_scheme_cache.set("http://localhost:5000", "NTLM")
+        request = requests.Request("GET", self.test_server_url + "negotiate").prepare()
+        request = auth(request)
+        assert request.headers["Authorization"].startswith("NTLM ")
+
+        response = requests.Response()
+        response.url = request.url
+        response.request = request
+        response.status_code = 401
+        response.headers["WWW-Authenticate"] = "Negotiate"
+        ntlm_context = requests_ntlm2.dance.HttpNtlmContext("user", "pass", auth_type="NTLM")
+        auth.preemptive_response_hook(response, ntlm_context=ntlm_context, auth_type="NTLM")
+
+        mock_response_hook.assert_called_once_with(response)
+        assert "Authorization" not in request.headers
+        assert auth.auth_scheme_cache.get("http://localhost:5000") is None
+
+    def test_host_cache(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tempdir, "hosts.cache")
+            auth = requests_ntlm2.HttpNtlmAuth(
+                self.test_server_username, self.test_server_password, host_cache=path
+            )
+            res = requests.get(url=self.test_server_url + "negotiate", auth=auth)
+            assert res.status_code == 200
+            assert len(res.history) == 2
+            capabilities = auth.host_cache.get("http://localhost:5000")
+            assert capabilities.auth_type == "Negotiate"
+            auth.host_cache.close()
+
+            # a fresh process knows straight away that the server uses Negotiate
+            auth = requests_ntlm2.HttpNtlmAuth(
+                self.test_server_username,
+                self.test_server_password,
+                preemptive=True,
+                host_cache=path
+            )
+            res = requests.get(url=self.test_server_url + "negotiate", auth=auth)
+            assert res.status_code == 200
+            assert len(res.history) == 1
+            auth.host_cache.close()
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_host_cache__strict_mode(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            auth = requests_ntlm2.HttpNtlmAuth(
+                self.test_server_username,
+                self.test_server_password,
+                host_cache=os.path.join(tempdir, "hosts.cache")
+            )
+            ntlm_context = mock.MagicMock(challenge_fixed=True)
+            auth._remember_handshake_result("http://example.com", ntlm_context, False)
+            assert auth.host_cache.get("http://example.com").strict_mode is True
+
+            ctx = auth._new_ntlm_context("NTLM", authority="http://example.com")
+            assert ctx.ntlm_strict_mode is True
+            ctx = auth._new_ntlm_context("NTLM", authority="http://example.org")
+            assert ctx.ntlm_strict_mode is False
+
+            ntlm_context = mock.MagicMock(challenge_fixed=True)
+            auth._remember_handshake_result("http://example.com", ntlm_context, True)
+            assert auth.host_cache.get("http://example.com").strict_mode is False
+            auth.host_cache.close()
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_streaming_body_is_replayed(self):
+        sent = []
+
+        def generate():
+            for chunk in (b"foo", b"bar"):
+                sent.append(chunk)
+                yield chunk
+
+        auth = requests_ntlm2.HttpNtlmAuth(self.test_server_username, self.test_server_password)
+        res = requests.post(url=self.test_server_url + "ntlm", data=generate(), auth=auth)
+        assert res.status_code == 200
+        assert len(res.history) == 2
+        assert sent == [b"foo", b"bar"]
+        assert isinstance(res.request.body, requests_ntlm2.body.ReplayableBody)
+        assert b"".join(res.request.body) == b"foobar"
+
+    def test_bodyless_handshake(self):
+        sent = []
+
+        class RecordingAdapter(requests.adapters.HTTPAdapter):
+            def send(self, request, **kwargs):
+                body = request.body
+                if body is not None and not isinstance(body, bytes):
+                    body = b"".join(body)
+                sent.append((request.headers.get("Authorization", ""), body))
+                return super(RecordingAdapter, self).send(request, **kwargs)
+
+        session = requests.Session()
+        session.mount("http://", RecordingAdapter())
+        session.auth = requests_ntlm2.HttpNtlmAuth(
+            self.test_server_username,
+            self.test_server_password,
+            bodyless_handshake_methods=["post"],
+            bodyless_handshake_threshold=5
+        )
+
+        # the first request has to find out that the server uses NTLM
+        res = session.post(self.test_server_url + "ntlm", data=b"payload")
+        assert res.status_code == 200
+        assert len(res.history) == 2
+        assert [body for _, body in sent] == [b"payload", None, b"payload"]
+        assert sent[1][0].startswith("NTLM ")
+
+        # small bodies and other methods are sent on every leg
+        del sent[:]
+        session.close()
+        res = session.post(self.test_server_url + "ntlm", data=b"tiny")
+        assert res.status_code == 200
+        assert [body for _, body in sent] == [b"tiny", b"tiny", b"tiny"]
+
+        # after that the payload is only sent with the authenticate message
+        del sent[:]
+        session.close()
+        res = session.post(self.test_server_url + "ntlm", data=iter([b"pay", b"load"]))
+        assert res.status_code == 200
+        assert len(res.history) == 1
+        assert [body for _, body in sent] == [None, b"payload"]
+        assert sent[0][0].startswith("NTLM ")
+        assert res.history[0].request.headers["Content-Length"] == "0"
+
+    def test_challenge_bodies_are_drained(self):
+        auth = requests_ntlm2.HttpNtlmAuth(self.test_server_username, self.test_server_password)
+        res = requests.get(url=self.test_server_url + "ntlm", auth=auth)
+        assert res.status_code == 200
+        assert [r.content for r in res.history] == [b"", b""]
+
+    def test_challenge_bodies_are_drained__too_big(self):
+        auth = requests_ntlm2.HttpNtlmAuth(
+            self.test_server_username, self.test_server_password, drain_max_bytes=4
+        )
+        with pytest.raises(requests_ntlm2.requests_ntlm2.ChallengeBodyTooLarge, match="within 4 bytes") as e:
+            requests.get(url=self.test_server_url + "ntlm", auth=auth)
+        assert e.value.response.status_code == 401
+        assert auth.stats.failed_handshakes == 1
+        assert auth.stats.handshakes == 0
+
+    def test_challenge_bodies_are_drained__too_slow_once(self):
+        auth = requests_ntlm2.HttpNtlmAuth(self.test_server_username, self.test_server_password)
+        drain_response = auth._drain_response
+        challenges = []
+
+        def drain_first_challenge_too_slowly(response):
+            if "NTLM " in response.headers.get("www-authenticate", ""):
+                challenges.append(response)
+                if len(challenges) == 1:
+                    response.raw.close()
+                    return False
+            return drain_response(response)
+
+        # the challenge belongs to the connection that had to be closed, so
+        # the dance starts over on a new one
+        with mock.patch.object(auth, "_drain_response", side_effect=drain_first_challenge_too_slowly):
+            res = requests.get(url=self.test_server_url + "ntlm", auth=auth)
+        assert res.status_code == 200
+        assert len(challenges) == 2
+        assert [r.status_code for r in res.history] == [401, 401, 401]
+        assert res.history[1:] == challenges
+        assert auth.stats.failed_handshakes == 0
+        assert auth.stats.handshakes == 1
+
     def test_username_parse_backslash(self):
         test_user = "domain\\user"
         expected_domain = "DOMAIN"
@@ -0,0 +1,132 @@
+import io
+import os
+
+import ntlm_auth.session_security
+import pytest
+from ntlm_auth.constants import NegotiateFlags
+
+import requests_ntlm2.session_security
+
+
+ESS = NegotiateFlags.NTLMSSP_NEGOTIATE_EXTENDED_SESSIONSECURITY
+FLAG_COMBINATIONS = (
+    NegotiateFlags.NTLMSSP_NEGOTIATE_SEAL | NegotiateFlags.NTLMSSP_NEGOTIATE_SIGN | ESS
+    | NegotiateFlags.NTLMSSP_NEGOTIATE_KEY_EXCH | NegotiateFlags.NTLMSSP_NEGOTIATE_128,
+    NegotiateFlags.NTLMSSP_NEGOTIATE_SEAL | NegotiateFlags.NTLMSSP_NEGOTIATE_SIGN | ESS,
+    NegotiateFlags.NTLMSSP_NEGOTIATE_SIGN | ESS | NegotiateFlags.NTLMSSP_NEGOTIATE_KEY_EXCH,
+    NegotiateFlags.NTLMSSP_NEGOTIATE_SEAL | NegotiateFlags.NTLMSSP_NEGOTIATE_SIGN
+    | NegotiateFlags.NTLMSSP_NEGOTIATE_56,
+    NegotiateFlags.NTLMSSP_NEGOTIATE_SIGN,
+    0,
+)
+SESSION_KEY = b"\x55" * 16
+MESSAGES = [b"", b"hello world", os.urandom(1024), os.urandom(70000)]
+
+
+@pytest.mark.parametrize("flags", FLAG_COMBINATIONS)
+def test_matches_ntlm_auth(flags):
+    expected = ntlm_auth.session_security.SessionSecurity(flags, SESSION_KEY)
+    actual = requests_ntlm2.session_security.SessionSecurity(flags, SESSION_KEY)
+    assert isinstance(actual, ntlm_auth.session_security.SessionSecurity)
+    for message in MESSAGES:
+        assert actual.wrap(message) == expected.wrap(message)
+    assert actual.outgoing_seq_num == expected.outgoing_seq_num
+
+
+@pytest.mark.parametrize("flags", FLAG_COMBINATIONS)
+def test_round_trip(flags):
+    client = requests_ntlm2.session_security.SessionSecurity(flags, SESSION_KEY)
+    server = ntlm_auth.session_security.SessionSecurity(flags, SESSION_KEY, source="server")
+    for message in MESSAGES:
+        wrapped, signature = client.wrap(message)
+        assert server.unwrap(wrapped, signature) == message
+
+        wrapped, signature = server.wrap(message)
+        assert client.unwrap(wrapped, signature) == message
+    assert client.incoming_seq_num == server.outgoing_seq_num
+
+
+@pytest.mark.parametrize("message_type", (bytes, bytearray, memoryview))
+def test_buffer_types(message_type):
+    flags = FLAG_COMBINATIONS[0]
+    expected = ntlm_auth.session_security.SessionSecurity(flags, SESSION_KEY)
+    actual = requests_ntlm2.session_security.SessionSecurity(flags, SESSION_KEY)
+    message = os.urandom(4096)
+    assert actual.wrap(message_type(message)) == expected.wrap(message)
+
+    client = ntlm_auth.session_security.SessionSecurity(flags, SESSION_KEY)
+    server = requests_ntlm2.session_security.SessionSecurity(flags, SESSION_KEY, source="server")
+    wrapped, signature = client.wrap(message)
+    assert server.unwrap(message_type(wrapped), memoryview(signature)) == message
+
+
+def test_verify_signature():
+    flags = FLAG_COMBINATIONS[0]
+    client = requests_ntlm2.session_security.SessionSecurity(flags, SESSION_KEY)
+    server = requests_ntlm2.session_security.SessionSecurity(flags, SESSION_KEY, source="server")
+
+    wrapped, signature = client.wrap(b"message")
+    with pytest.raises(Exception, match="message has been altered"):
+        server.unwrap(b"X" + wrapped[1:], signature)
+
+    server.reset_rc4_state(outgoing=False)
+    wrapped, signature = client.wrap(b"message")
+    with pytest.raises(Exception, match="checksum does not match"):
+        server.unwrap(wrapped, signature)
+
+    flags = NegotiateFlags.NTLMSSP_NEGOTIATE_SIGN | ESS
+    client = requests_ntlm2.session_security.SessionSecurity(flags, SESSION_KEY)
+    server = requests_ntlm2.session_security.SessionSecurity(flags, SESSION_KEY, source="server")
+    client.wrap(b"lost")
+    wrapped, signature = client.wrap(b"message")
+    with pytest.raises(Exception):
+        server.unwrap(wrapped, signature)
+
+
+@pytest.mark.parametrize("flags", FLAG_COMBINATIONS)
+def test_wrap_stream_matches_wrap(flags):
+    expected = ntlm_auth.session_security.SessionSecurity(flags, SESSION_KEY)
+    actual = requests_ntlm2.session_security.SessionSecurity(flags, SESSION_KEY)
+    for message in MESSAGES:
+        stream = actual.wrap_stream([message[:100], message[100:]], chunk_size=4096)
+        wrapped = b"".join(bytes(chunk) for chunk in stream)
+        assert (wrapped, stream.signature) == expected.wrap(message)
+    assert actual.outgoing_seq_num == expected.outgoing_seq_num
+
+
+@pytest.mark.parametrize("flags", FLAG_COMBINATIONS)
+def test_unwrap_stream_matches_unwrap(flags):
+    client = ntlm_auth.session_security.SessionSecurity(flags, SESSION_KEY)
+    server = requests_ntlm2.session_security.SessionSecurity(flags, SESSION_KEY, source="server")
+    for message in MESSAGES:
+        wrapped, signature = client.wrap(message)
+        output = io.BytesIO()
+        server.unwrap_stream(io.BytesIO(wrapped), signature, chunk_size=1000).write_to(output)
+        assert output.getvalue() == message
+    assert server.incoming_seq_num == client.outgoing_seq_num
+
+
+def test_wrap_stream_iter_signed():
+    flags = FLAG_COMBINATIONS[0]
+    expected = ntlm_auth.session_security.SessionSecurity(flags, SESSION_KEY)
+    actual = requests_ntlm2.session_security.SessionSecurity(flags, SESSION_KEY)
+    message = os.urandom(70000)
+    chunks = list(actual.wrap_stream(io.BytesIO(message), chunk_size=8192).iter_signed(spool_threshold=1024))
+    wrapped, signature = expected.wrap(message)
+    assert chunks[0] == signature
+    assert b"".join(chunks[1:]) == wrapped
+    assert max(len(chunk) for chunk in chunks[1:]) == 8192
+
+
+def test_unwrap_stream_altered():
+    flags = FLAG_COMBINATIONS[0]
+    client = requests_ntlm2.session_security.SessionSecurity(flags, SESSION_KEY)
+    server = requests_ntlm2.session_security.SessionSecurity(flags, SESSION_KEY, source="server")
+    stream = client.wrap_stream([b"message"])
+    wrapped = b"".join(stream)
+
+    chunks = []
+    with pytest.raises(Exception, match="message has been altered"):
+        for chunk in server.unwrap_stream([b"X" + wrapped[1:]], stream.signature):
+            chunks.append(chunk)
+    assert len(chunks) == 1
@@ -0,0 +1,129 @@
+import socket
+
+import mock
+
+import requests_ntlm2.state
+
+
+class TestHandshakeStats(object):
+    def test_increment(self):
+        stats = requests_ntlm2.state.HandshakeStats()
+        assert stats.as_dict() == {
+            "handshakes": 0,
+            "failed_handshakes": 0,
+            "reused_connections": 0,
+            "expired_connections": 0,
+        }
+        stats.increment("handshakes")
+        stats.increment("reused_connections")
+        stats.increment("reused_connections")
+        assert stats.handshakes == 1
+        assert stats.reused_connections == 2
+        assert "handshakes=1" in repr(stats)
+
+
+class TestConnectionStateRegistry(object):
+    def test_mark_authenticated(self):
+        registry = requests_ntlm2.state.ConnectionStateRegistry()
+        sock = socket.socket()
+        try:
+            assert registry.is_authenticated(sock) is False
+            state = registry.mark_authenticated(sock, "NTLM", "http://example.com")
+            assert state.auth_type == "NTLM"
+            assert state.authority == "http://example.com"
+            assert registry.is_authenticated(sock) is True
+            assert registry.get(sock) is state
+            assert len(registry) == 1
+
+            assert registry.forget(sock) is state
+            assert registry.is_authenticated(sock) is False
+            assert registry.forget(sock) is None
+        finally:
+            sock.close()
+
+    def test_is_authenticated_socket(self):
+        registry, other_registry = (
+            requests_ntlm2.state.ConnectionStateRegistry(), requests_ntlm2.state.ConnectionStateRegistry()
+        )
+        sock = socket.socket()
+        try:
+            registry.mark_authenticated(sock, "NTLM", "http://example.com")
+            assert requests_ntlm2.state.is_authenticated_socket(sock) is True
+
+            # other registries only forget the sockets they marked themselves
+            assert other_registry.forget(sock) is None
+            assert requests_ntlm2.state.is_authenticated_socket(sock) is True
+            other_registry.mark_authenticated(sock, "NTLM", "http://example.com")
+            other_registry.forget(sock)
+            assert requests_ntlm2.state.is_authenticated_socket(sock) is True
+
+            registry.forget(sock)
+            assert requests_ntlm2.state.is_authenticated_socket(sock) is False
+            assert requests_ntlm2.state.is_authenticated_socket(None) is False
+        finally:
+            sock.close()
+
+    def test_has_authenticated(self):
+        registry = requests_ntlm2.state.ConnectionStateRegistry()
+        sock = socket.socket()
+        registry.mark_authenticated(sock, "NTLM", "http://example.com")
+        assert registry.has_authenticated("http://example.com") is True
+        assert registry.has_authenticated("http://example.org") is False
+
+        sock.close()
+        assert registry.has_authenticated("http://example.com") is False
+
+    def test_none_socket(self):
+        registry = requests_ntlm2.state.ConnectionStateRegistry()
+        assert registry.mark_authenticated(None, "NTLM") is None
+        assert registry.is_authenticated(None) is False
+        assert registry.forget(None) is None
+        assert len(registry) == 0
+
+    def test_unhashable_socket(self):
+        registry = requests_ntlm2.state.ConnectionStateRegistry()
+        assert registry.mark_authenticated(1, "NTLM") is None
+        assert registry.is_authenticated(1) is False
+
+    def test_sockets_are_weakly_referenced(self):
+        registry = requests_ntlm2.state.ConnectionStateRegistry()
+        sock = socket.socket()
+        registry.mark_authenticated(sock, "NTLM")
+        assert len(registry) == 1
+        sock.close()
+        del sock
+        assert len(registry) == 0
+
+    def test_closed_sockets_are_pruned(self):
+        registry = requests_ntlm2.state.ConnectionStateRegistry()
+        closed, sock = socket.socket(), socket.socket()
+        registry.mark_authenticated(closed, "NTLM")
+        closed.close()
+        try:
+            registry.mark_authenticated(sock, "NTLM")
+            assert len(registry) == 1
+            assert registry.is_authenticated(closed) is False
+        finally:
+            sock.close()
+
+    def test_bind_response(self):
+        registry = requests_ntlm2.state.ConnectionStateRegistry()
+        session_security = mock.Mock()
+        sock, other_sock = socket.socket(), socket.socket()
+        response, other_response = mock.Mock(), mock.Mock()
+        try:
+            state = registry.mark_authenticated(sock, "NTLM", session_security=session_security)
+            assert state.session_security is session_security
+            assert registry.bind_response(response, sock) is state
+            assert registry.bind_response(other_response, other_sock) is None
+        finally:
+            sock.close()
+            other_sock.close()
+
+        # the state outlives the connection for as long as the response is around
+        del sock
+        assert len(registry) == 0
+        assert registry.get_for_response(response) is state
+        assert registry.get_for_response(other_response) is None
+        del response
+        assert len(registry._responses) == 0
@@ -0,0 +1,101 @@
+import mock
+import pytest
+
+import requests_ntlm2.tunnels
+from tests.test_utils import FakeTimer
+
+
+KEY = ("proxy", 8080, "target", 443)
+OTHER_KEY = ("proxy", 8080, "other", 443)
+
+
+def get_pool(timer, **kwargs):
+    return requests_ntlm2.tunnels.TunnelPool(timer=timer, **kwargs)
+
+
+class TestTunnelPool(object):
+    def test_init(self):
+        with pytest.raises(ValueError, match="maxsize must be at least 1, got 0"):
+            requests_ntlm2.tunnels.TunnelPool(maxsize=0)
+
+    def test_put_and_get(self):
+        timer = FakeTimer()
+        pool = get_pool(timer)
+        sock = mock.Mock()
+        assert pool.get(KEY) is None
+        assert pool.put(KEY, sock, created_at=0, is_verified=True)
+        timer.now = 5
+        assert pool.get(OTHER_KEY) is None
+        assert len(pool) == 1
+
+        tunnel = pool.get(KEY)
+        assert tunnel == requests_ntlm2.tunnels.Tunnel(sock, 0, 0, True)
+        assert pool.get(KEY) is None
+        assert len(pool) == 0
+        assert (pool.hits, pool.misses, pool.evictions) == (1, 3, 0)
+        sock.close.assert_not_called()
+
+    def test_get__most_recent_first(self):
+        pool = get_pool(FakeTimer())
+        first, second = mock.Mock(), mock.Mock()
+        pool.put(KEY, first, created_at=0)
+        pool.put(KEY, second, created_at=0)
+        assert pool.get(KEY).sock is second
+        assert pool.get(KEY).sock is first
+
+    def test_max_idle(self):
+        timer = FakeTimer()
+        pool = get_pool(timer, max_idle=10)
+        sock = mock.Mock()
+        pool.put(KEY, sock, created_at=0)
+        timer.now = 10
+        assert pool.get(KEY) is None
+        sock.close.assert_called_once_with()
+        assert pool.evictions == 1
+
+    def test_max_age(self):
+        timer = FakeTimer()
+        pool = get_pool(timer, max_idle=None, max_age=100)
+        timer.now = 100
+        sock = mock.Mock()
+        assert not pool.put(KEY, sock, created_at=0)
+        assert len(pool) == 0
+        sock.close.assert_not_called()
+
+        pool.put(KEY, sock, created_at=50)
+        timer.now = 149
+        assert pool.prune() == 0
+        timer.now = 150
+        assert pool.prune() == 1
+        sock.close.assert_called_once_with()
+
+    def test_maxsize(self):
+        pool = get_pool(FakeTimer(), maxsize=2)
+        socks = [mock.Mock() for _ in range(3)]
+        pool.put(KEY, socks[0], created_at=0)
+        pool.put(OTHER_KEY, socks[1], created_at=0)
+        pool.put(KEY, socks[2], created_at=0)
+        assert len(pool) == 2
+        assert pool.evictions == 1
+        socks[0].close.assert_called_once_with()
+        assert pool.get(KEY).sock is socks[2]
+        assert pool.get(OTHER_KEY).sock is socks[1]
+
+    def test_clear(self):
+        pool = get_pool(FakeTimer())
+        sock = mock.Mock()
+        sock.close.side_effect = OSError("already closed")
+        pool.put(KEY, sock, created_at=0)
+        pool.clear()
+        assert len(pool) == 0
+        sock.close.assert_called_once_with()
+
+
+def test_get_tunnel_pool():
+    pool = requests_ntlm2.tunnels.TunnelPool()
+    assert requests_ntlm2.tunnels.get_tunnel_pool(None) is None
+    assert requests_ntlm2.tunnels.get_tunnel_pool(False) is None
+    assert requests_ntlm2.tunnels.get_tunnel_pool(pool) is pool
+    assert isinstance(requests_ntlm2.tunnels.get_tunnel_pool(True), requests_ntlm2.tunnels.TunnelPool)
+    with pytest.raises(TypeError):
+        requests_ntlm2.tunnels.get_tunnel_pool("yes")